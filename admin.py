@@ -0,0 +1,84 @@
+import os
+import asyncio
+import logging
+import tempfile
+
+from aiogram import F, Router, types
+from aiogram.filters import Command, CommandObject
+from aiogram.types import BufferedInputFile, FSInputFile
+
+import broadcast
+import export
+from monitor import monitor
+
+logger = logging.getLogger(__name__)
+
+# Telegram id администраторов через запятую; без них служебные команды недоступны
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+# больше бот отправить файлом не может (лимит Bot API — 50 МБ)
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+
+router = Router()
+# сообщения не от администраторов проходят дальше, в handlers.router
+router.message.filter(F.from_user.id.in_(ADMIN_IDS))
+
+
+@router.message(Command("debug_state"))
+async def debug_state(message: types.Message):
+    """Состояние процесса: задержка цикла событий, самописец апдейтов, топ выделений памяти."""
+    report = monitor.state_report()
+    logger.info("Admin %s requested debug state", message.from_user.id)
+    await message.answer_document(
+        BufferedInputFile(report.encode("utf-8"), filename="debug_state.txt"),
+        caption=f"Задержка цикла: {monitor.last_lag * 1000:.1f} мс (макс. {monitor.max_lag * 1000:.1f} мс), "
+                f"в работе апдейтов: {len(monitor.in_flight)}",
+    )
+
+
+@router.message(Command("digest"))
+async def digest_status(message: types.Message):
+    """Прогресс последних сезонных рассылок."""
+    rows = await broadcast.status()
+    if not rows:
+        await message.answer("Рассылок ещё не было.")
+        return
+    lines = []
+    for row in rows:
+        state = f"завершена {row.finished_at:%d.%m %H:%M}" if row.finished_at else f"идёт, до id {row.last_user_id}"
+        lines.append(f"<b>{row.key}</b>: {state}\nотправлено {row.sent}, заблокировали {row.blocked}, "
+                     f"ошибок {row.failed}")
+    await message.answer("\n\n".join(lines))
+
+
+_export_lock = asyncio.Lock()
+
+
+@router.message(Command("export"))
+async def export_data(message: types.Message, command: CommandObject):
+    """/export users|favorites|completions|routes [csv|jsonl] — выгрузка файлом (gzip)."""
+    args = (command.args or "").split()
+    kind = args[0] if args else ""
+    fmt = args[1] if len(args) > 1 else "csv"
+    if kind not in export.EXPORTS or fmt not in export.FORMATS:
+        await message.answer(f"Использование: /export {'|'.join(export.EXPORTS)} [{'|'.join(export.FORMATS)}]")
+        return
+    if _export_lock.locked():
+        await message.answer("Выгрузка уже идёт, дождитесь файла.")
+        return
+    async with _export_lock:
+        logger.info("Admin %s requested %s export as %s", message.from_user.id, kind, fmt)
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+        os.close(fd)
+        try:
+            count = await export.export_gzip(kind, fmt, path)
+            size = os.path.getsize(path)
+            if size > EXPORT_MAX_BYTES:
+                logger.warning("Export %s is %s bytes, over the %s bytes upload limit", kind, size, EXPORT_MAX_BYTES)
+                await message.answer(
+                    f"Выгрузка слишком большая для отправки: {size / 2**20:.1f} МБ при лимите "
+                    f"{EXPORT_MAX_BYTES / 2**20:.0f} МБ (строк: {count}). Выгрузите на сервере: "
+                    f"<code>python export.py {kind} --format {fmt} -o {kind}.{fmt}</code>")
+                return
+            await message.answer_document(FSInputFile(path, filename=f"{kind}.{fmt}.gz"), caption=f"Строк: {count}")
+        finally:
+            os.remove(path)
@@ -0,0 +1,162 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Deque, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # ответы на нажатия, навигация по меню и мастеру предпочтений
+    NORMAL = 1  # текстовые сообщения и прочие апдейты
+    HEAVY = 2  # экраны с выдачей: загрузка каталога и серия send_message
+
+
+HEAVY_ACTIONS = {"find_routes", "my_routes", "show_stats", "stats_details_all"}
+HEAVY_PREFIXES = ("similar_",)
+
+MAX_RUNNING = int(os.getenv("ADMISSION_MAX_RUNNING", "32"))
+CLASS_LIMITS = {
+    Priority.INTERACTIVE: MAX_RUNNING,
+    Priority.NORMAL: int(os.getenv("ADMISSION_NORMAL_LIMIT", "16")),
+    Priority.HEAVY: int(os.getenv("ADMISSION_HEAVY_LIMIT", "4")),
+}
+QUEUE_LIMITS = {
+    Priority.INTERACTIVE: int(os.getenv("ADMISSION_QUEUE", "200")),
+    Priority.NORMAL: int(os.getenv("ADMISSION_QUEUE", "200")) // 2,
+    Priority.HEAVY: int(os.getenv("ADMISSION_HEAVY_QUEUE", "16")),
+}
+MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "8"))
+
+SHED_TEXT = "Сейчас много запросов, попробуйте ещё раз через минутку 🙏"
+
+
+def classify(update: Update) -> Priority:
+    if update.inline_query is not None:
+        return Priority.INTERACTIVE
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        if data in HEAVY_ACTIONS or data.startswith(HEAVY_PREFIXES):
+            return Priority.HEAVY
+        return Priority.INTERACTIVE
+    return Priority.NORMAL
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController:
+    """Ограничивает число одновременно выполняемых апдейтов с учётом класса приоритета.
+
+    Свободный слот всегда достаётся самому приоритетному ожидающему классу, у которого
+    не исчерпан собственный лимит. Очередь каждого класса ограничена: если она полна
+    или ожидание длится дольше ``max_wait``, апдейт отбрасывается (Overloaded).
+    """
+
+    def __init__(self, max_running: int = MAX_RUNNING, class_limits: Dict[Priority, int] = None,
+                 queue_limits: Dict[Priority, int] = None, max_wait: float = MAX_WAIT):
+        self.max_running = max_running
+        self.class_limits = class_limits or CLASS_LIMITS
+        self.queue_limits = queue_limits or QUEUE_LIMITS
+        self.max_wait = max_wait
+        self.running = 0
+        self.running_by_class = {p: 0 for p in Priority}
+        self.waiters: Dict[Priority, Deque[asyncio.Future]] = {p: deque() for p in Priority}
+        self.shed_count = {p: 0 for p in Priority}
+
+    def _has_slot(self, priority: Priority) -> bool:
+        return self.running < self.max_running and self.running_by_class[priority] < self.class_limits[priority]
+
+    def _take(self, priority: Priority) -> None:
+        self.running += 1
+        self.running_by_class[priority] += 1
+
+    def _shed(self, priority: Priority, reason: str):
+        self.shed_count[priority] += 1
+        raise Overloaded(f"{priority.name}: {reason}")
+
+    async def acquire(self, priority: Priority) -> None:
+        queue = self.waiters[priority]
+        ahead = any(self.waiters[p] for p in Priority if p <= priority)
+        if not ahead and self._has_slot(priority):
+            self._take(priority)
+            return
+        if len(queue) >= self.queue_limits[priority]:
+            self._shed(priority, "queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if future.done():
+                return
+            future.cancel()
+            queue.remove(future)
+            self._shed(priority, "waited too long")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(priority)
+            else:
+                future.cancel()
+                if future in queue:
+                    queue.remove(future)
+            raise
+
+    def release(self, priority: Priority) -> None:
+        self.running -= 1
+        self.running_by_class[priority] -= 1
+        for p in Priority:
+            queue = self.waiters[p]
+            while queue and self._has_slot(p):
+                future = queue.popleft()
+                if not future.done():
+                    self._take(p)
+                    future.set_result(None)
+
+    def depths(self) -> Dict[str, int]:
+        return {p.name.lower(): len(q) for p, q in self.waiters.items()}
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Пускает апдейт к обработчикам только при наличии слота, иначе сразу отвечает
+    пользователю «попробуйте ещё раз» вместо зависшего спиннера."""
+
+    def __init__(self, controller: AdmissionController = None):
+        self.controller = controller or AdmissionController()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Update):
+            return await handler(event, data)
+        priority = classify(event)
+        try:
+            await self.controller.acquire(priority)
+        except Overloaded as e:
+            logger.warning("Shedding update %s (%s)", event.update_id, e)
+            await self._reply_overloaded(event)
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            self.controller.release(priority)
+
+    @staticmethod
+    async def _reply_overloaded(update: Update) -> None:
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(SHED_TEXT)
+            elif update.message is not None:
+                await update.message.answer(SHED_TEXT)
+        except Exception:
+            logger.exception("Failed to notify user about shed update %s", update.update_id)
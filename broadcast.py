@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import exists, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+import catalog
+import metrics
+from db import AsyncSessionLocal
+from models import BlockedUser, Broadcast, User
+from recommender import SEASONS_BY_MONTH, top_routes
+from utils import SEASON_NAMES
+
+logger = logging.getLogger(__name__)
+
+# дайджест «маршруты сезона» при смене сезона; 0 — выключен
+BROADCAST_DIGEST = os.getenv("BROADCAST_DIGEST", "1") == "1"
+# сообщений в секунду на всю рассылку: общий лимит Telegram около 30, часть оставляем ответам пользователям
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_CHECK_INTERVAL = float(os.getenv("BROADCAST_CHECK_INTERVAL", "3600"))
+DIGEST_SIZE = int(os.getenv("DIGEST_SIZE", "3"))
+# аренда рассылки: если процесс упал, другой продолжит её после истечения аренды
+LEASE_SECONDS = 120
+SEND_ATTEMPTS = 3
+
+messages_sent = metrics.registry.counter(
+    "bot_broadcast_messages_total", "Сообщения рассылок по результату", ("result",))
+
+digest_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔍 Найти маршруты", callback_data="find_routes")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")],
+])
+
+SEASON_GREETINGS = {
+    "winter": "Наступила зима!",
+    "spring": "Наступила весна!",
+    "summer": "Наступило лето!",
+    "autumn": "Наступила осень!",
+}
+
+
+class TokenBucket:
+    """Не больше ``rate`` отправок в секунду с запасом ``burst``; pause() останавливает всех
+    отправителей (ответ Telegram «retry after»)."""
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def digest_key(now: datetime) -> Tuple[str, str]:
+    """Ключ рассылки и сезон; зима относится к году, в котором началась (декабрь)."""
+    season = SEASONS_BY_MONTH[now.month]
+    year = now.year - 1 if season == "winter" and now.month <= 2 else now.year
+    return f"digest:{year}-{season}", season
+
+
+def digest_text(season: str, ranked: List[Tuple[float, Dict[str, Any]]]) -> str:
+    lines = [f"{SEASON_NAMES.get(season, season)} — {SEASON_GREETINGS.get(season, '')}",
+             "Маршруты сезона для вас:", ""]
+    for i, (_, route) in enumerate(ranked, 1):
+        lines.append(f"{i}. <b>{route['title']}</b> — {route.get('length_km')} км, {route.get('difficulty')}")
+    lines.append("")
+    lines.append("Все подборки — в разделе «Найти маршруты».")
+    return "\n".join(lines)
+
+
+class DigestBroadcast:
+    """Рассылка дайджеста одного сезона всем пользователям.
+
+    Пользователи читаются пачками по ``users.id`` (keyset), в памяти только текущая пачка. Подборки
+    считаются по одному снимку каталога и кэшируются по строке предпочтений: у многих пользователей
+    они совпадают. После каждой пачки прогресс записывается в ``broadcasts``; при перезапуске
+    рассылка продолжается со следующей пачки, так что повторно получить сообщение может не больше
+    одной пачки пользователей.
+    """
+
+    def __init__(self, bot: Bot, key: str, season: str, rate: float = BROADCAST_RATE,
+                 batch: int = BROADCAST_BATCH, concurrency: int = BROADCAST_CONCURRENCY,
+                 digest_size: int = DIGEST_SIZE):
+        self.bot = bot
+        self.key = key
+        self.season = season
+        self.batch = batch
+        self.digest_size = digest_size
+        self.bucket = TokenBucket(rate, burst=max(1.0, min(rate, concurrency)))
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._texts: OrderedDict = OrderedDict()
+        self._routes: List[Dict[str, Any]] = []
+
+    async def claim(self) -> Broadcast | None:
+        """Создаёт запись рассылки, если её нет, и берёт аренду; None — рассылку ведёт другой процесс
+        или она уже завершена."""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as session:
+            try:
+                await session.execute(insert(Broadcast).values(key=self.key, last_user_id=0, sent=0,
+                                                               blocked=0, failed=0, started_at=now))
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+            result = await session.execute(
+                update(Broadcast)
+                .where(Broadcast.key == self.key, Broadcast.finished_at.is_(None),
+                       (Broadcast.lease_until.is_(None)) | (Broadcast.lease_until < now)
+                       | (Broadcast.lease_owner == self.owner))
+                .values(lease_owner=self.owner, lease_until=now + timedelta(seconds=LEASE_SECONDS))
+            )
+            await session.commit()
+            if result.rowcount != 1:
+                return None
+            return await session.get(Broadcast, self.key)
+
+    def text_for(self, preferences: str | None) -> str:
+        cached = self._texts.get(preferences)
+        if cached is not None:
+            self._texts.move_to_end(preferences)
+            return cached
+        try:
+            prefs = json.loads(preferences) if preferences else {}
+        except ValueError:
+            prefs = {}
+        if prefs:
+            ranked = top_routes(self._routes, prefs, self.season, self.digest_size)
+        else:
+            ranked = [(0.0, r) for r in sorted(self._routes, key=lambda r: -(r.get("popularity") or 0))
+                      [:self.digest_size]]
+        text = self._texts[preferences] = digest_text(self.season, ranked)
+        if len(self._texts) > 4096:
+            self._texts.popitem(last=False)
+        return text
+
+    async def deliver(self, tg_id: int, text: str) -> str:
+        """Отправляет одно сообщение: sent, blocked или failed."""
+        async with self.semaphore:
+            for attempt in range(SEND_ATTEMPTS):
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(tg_id, text, reply_markup=digest_keyboard,
+                                                disable_web_page_preview=True)
+                    return "sent"
+                except TelegramRetryAfter as e:
+                    logger.warning("Broadcast %s: flood control, pausing for %ss", self.key, e.retry_after)
+                    self.bucket.pause(e.retry_after)
+                except TelegramForbiddenError:
+                    return "blocked"
+                except TelegramBadRequest as e:
+                    if "chat not found" in e.message.lower():
+                        return "blocked"
+                    logger.warning("Broadcast %s: failed to send to %s: %s", self.key, tg_id, e.message)
+                    return "failed"
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    logger.warning("Broadcast %s: %s for %s, attempt %s", self.key, e, tg_id, attempt + 1)
+                    await asyncio.sleep(2 ** attempt)
+            return "failed"
+
+    async def _next_batch(self, last_id: int) -> List[Any]:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(User.id, User.tg_id, User.preferences)
+                .where(User.id > last_id, ~exists().where(BlockedUser.user_id == User.id))
+                .order_by(User.id)
+                .limit(self.batch)
+            )
+            return result.all()
+
+    async def _checkpoint(self, last_id: int, counts: Counter, blocked_ids: List[int], finished: bool) -> bool:
+        """Записывает прогресс и продлевает аренду; False — аренду перехватил другой процесс."""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as session:
+            if blocked_ids:
+                # заблокированные не попадают в пачку, поэтому конфликтов здесь нет
+                await session.execute(insert(BlockedUser),
+                                      [{"user_id": user_id, "blocked_at": now} for user_id in blocked_ids])
+            values = dict(
+                last_user_id=last_id,
+                sent=Broadcast.sent + counts["sent"],
+                blocked=Broadcast.blocked + counts["blocked"],
+                failed=Broadcast.failed + counts["failed"],
+                lease_until=now + timedelta(seconds=LEASE_SECONDS),
+            )
+            if finished:
+                values.update(finished_at=now, lease_owner=None, lease_until=None)
+            result = await session.execute(
+                update(Broadcast).where(Broadcast.key == self.key, Broadcast.lease_owner == self.owner)
+                .values(**values)
+            )
+            await session.commit()
+            return result.rowcount == 1
+
+    async def run(self) -> Dict[str, int] | None:
+        state = await self.claim()
+        if state is None:
+            return None
+        snapshot = await catalog.get_snapshot()
+        self._routes = [r for r in snapshot.routes if self.season in r.get("seasons", [])] or snapshot.routes
+        last_id = state.last_user_id
+        totals: Counter = Counter(sent=state.sent, blocked=state.blocked, failed=state.failed)
+        logger.info("Broadcast %s started from user id > %s (%s routes in season)",
+                    self.key, last_id, len(self._routes))
+        started = time.monotonic()
+        while True:
+            rows = await self._next_batch(last_id)
+            counts: Counter = Counter()
+            blocked_ids: List[int] = []
+            if rows:
+                results = await asyncio.gather(*(self.deliver(row.tg_id, self.text_for(row.preferences))
+                                                 for row in rows))
+                counts.update(results)
+                for result, n in counts.items():
+                    messages_sent.labels(result).inc(n)
+                blocked_ids = [row.id for row, result in zip(rows, results) if result == "blocked"]
+                last_id = rows[-1].id
+                totals.update(counts)
+            finished = len(rows) < self.batch
+            if not await self._checkpoint(last_id, counts, blocked_ids, finished):
+                logger.warning("Broadcast %s: lease lost at user id %s, stopping", self.key, last_id)
+                return None
+            if finished:
+                break
+            logger.info("Broadcast %s: up to user id %s, sent %s, blocked %s, failed %s (%.1f msg/s)",
+                        self.key, last_id, totals["sent"], totals["blocked"], totals["failed"],
+                        totals["sent"] / max(time.monotonic() - started, 1e-6))
+        logger.info("Broadcast %s finished: sent %s, blocked %s, failed %s",
+                    self.key, totals["sent"], totals["blocked"], totals["failed"])
+        return dict(totals)
+
+
+async def run_due(bot: Bot, now: datetime | None = None) -> Dict[str, int] | None:
+    """Запускает или продолжает дайджест текущего сезона, если он ещё не разослан.
+
+    При самом первом запуске текущий сезон считается уже разосланным: дайджест уходит только
+    при смене сезона, а не в середине сезона после деплоя.
+    """
+    key, season = digest_key(now or datetime.utcnow())
+    async with AsyncSessionLocal() as session:
+        state = await session.get(Broadcast, key)
+        if state is None:
+            previous = await session.scalar(select(func.count()).where(Broadcast.key.like("digest:%")))
+            if not previous:
+                session.add(Broadcast(key=key, finished_at=datetime.utcnow()))
+                try:
+                    await session.commit()
+                    logger.info("Broadcast %s marked as done: first run, waiting for the next season", key)
+                except IntegrityError:
+                    await session.rollback()
+                return None
+        elif state.finished_at is not None:
+            return None
+    return await DigestBroadcast(bot, key, season).run()
+
+
+async def watch(bot: Bot, interval: float = BROADCAST_CHECK_INTERVAL) -> None:
+    """Фоновая задача: раз в ``interval`` секунд проверяет, не сменился ли сезон."""
+    while True:
+        try:
+            await run_due(bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Digest broadcast failed, will retry in %ss", interval)
+        await asyncio.sleep(interval)
+
+
+async def status(limit: int = 5) -> List[Broadcast]:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(Broadcast).order_by(Broadcast.started_at.desc()).limit(limit))
+        return list(result.scalars())
+
+
+_watch_task: asyncio.Task | None = None
+
+
+def start(bot: Bot) -> None:
+    global _watch_task
+    if _watch_task is None:
+        _watch_task = asyncio.create_task(watch(bot), name="digest-broadcast")
+
+
+async def stop() -> None:
+    """Останавливает рассылку; прогресс уже записан на последней контрольной точке."""
+    global _watch_task
+    if _watch_task is not None:
+        _watch_task.cancel()
+        try:
+            await _watch_task
+        except asyncio.CancelledError:
+            pass
+        _watch_task = None
@@ -0,0 +1,190 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List
+
+import metrics
+from db import AsyncSessionLocal, SCHEMA_VERSION, engine, read_meta
+from loaders import load_routes_with_meta
+
+logger = logging.getLogger(__name__)
+
+# файл снимка каталога; по умолчанию рядом с файлом SQLite (<база>.catalog.json), "-" — не использовать
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "")
+# как часто проверять catalog_version в app_meta, секунды (0 — не проверять, каталог меняется только перезапуском)
+CATALOG_POLL_INTERVAL = float(os.getenv("CATALOG_POLL_INTERVAL", "30"))
+
+
+async def fetch_routes_with_meta(session) -> List[Dict[str, Any]]:
+    return list((await load_routes_with_meta(session)).values())
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога маршрутов (словари из fetch_routes_with_meta).
+
+    Словари маршрутов общие для всех апдейтов процесса — менять их нельзя.
+    """
+
+    def __init__(self, routes: List[Dict[str, Any]], version: int = 0):
+        self.routes = routes
+        self.by_id = {r["id"]: r for r in routes}
+        self.version = version
+
+    def __len__(self) -> int:
+        return len(self.routes)
+
+
+def snapshot_path() -> str | None:
+    if CATALOG_SNAPSHOT_PATH:
+        return None if CATALOG_SNAPSHOT_PATH == "-" else CATALOG_SNAPSHOT_PATH
+    database = engine.url.database
+    if engine.url.get_backend_name() != "sqlite" or not database or database == ":memory:":
+        return None
+    return database + ".catalog.json"
+
+
+def read_snapshot_file(path: str, version: int) -> List[Dict[str, Any]] | None:
+    """Маршруты из файла снимка, если он собран для этой версии каталога и схемы, иначе None."""
+    try:
+        with open(path, "rb") as f:
+            payload = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if payload.get("catalog_version") != version or payload.get("schema_version") != SCHEMA_VERSION:
+        return None
+    return payload["routes"]
+
+
+def write_snapshot_file(path: str, version: int, routes: List[Dict[str, Any]]) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"catalog_version": version, "schema_version": SCHEMA_VERSION, "routes": routes},
+                      f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError:
+        logger.exception("Failed to write catalog snapshot %s", path)
+
+
+async def _load(session) -> CatalogSnapshot:
+    version = int((await read_meta(session)).get("catalog_version", 0))
+    path = snapshot_path()
+    routes = read_snapshot_file(path, version) if path else None
+    if routes is not None:
+        logger.info("Catalog snapshot v%s loaded from %s: %s routes", version, path, len(routes))
+        return CatalogSnapshot(routes, version)
+    routes = await fetch_routes_with_meta(session)
+    logger.info("Catalog snapshot v%s loaded from DB: %s routes", version, len(routes))
+    if path:
+        await asyncio.to_thread(write_snapshot_file, path, version, routes)
+    return CatalogSnapshot(routes, version)
+
+
+_snapshot: CatalogSnapshot | None = None
+_lock = asyncio.Lock()
+_preload_task: asyncio.Task | None = None
+_watch_task: asyncio.Task | None = None
+# вызываются с новым снимком в момент подмены — для кэшей, построенных по снимку (индекс inline-поиска)
+_swap_listeners: List[Callable[[CatalogSnapshot], None]] = []
+
+
+async def get_snapshot(session=None) -> CatalogSnapshot:
+    """Снимок каталога процесса; при первом обращении загружается из файла снимка или из БД
+    (в переданной сессии, если есть)."""
+    global _snapshot
+    if _snapshot is not None:
+        return _snapshot
+    async with _lock:
+        if _snapshot is None:
+            if session is not None:
+                _snapshot = await _load(session)
+            else:
+                async with AsyncSessionLocal() as own_session:
+                    _snapshot = await _load(own_session)
+    return _snapshot
+
+
+def preload() -> None:
+    """Загружает снимок в фоне после старта, чтобы первый «Найти маршруты» не ждал каталог."""
+    global _preload_task
+    if _snapshot is None and _preload_task is None:
+        _preload_task = asyncio.create_task(get_snapshot())
+        _preload_task.add_done_callback(_preload_done)
+
+
+def _preload_done(task: asyncio.Task) -> None:
+    global _preload_task
+    _preload_task = None
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Catalog preload failed", exc_info=task.exception())
+
+
+def invalidate() -> None:
+    global _snapshot
+    _snapshot = None
+
+
+def on_swap(listener: Callable[[CatalogSnapshot], None]) -> None:
+    _swap_listeners.append(listener)
+
+
+def _swap(snapshot: CatalogSnapshot) -> None:
+    """Подменяет снимок и зависящие от него кэши за один шаг цикла событий: между ними нет await,
+    поэтому обработчик видит либо всё старое, либо всё новое."""
+    global _snapshot
+    _snapshot = snapshot
+    for listener in _swap_listeners:
+        listener(snapshot)
+
+
+async def reload_if_changed() -> bool:
+    """Загружает новую версию каталога, если она сменилась в app_meta, и подменяет снимок.
+
+    Пока новая версия загружается, обработчики получают старый снимок и не ждут.
+    """
+    async with AsyncSessionLocal() as session:
+        version = int((await read_meta(session)).get("catalog_version", 0))
+        if _snapshot is None or _snapshot.version == version:
+            return False
+        async with _lock:
+            old = _snapshot.version
+            fresh = await _load(session)
+    _swap(fresh)
+    logger.info("Catalog swapped: v%s -> v%s, %s routes", old, fresh.version, len(fresh))
+    return True
+
+
+async def _watch(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reload_if_changed()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Catalog reload failed")
+
+
+def start(interval: float = CATALOG_POLL_INTERVAL) -> None:
+    """Следит за версией каталога в фоне: её меняет ``python catalog_sync.py apply``."""
+    global _watch_task
+    if _watch_task is None and interval > 0:
+        _watch_task = asyncio.create_task(_watch(interval), name="catalog-watch")
+
+
+async def stop() -> None:
+    global _watch_task
+    if _watch_task is not None:
+        _watch_task.cancel()
+        try:
+            await _watch_task
+        except asyncio.CancelledError:
+            pass
+        _watch_task = None
+
+
+metrics.registry.callback("bot_catalog_routes", "Маршрутов в снимке каталога (0 — снимок не загружен)",
+                          lambda: len(_snapshot) if _snapshot is not None else 0)
+metrics.registry.callback("bot_catalog_version", "Версия каталога в памяти процесса (0 — снимок не загружен)",
+                          lambda: _snapshot.version if _snapshot is not None else 0)
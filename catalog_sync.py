@@ -0,0 +1,236 @@
+"""Правка каталога маршрутов без перезапуска бота.
+
+    python catalog_sync.py dump [catalog.json]      # текущий каталог из БД в файл (или в stdout)
+    python catalog_sync.py diff [catalog.json]      # что изменится
+    python catalog_sync.py apply [catalog.json] [--prune]
+
+Без файла берётся встроенный каталог db.SAMPLE_ROUTES. Маршрут из файла сопоставляется с маршрутом в БД
+по "id", а без него или с неизвестным id — по названию. Применение идёт одной транзакцией и меняет
+catalog_version в app_meta.
+Работающие процессы замечают новую версию в течение CATALOG_POLL_INTERVAL и подменяют снимок каталога.
+Маршруты, которых нет в файле, удаляются только с --prune, вместе с их избранным и прохождениями.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import delete, update
+
+import similarity
+from catalog import snapshot_path, write_snapshot_file
+from db import SAMPLE_ROUTES, AsyncSessionLocal, init_db_and_seed, read_meta, seed_routes, set_meta
+from loaders import load_routes_with_meta
+from models import CompletedRoute, Favorite, Route, route_seasons, route_tags, route_transports
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("title", "description", "length_km", "difficulty", "price_estimate", "link", "popularity")
+NUMBER_FIELDS = ("length_km", "price_estimate", "popularity")
+ASSOCIATIONS = {
+    "tags": (route_tags, route_tags.c.tag),
+    "seasons": (route_seasons, route_seasons.c.season),
+    "transports": (route_transports, route_transports.c.transport),
+}
+
+
+def validate(routes: Any) -> List[Dict[str, Any]]:
+    """Проверяет каталог из файла; ValueError с номером маршрута при ошибке."""
+    if not isinstance(routes, list):
+        raise ValueError("catalog must be a JSON list of routes")
+    ids, titles = set(), set()
+    for n, route in enumerate(routes, start=1):
+        if not isinstance(route, dict) or not isinstance(route.get("title"), str) or not route["title"].strip():
+            raise ValueError(f"route #{n}: title is required")
+        if route["title"] in titles:
+            raise ValueError(f"route #{n}: duplicate title {route['title']!r}")
+        titles.add(route["title"])
+        if "id" in route:
+            if not isinstance(route["id"], int) or route["id"] in ids:
+                raise ValueError(f"route #{n}: bad or duplicate id {route['id']!r}")
+            ids.add(route["id"])
+        for key in NUMBER_FIELDS:
+            if route.get(key) is not None and not isinstance(route[key], (int, float)):
+                raise ValueError(f"route #{n}: {key} must be a number")
+        for key in ASSOCIATIONS:
+            values = route.get(key, [])
+            if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+                raise ValueError(f"route #{n}: {key} must be a list of strings")
+    return routes
+
+
+def load_file(path: str | None) -> List[Dict[str, Any]]:
+    if path is None:
+        return SAMPLE_ROUTES
+    with open(path, encoding="utf-8") as f:
+        return validate(json.load(f))
+
+
+def _normalized(route: Dict[str, Any]) -> Dict[str, Any]:
+    """Маршрут в виде для сравнения: поля таблицы routes и множества связей."""
+    result = {key: route.get(key) for key in FIELDS}
+    result["popularity"] = result["popularity"] or 0
+    for key in ("length_km", "price_estimate"):
+        if result[key] is not None:
+            result[key] = float(result[key])
+    for key in ASSOCIATIONS:
+        result[key] = set(route.get(key) or ())
+    return result
+
+
+class CatalogDiff:
+    """Разница между каталогом в БД и желаемым: добавленные, изменённые и удалённые маршруты."""
+
+    def __init__(self):
+        self.added: List[Dict[str, Any]] = []
+        # (id, поля таблицы routes, которые поменялись, связи, которые поменялись, маршрут в новом виде)
+        self.changed: List[Tuple[int, Dict[str, Any], List[str], Dict[str, Any]]] = []
+        self.removed: List[Dict[str, Any]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def describe(self, prune: bool) -> str:
+        lines = [f"+ {r['id']}: {r['title']}" for r in self.added]
+        for route_id, fields, associations, route in self.changed:
+            lines.append(f"~ {route_id}: {route['title']} ({', '.join(list(fields) + associations)})")
+        for r in self.removed:
+            lines.append(f"- {r['id']}: {r['title']}" + ("" if prune else " (kept, use --prune to remove)"))
+        lines.append(f"{len(self.added)} added, {len(self.changed)} changed, {len(self.removed)} "
+                     f"{'removed' if prune else 'missing from file'}")
+        return "\n".join(lines)
+
+
+def diff_catalog(current: Dict[int, Dict[str, Any]], wanted: List[Dict[str, Any]]) -> CatalogDiff:
+    """Сравнивает маршруты из БД (id -> маршрут) с каталогом из файла; новым маршрутам назначает id.
+
+    ValueError, если два маршрута файла сопоставились с одним маршрутом БД (по id и по названию).
+    """
+    result = CatalogDiff()
+    by_title = {r["title"]: route_id for route_id, r in current.items()}
+    next_id = max([*current, *(r["id"] for r in wanted if "id" in r), 0]) + 1
+    matched = set()
+    for route in wanted:
+        route_id = route.get("id")
+        if route_id not in current:
+            # неизвестный id (например, файл выгружен из другой БД): тот же маршрут узнаётся по названию,
+            # иначе он добавился бы вторым с тем же названием
+            route_id = by_title.get(route["title"], route_id)
+        if route_id is None or route_id not in current:
+            if route_id is None:
+                route_id, next_id = next_id, next_id + 1
+            result.added.append({**route, "id": route_id})
+            continue
+        if route_id in matched:
+            raise ValueError(f"route {route['title']!r} matches route {route_id} a second time")
+        matched.add(route_id)
+        old, new = _normalized(current[route_id]), _normalized(route)
+        fields = {key: new[key] for key in FIELDS if old[key] != new[key]}
+        associations = [key for key in ASSOCIATIONS if old[key] != new[key]]
+        if fields or associations:
+            result.changed.append((route_id, fields, associations, {**route, "id": route_id}))
+    result.removed = [r for route_id, r in current.items() if route_id not in matched]
+    return result
+
+
+def _as_snapshot_route(route: Dict[str, Any]) -> Dict[str, Any]:
+    """Маршрут из файла в виде словаря снимка каталога (как из load_routes_with_meta)."""
+    result = {key: route.get(key) for key in ("id",) + FIELDS}
+    result["popularity"] = result["popularity"] or 0
+    result.update({key: list(route.get(key) or ()) for key in ASSOCIATIONS})
+    return result
+
+
+async def apply_catalog(wanted: List[Dict[str, Any]], prune: bool = False,
+                        dry_run: bool = False) -> Tuple[CatalogDiff, int | None]:
+    """Приводит каталог в БД к ``wanted`` одной транзакцией; возвращает разницу и новую версию каталога
+    (None, если менять нечего или dry_run)."""
+    async with AsyncSessionLocal() as session:
+        current = await load_routes_with_meta(session)
+        diff = diff_catalog(current, wanted)
+        removed = diff.removed if prune else []
+        if dry_run or not (diff.added or diff.changed or removed):
+            return diff, None
+
+        for route_id, fields, associations, route in diff.changed:
+            if fields:
+                await session.execute(update(Route).where(Route.id == route_id).values(**fields))
+            for key in associations:
+                table, column = ASSOCIATIONS[key]
+                await session.execute(delete(table).where(table.c.route_id == route_id))
+                if route.get(key):
+                    await session.execute(table.insert(), [{"route_id": route_id, column.name: v}
+                                                           for v in route[key]])
+        if diff.added:
+            await seed_routes(session, diff.added)
+
+        meta = await read_meta(session)
+        version = max(int(meta.get("catalog_version", 0)) + 1, int(time.time()))
+        # соседи по похожести: новые маршруты уже в routes, удаляемые ещё не удалены (на них ссылаются строки)
+        changes: Dict[int, Dict[str, Any] | None] = {r["id"]: _as_snapshot_route(r) for r in diff.added}
+        changes.update({route_id: _as_snapshot_route(route) for route_id, _, _, route in diff.changed})
+        changes.update({r["id"]: None for r in removed})
+        await similarity.update_routes(session, changes, version, base=list(current.values()))
+
+        if removed:
+            ids = [r["id"] for r in removed]
+            for model in (Favorite, CompletedRoute):
+                await session.execute(delete(model).where(model.route_id.in_(ids)))
+            for table, _ in ASSOCIATIONS.values():
+                await session.execute(delete(table).where(table.c.route_id.in_(ids)))
+            await session.execute(delete(Route).where(Route.id.in_(ids)))
+
+        await set_meta(session, catalog_version=version)
+        # файл снимка пишется до коммита: процессы, увидевшие новую версию, читают его, а не БД
+        path = snapshot_path()
+        if path:
+            routes = list((await load_routes_with_meta(session)).values())
+            await asyncio.to_thread(write_snapshot_file, path, version, routes)
+        await session.commit()
+    logger.info("Catalog v%s applied: %s added, %s changed, %s removed",
+                version, len(diff.added), len(diff.changed), len(removed))
+    return diff, version
+
+
+async def dump_catalog() -> List[Dict[str, Any]]:
+    async with AsyncSessionLocal() as session:
+        routes = await load_routes_with_meta(session)
+    return [{key: r[key] for key in ("id",) + FIELDS + tuple(ASSOCIATIONS)} for r in routes.values()]
+
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Синхронизация каталога маршрутов с файлом")
+    parser.add_argument("command", choices=("dump", "diff", "apply"))
+    parser.add_argument("file", nargs="?", help="JSON-файл каталога (по умолчанию db.SAMPLE_ROUTES)")
+    parser.add_argument("--prune", action="store_true", help="удалить маршруты, которых нет в файле")
+    args = parser.parse_args(argv)
+
+    await init_db_and_seed()
+    if args.command == "dump":
+        text = json.dumps(await dump_catalog(), ensure_ascii=False, indent=2)
+        if args.file:
+            with open(args.file, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+        return 0
+    try:
+        wanted = load_file(args.file)
+        diff, version = await apply_catalog(wanted, prune=args.prune, dry_run=args.command == "diff")
+    except (OSError, ValueError) as e:
+        print(f"{args.file or 'SAMPLE_ROUTES'}: {e}", file=sys.stderr)
+        return 1
+    print(diff.describe(args.prune))
+    if version is not None:
+        print(f"catalog version {version}")
+    elif args.command == "apply":
+        print("nothing to apply")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,221 @@
+import os
+import sys
+import math
+import asyncio
+import logging
+from functools import partial
+from itertools import groupby
+from typing import Callable, Dict, Iterable, Set
+
+from sqlalchemy import select, union
+
+import metrics
+from db import AsyncSessionLocal
+from models import CompletedRoute, Favorite
+
+logger = logging.getLogger(__name__)
+
+# вес коллаборативной составляющей в оценке маршрута (0 — не учитывать)
+COLLAB_WEIGHT = float(os.getenv("COLLAB_WEIGHT", "3"))
+# полная пересборка по БД раз в столько секунд (0 — только при старте); между пересборками индекс
+# меняется на месте по нажатиям ❤️/🏁 в этом процессе
+COLLAB_REBUILD_INTERVAL = float(os.getenv("COLLAB_REBUILD_INTERVAL", "21600"))
+BUILD_PARTITION = 5000
+
+
+class CoOccurrenceIndex:
+    """Разреженная матрица совместных взаимодействий маршрутов.
+
+    Взаимодействие — маршрут в избранном или в пройденных (считается один раз). ``pairs[i][j]`` —
+    сколько пользователей взаимодействовали и с i, и с j; ``counts[i]`` — сколько взаимодействовали с i.
+    Похожесть — косинус: pairs[i][j] / sqrt(counts[i] * counts[j]). Размер зависит только от числа
+    маршрутов и пар, а не от числа пользователей.
+    """
+
+    def __init__(self):
+        self.pairs: Dict[int, Dict[int, int]] = {}
+        self.counts: Dict[int, int] = {}
+        self.ready = False
+
+    def add_user(self, routes: Iterable[int]) -> None:
+        routes = list(routes)
+        for i in routes:
+            self.counts[i] = self.counts.get(i, 0) + 1
+            row = self.pairs.setdefault(i, {})
+            for j in routes:
+                if j != i:
+                    row[j] = row.get(j, 0) + 1
+
+    def update(self, others: Iterable[int], route_id: int, added: bool) -> None:
+        """Пользователь начал (added) или перестал взаимодействовать с route_id; others — его остальные маршруты."""
+        delta = 1 if added else -1
+        self.counts[route_id] = self.counts.get(route_id, 0) + delta
+        if self.counts[route_id] <= 0:
+            self.counts.pop(route_id)
+        for j in others:
+            if j != route_id:
+                self._bump(route_id, j, delta)
+                self._bump(j, route_id, delta)
+
+    def _bump(self, a: int, b: int, delta: int) -> None:
+        row = self.pairs.setdefault(a, {})
+        value = row.get(b, 0) + delta
+        if value > 0:
+            row[b] = value
+        else:
+            row.pop(b, None)
+
+    def scores(self, interacted: Set[int]) -> Dict[int, float]:
+        """Средняя похожесть каждого маршрута на маршруты пользователя, 0..1; только ненулевые."""
+        if not interacted or not self.ready:
+            return {}
+        acc: Dict[int, float] = {}
+        counts = self.counts
+        for j in interacted:
+            row = self.pairs.get(j)
+            nj = counts.get(j)
+            if not row or not nj:
+                continue
+            for i, together in row.items():
+                ni = counts.get(i)
+                if ni:
+                    acc[i] = acc.get(i, 0.0) + together / math.sqrt(ni * nj)
+        n = len(interacted)
+        return {i: value / n for i, value in acc.items()}
+
+    def __len__(self) -> int:
+        return sum(len(row) for row in self.pairs.values())
+
+
+index = CoOccurrenceIndex()
+
+
+def on_toggle(favorites: Set[int], completed: Set[int], route_id: int, kind_ids: Set[int],
+              value: bool) -> Callable[[], None] | None:
+    """Вызывается до изменения множества ``kind_ids`` (избранное или пройденные) пользователя.
+
+    Индекс меняется, только если маршрут появляется в объединении избранного и пройденных или
+    пропадает из него. Возвращает обратное изменение (для отката записи) или None, если индекс не менялся.
+    """
+    other_ids = completed if kind_ids is favorites else favorites
+    if route_id in other_ids or (route_id in kind_ids) == value:
+        return None
+    others = (favorites | completed) - {route_id}
+    index.update(others, route_id, value)
+    return partial(index.update, others, route_id, not value)
+
+
+async def build() -> CoOccurrenceIndex:
+    """Строит индекс по БД потоком пар (пользователь, маршрут), не загружая их все в память."""
+    fresh = CoOccurrenceIndex()
+    stmt = union(
+        select(Favorite.user_id, Favorite.route_id),
+        select(CompletedRoute.user_id, CompletedRoute.route_id),
+    ).order_by("user_id")
+    users = 0
+    current_user, current_routes = None, []
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(stmt)
+        async for partition in result.partitions(BUILD_PARTITION):
+            for user_id, rows in groupby(partition, key=lambda row: row[0]):
+                if user_id != current_user:
+                    if current_routes:
+                        fresh.add_user(current_routes)
+                        users += 1
+                    current_user, current_routes = user_id, []
+                current_routes.extend(row[1] for row in rows)
+            # пачка обработана — отдаём цикл событий обработчикам
+            await asyncio.sleep(0)
+    if current_routes:
+        fresh.add_user(current_routes)
+        users += 1
+    fresh.ready = True
+    logger.info("Collaborative index built: %s users, %s routes, %s pairs", users, len(fresh.counts), len(fresh))
+    return fresh
+
+
+async def _maintain(interval: float) -> None:
+    global index
+    while True:
+        try:
+            index = await build()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to build collaborative index")
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+
+
+_task: asyncio.Task | None = None
+
+
+def start(interval: float = COLLAB_REBUILD_INTERVAL) -> None:
+    """Строит индекс в фоне после старта; до готовности коллаборативная составляющая равна нулю."""
+    global _task
+    if _task is None and COLLAB_WEIGHT:
+        _task = asyncio.create_task(_maintain(interval), name="collab-index")
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+metrics.registry.callback("bot_collab_pairs", "Ненулевых пар маршрутов в коллаборативном индексе",
+                          lambda: len(index))
+
+
+def _bench(users: int = 100_000, routes: int = 1000) -> None:
+    """Синтетика: популярность маршрутов по Ципфу, у пользователя 3–10 взаимодействий."""
+    import random
+    import time
+    import tracemalloc
+    from itertools import accumulate
+
+    rng = random.Random(1)
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(routes)))
+
+    def profile():
+        return set(rng.choices(range(routes), cum_weights=cum_weights, k=rng.randint(3, 10)))
+
+    interactions = [profile() for _ in range(users)]
+    bench = CoOccurrenceIndex()
+    started = time.perf_counter()
+    for routes_of_user in interactions:
+        bench.add_user(routes_of_user)
+    bench.ready = True
+    built = time.perf_counter() - started
+    del interactions
+    tracemalloc.start()
+    measured = CoOccurrenceIndex()
+    for _ in range(users):
+        measured.add_user(profile())
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del measured
+    print(f"build: {users} users x {routes} routes in {built:.2f}s, {len(bench)} pairs, {size / 1e6:.1f} MB")
+
+    profiles = [profile() for _ in range(1000)]
+    started = time.perf_counter()
+    for user_routes in profiles:
+        bench.scores(user_routes)
+    print(f"scores: {(time.perf_counter() - started) / len(profiles) * 1000:.3f} ms per user")
+    started = time.perf_counter()
+    for user_routes in profiles:
+        route = rng.randrange(routes)
+        bench.update(user_routes, route, True)
+        bench.update(user_routes, route, False)
+    print(f"update: {(time.perf_counter() - started) / len(profiles) / 2 * 1e6:.1f} us per toggle")
+
+
+if __name__ == "__main__":
+    # python collab.py [пользователей] [маршрутов] — замер построения, памяти и времени ответа
+    _bench(*(int(arg) for arg in sys.argv[1:3]))
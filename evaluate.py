@@ -0,0 +1,345 @@
+"""Офлайн-оценка качества подбора маршрутов.
+
+    python evaluate.py [--variant tags3='{"tag": 3}'] [--experiment exp.json] [--scorer my=module:func]
+                       [-k 10] [--season summer] [--workers 4] [-o report.json]
+    python evaluate.py --synthetic 1000000       # замер скорости на сгенерированных профилях
+
+Сохранённые предпочтения пользователей прогоняются через ту же выдачу, что у recommend_routes (score_routes и
+select_top): с коэффициентами по умолчанию и с каждым вариантом. Вариант — набор коэффициентов ScoringWeights
+(как в experiments.py) или своя функция оценки score(route, prefs, season). Релевантными считаются маршруты из
+избранного и пройденных пользователя. Профили без отметок идут только в покрытие и разнообразие. Пройденные из
+выдачи не исключаются, иначе их нельзя угадать. Коллаборативная составляющая не учитывается: её индекс построен
+по тем же отметкам, которые угадываются.
+
+Это базовая оценка без разбиения по времени, и она завышена: отметки сравниваются с текущими предпочтениями,
+а пользователь мог настроить их уже после отметок (в том числе под них). Разбить честно нельзя — у избранного
+нет времени, а у предпочтений нет времени изменения (есть только CompletedRoute.completed_at). Поэтому
+абсолютные значения не показывают качество подбора; сравнивать имеет смысл только варианты между собой на
+одних и тех же данных. В отчёте это отмечено полем "ground_truth": "unsplit".
+
+Метрики, средние по профилям с отметками:
+- precision@k — доля релевантных среди первых k;
+- recall@k — угаданные из релевантных (но не больше k);
+- ndcg@k — бинарный NDCG;
+- hit_rate@k — доля профилей хотя бы с одним угаданным;
+а по всем профилям:
+- coverage — доля маршрутов каталога, попавших хотя бы в одну выдачу;
+- diversity — 1 − средняя попарная похожесть маршрутов выдачи (similarity.similarity).
+
+Профили читаются пачками по EVAL_BATCH и считаются в пуле процессов. Отчёт детерминирован: результаты пачек
+складываются в порядке чтения, суммы — через math.fsum, сезон записывается в отчёт. От числа процессов он не
+зависит.
+"""
+import os
+import sys
+import json
+import math
+import random
+import asyncio
+import argparse
+import importlib
+import logging
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from time import perf_counter
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import select, union
+
+from catalog import get_snapshot
+from db import AsyncSessionLocal, init_db_and_seed
+from experiments import make_weights, parse
+from models import CompletedRoute, Favorite, User
+from recommender import DEFAULT_WEIGHTS, ScoringWeights, current_season, score_routes, scorer_for, select_top
+from similarity import route_features, similarity
+
+logger = logging.getLogger(__name__)
+
+EVAL_BATCH = int(os.getenv("EVAL_BATCH", "2000"))
+SEASONS = ("winter", "spring", "summer", "autumn")
+RANK_METRICS = ("precision", "recall", "ndcg", "hit_rate")
+
+# (название, коэффициенты, "модуль:функция" своей оценки или None)
+VariantSpec = Tuple[str, ScoringWeights, str | None]
+# (предпочтения в JSON, id избранных и пройденных маршрутов)
+Profile = Tuple[str, Iterable[int]]
+
+# состояние процесса пула, задаётся в _init_worker
+_routes: List[Dict[str, Any]] = []
+_features: Dict[int, Tuple] = {}
+_rankers: List[Tuple[str, Callable, float]] = []
+_k = 10
+_season = ""
+_discounts: List[float] = []
+# похожесть пар маршрутов каталога не зависит от профиля — считается один раз на процесс
+_pairs: Dict[Tuple[int, int], float] = {}
+
+
+def load_scorer(path: str) -> Callable[[Dict[str, Any], Dict[str, Any], str], float]:
+    module, _, name = path.partition(":")
+    if not name:
+        raise ValueError(f"scorer must be module:function, got {path!r}")
+    return getattr(importlib.import_module(module), name)
+
+
+def _init_worker(routes: List[Dict[str, Any]], variants: List[VariantSpec], k: int, season: str) -> None:
+    global _routes, _features, _rankers, _k, _season, _discounts, _pairs
+    _routes, _k, _season, _pairs = routes, k, season, {}
+    _features = {r["id"]: route_features(r) for r in routes}
+    _rankers = [(name, load_scorer(path) if path else scorer_for(weights), weights.rerank_lambda)
+                for name, weights, path in variants]
+    _discounts = [1 / math.log2(rank + 2) for rank in range(k)]
+
+
+def _similar(a: Dict[str, Any], b: Dict[str, Any]) -> float:
+    key = (a["id"], b["id"]) if a["id"] < b["id"] else (b["id"], a["id"])
+    value = _pairs.get(key)
+    if value is None:
+        value = _pairs[key] = similarity(_features[key[0]], _features[key[1]])
+    return value
+
+
+def _evaluate(profiles: List[Tuple[Dict[str, Any], Set[int]]]) -> Dict[str, Dict[str, Any]]:
+    """Суммы метрик пачки по вариантам."""
+    result = {}
+    for name, score, lambda_ in _rankers:
+        sums: Dict[str, List[float]] = {metric: [] for metric in RANK_METRICS}
+        diversity: List[float] = []
+        shown: Set[int] = set()
+        for prefs, relevant in profiles:
+            top = [r for _, r in select_top(score_routes(_routes, prefs, _season, score), _k, lambda_, _similar)]
+            if len(top) > 1:
+                pairs = [_similar(a, b) for a, b in combinations(top, 2)]
+                diversity.append(1 - math.fsum(pairs) / len(pairs))
+            top = [r["id"] for r in top]
+            shown.update(top)
+            if not relevant:
+                continue
+            hits = [rank for rank, route_id in enumerate(top) if route_id in relevant]
+            ideal = min(len(relevant), _k)
+            sums["precision"].append(len(hits) / _k)
+            sums["recall"].append(len(hits) / ideal)
+            sums["ndcg"].append(math.fsum(_discounts[rank] for rank in hits) / math.fsum(_discounts[:ideal]))
+            sums["hit_rate"].append(1.0 if hits else 0.0)
+        result[name] = {
+            "profiles": len(profiles),
+            "judged": len(sums["precision"]),
+            "sums": {metric: math.fsum(values) for metric, values in sums.items()},
+            "diversity": math.fsum(diversity),
+            "diverse": len(diversity),
+            "shown": shown,
+        }
+    return result
+
+
+def evaluate_rows(rows: List[Profile]) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """Пачка профилей из БД; возвращает суммы и число пропущенных (предпочтения не заполнены или битые)."""
+    profiles = []
+    for text, relevant in rows:
+        try:
+            prefs = json.loads(text)
+        except ValueError:
+            prefs = None
+        if isinstance(prefs, dict) and prefs:
+            profiles.append((prefs, set(relevant)))
+    return _evaluate(profiles), len(rows) - len(profiles)
+
+
+def evaluate_synthetic(seed: int, number: int, size: int) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """Пачка сгенерированных профилей; генератор зависит только от seed и номера пачки."""
+    rng = random.Random(f"{seed}:{number}")
+    tags = sorted({tag for r in _routes for tag in r.get("tags") or ()})
+    transports = sorted({t for r in _routes for t in r.get("transports") or ()})
+    difficulties = sorted({r["difficulty"] for r in _routes if r.get("difficulty")})
+    profiles = []
+    for _ in range(size):
+        prefs = {"season": rng.choice(SEASONS), "length_km": round(rng.uniform(1, 150)),
+                 "price_estimate": rng.choice((0, 500, 2000, 5000, 15000)), "popularity": rng.randint(0, 100),
+                 "difficulty": rng.choice(difficulties) if difficulties else None,
+                 "transport": rng.choice(transports) if transports else None,
+                 "tags": rng.sample(tags, min(len(tags), rng.randint(1, 3)))}
+        liked = [r["id"] for r in _routes if set(prefs["tags"]) & set(r.get("tags") or ())]
+        profiles.append((prefs, set(rng.sample(liked, min(len(liked), rng.randint(0, 3))))))
+    return _evaluate(profiles), 0
+
+
+async def db_batches(batch: int = EVAL_BATCH) -> AsyncIterator[Tuple[Callable, tuple]]:
+    """Пачки профилей по возрастанию id пользователя, каждая — своя короткая транзакция."""
+    last = 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            users = (await session.execute(
+                select(User.id, User.preferences)
+                .where(User.id > last, User.preferences.is_not(None))
+                .order_by(User.id).limit(batch)
+            )).all()
+            if not users:
+                return
+            first, last = users[0][0], users[-1][0]
+            interactions = union(
+                select(Favorite.user_id, Favorite.route_id).where(Favorite.user_id.between(first, last)),
+                select(CompletedRoute.user_id, CompletedRoute.route_id)
+                .where(CompletedRoute.user_id.between(first, last)),
+            )
+            relevant: Dict[int, List[int]] = {}
+            for user_id, route_id in (await session.execute(interactions)).all():
+                relevant.setdefault(user_id, []).append(route_id)
+        yield evaluate_rows, ([(prefs, relevant.get(user_id, ())) for user_id, prefs in users],)
+        if len(users) < batch:
+            return
+
+
+async def synthetic_batches(count: int, seed: int = 1,
+                            batch: int = EVAL_BATCH) -> AsyncIterator[Tuple[Callable, tuple]]:
+    for number, start in enumerate(range(0, count, batch)):
+        yield evaluate_synthetic, (seed, number, min(batch, count - start))
+
+
+class _Totals:
+    def __init__(self):
+        self.profiles = self.judged = self.diverse = 0
+        self.sums: Dict[str, List[float]] = {metric: [] for metric in RANK_METRICS}
+        self.diversity: List[float] = []
+        self.shown: Set[int] = set()
+
+    def add(self, part: Dict[str, Any]) -> None:
+        self.profiles += part["profiles"]
+        self.judged += part["judged"]
+        self.diverse += part["diverse"]
+        for metric, value in part["sums"].items():
+            self.sums[metric].append(value)
+        self.diversity.append(part["diversity"])
+        self.shown |= part["shown"]
+
+    def report(self, k: int, routes: int) -> Dict[str, float]:
+        result = {f"{metric}@{k}": round(math.fsum(values) / self.judged, 6) if self.judged else None
+                  for metric, values in self.sums.items()}
+        result["coverage"] = round(len(self.shown) / routes, 6) if routes else None
+        result["diversity"] = round(math.fsum(self.diversity) / self.diverse, 6) if self.diverse else None
+        return result
+
+
+async def run(batches: AsyncIterator[Tuple[Callable, tuple]], variants: List[VariantSpec], k: int = 10,
+              season: str | None = None, workers: int | None = None) -> Dict[str, Any]:
+    """Прогоняет пачки в пуле процессов; не больше двух пачек на процесс в очереди."""
+    snapshot = await get_snapshot()
+    season = season or current_season()
+    workers = workers or os.cpu_count() or 1
+    totals = {name: _Totals() for name, _, _ in variants}
+    skipped = 0
+    loop = asyncio.get_running_loop()
+    pending: deque = deque()
+
+    def merge(result: Tuple[Dict[str, Dict[str, Any]], int]) -> None:
+        nonlocal skipped
+        parts, invalid = result
+        skipped += invalid
+        for name, part in parts.items():
+            totals[name].add(part)
+
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn"), initializer=_init_worker,
+                             initargs=(snapshot.routes, variants, k, season)) as pool:
+        async for func, args in batches:
+            pending.append(loop.run_in_executor(pool, func, *args))
+            if len(pending) >= workers * 2:
+                merge(await pending.popleft())
+        while pending:
+            merge(await pending.popleft())
+
+    first = totals[variants[0][0]]
+    return {
+        "catalog_version": snapshot.version,
+        "routes": len(snapshot.routes),
+        "season": season,
+        "k": k,
+        "profiles": first.profiles,
+        "judged": first.judged,
+        "skipped": skipped,
+        "variants": {name: total.report(k, len(snapshot.routes)) for name, total in totals.items()},
+    }
+
+
+def format_table(report: Dict[str, Any]) -> str:
+    """Метрики вариантов таблицей; в скобках — разница с первым (по умолчанию)."""
+    variants = report["variants"]
+    base = next(iter(variants.values()))
+    columns = list(base)
+    lines = ["variant".ljust(16) + "".join(column.rjust(22) for column in columns)]
+    for name, values in variants.items():
+        cells = []
+        for column in columns:
+            value = values[column]
+            if value is None:
+                cells.append("-".rjust(22))
+            elif values is base or base[column] is None:
+                cells.append(f"{value:.4f}".rjust(22))
+            else:
+                cells.append(f"{value:.4f} ({value - base[column]:+.4f})".rjust(22))
+        lines.append(name[:16].ljust(16) + "".join(cells))
+    return "\n".join(lines)
+
+
+def parse_variants(args) -> List[VariantSpec]:
+    variants: List[VariantSpec] = [("default", DEFAULT_WEIGHTS, None)]
+    if args.experiment:
+        with open(args.experiment, encoding="utf-8") as f:
+            experiment = parse(json.load(f))
+        if experiment is not None:
+            variants += [(f"{experiment.name}/{a.variant}", a.weights, None) for a in experiment.variants]
+    for spec in args.variant:
+        name, _, overrides = spec.partition("=")
+        variants.append((name, make_weights(json.loads(overrides)), None))
+    for spec in args.scorer:
+        name, _, path = spec.partition("=")
+        load_scorer(path)
+        variants.append((name, DEFAULT_WEIGHTS, path))
+    names = [name for name, _, _ in variants]
+    if len(set(names)) != len(names):
+        raise ValueError(f"duplicate variant names: {names}")
+    return variants
+
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Офлайн-оценка подбора маршрутов по сохранённым профилям")
+    parser.add_argument("--variant", action="append", default=[], metavar="NAME=JSON",
+                        help="коэффициенты ScoringWeights, отличные от умолчаний")
+    parser.add_argument("--experiment", help="файл эксперимента (формат EXPERIMENTS_FILE): все его варианты")
+    parser.add_argument("--scorer", action="append", default=[], metavar="NAME=MODULE:FUNC",
+                        help="своя функция оценки score(route, prefs, season)")
+    parser.add_argument("-k", type=int, default=10, help="длина выдачи")
+    parser.add_argument("--season", choices=SEASONS, help="сезон (по умолчанию текущий)")
+    parser.add_argument("--workers", type=int, help="процессов (по умолчанию по числу ядер)")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="N сгенерированных профилей вместо БД")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="JSON-отчёт в файл (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+    try:
+        variants = parse_variants(args)
+    except (OSError, ValueError, ImportError, AttributeError) as e:
+        print(f"bad variant: {e}", file=sys.stderr)
+        return 1
+
+    await init_db_and_seed()
+    batches = synthetic_batches(args.synthetic, args.seed) if args.synthetic else db_batches()
+    started = perf_counter()
+    report = await run(batches, variants, k=args.k, season=args.season, workers=args.workers)
+    elapsed = perf_counter() - started
+    # отметки из БД сравниваются с текущими предпочтениями без разбиения по времени (см. описание модуля)
+    report["ground_truth"] = "synthetic" if args.synthetic else "unsplit"
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    print(format_table(report), file=sys.stderr)
+    print(f"{report['profiles']} profiles x {len(variants)} variants in {elapsed:.1f}s "
+          f"({report['profiles'] / elapsed if elapsed else 0:.0f} profiles/s)", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main()))
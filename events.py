@@ -0,0 +1,425 @@
+"""Журнал действий пользователей: показы подборок, ❤️/🏁, шаги настройки предпочтений.
+
+События копятся в памяти и раз в EVENTS_FLUSH_INTERVAL секунд (или по EVENTS_BATCH штук) дописываются
+в файлы JSON Lines отдельно от основной БД. Каждый процесс пишет свой сегмент
+events-<дата>-<время>-<pid>.jsonl.part. При смене суток (UTC) или по EVENTS_SEGMENT_BYTES сегмент
+закрывается (.jsonl), а закрытые сегменты дня сливаются в один сжатый файл events-<дата>.g<N>.jsonl.gz.
+
+    python events.py read [--type impression] [--since 2026-10-01] [--user 42]
+    python events.py stats [--since ...]     # события по типам и показы/❤️/🏁 по маршрутам
+    python events.py compact                 # слить закрытые сегменты (делается и при старте бота)
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import asyncio
+import argparse
+import logging
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List
+
+import metrics
+from db import engine
+
+logger = logging.getLogger(__name__)
+
+# каталог журнала; по умолчанию рядом с файлом SQLite (<база>.events), "-" — не вести журнал
+EVENTS_DIR = os.getenv("EVENTS_DIR", "")
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "2"))
+# сброс раньше интервала, если накопилось столько событий
+EVENTS_BATCH = int(os.getenv("EVENTS_BATCH", "1000"))
+# больше событий в памяти не держим (диск не успевает или недоступен) — новые отбрасываются
+EVENTS_BUFFER_MAX = int(os.getenv("EVENTS_BUFFER_MAX", "100000"))
+EVENTS_SEGMENT_BYTES = int(os.getenv("EVENTS_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# сжатые файлы дней старше стольких дней удаляются при слиянии (0 — хранить всё)
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", "0"))
+
+PREFIX = "events-"
+ACTIVE = ".jsonl.part"
+CLOSED = ".jsonl"
+COMPACTED = ".jsonl.gz"
+JOURNAL = ".compact"
+
+events_total = metrics.registry.counter("bot_events_total", "События журнала действий", ("type",))
+
+
+def events_dir() -> str | None:
+    if EVENTS_DIR:
+        return None if EVENTS_DIR == "-" else EVENTS_DIR
+    database = engine.url.database
+    if engine.url.get_backend_name() != "sqlite" or not database or database == ":memory:":
+        return "events"
+    return database + ".events"
+
+
+def _day(name: str) -> str:
+    return name[len(PREFIX):len(PREFIX) + 8]
+
+
+def _alive(pid: int) -> bool:
+    if sys.platform == "win32":
+        return _alive_windows(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _alive_windows(pid: int) -> bool:
+    """На Windows os.kill(pid, 0) посылает CTRL_C_EVENT, поэтому процесс проверяется через OpenProcess."""
+    import ctypes
+    from ctypes import wintypes
+
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+    if not handle:
+        # ERROR_ACCESS_DENIED — процесс есть, но чужой
+        return ctypes.get_last_error() == 5
+    try:
+        code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+            return True
+        return code.value == 259  # STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+class SegmentWriter:
+    """Дописывает строки в текущий сегмент процесса. Вызывается из потока, поэтому под блокировкой."""
+
+    def __init__(self, directory: str, max_bytes: int = EVENTS_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._day = None
+
+    def write(self, lines: List[str]) -> bool:
+        """Возвращает True, если перед записью был закрыт предыдущий сегмент."""
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            rotated = False
+            if self._file is not None and (now.strftime("%Y%m%d") != self._day or self._file.tell() >= self.max_bytes):
+                self._close()
+                rotated = True
+            if self._file is None:
+                self._path = os.path.join(self.directory, f"{PREFIX}{now:%Y%m%d-%H%M%S-%f}-{os.getpid()}{ACTIVE}")
+                self._file = open(self._path, "a", encoding="utf-8")
+                self._day = now.strftime("%Y%m%d")
+            self._file.writelines(lines)
+            self._file.flush()
+            return rotated
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            os.replace(self._path, self._path[:-len(ACTIVE)] + CLOSED)
+            self._file = None
+
+
+def close_orphans(directory: str) -> None:
+    """Закрывает сегменты, оставшиеся от упавших процессов (и от прошлого запуска с тем же pid)."""
+    for name in os.listdir(directory):
+        if not (name.startswith(PREFIX) and name.endswith(ACTIVE)):
+            continue
+        pid = int(name[:-len(ACTIVE)].rsplit("-", 1)[1])
+        if pid == os.getpid() or not _alive(pid):
+            path = os.path.join(directory, name)
+            os.replace(path, path[:-len(ACTIVE)] + CLOSED)
+
+
+def _finish_journals(directory: str) -> None:
+    """Доводит прерванные слияния: если итоговый файл на месте, удаляет источники, иначе — черновик."""
+    for name in os.listdir(directory):
+        if not name.endswith(JOURNAL):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, encoding="utf-8") as f:
+            plan = json.load(f)
+        target = os.path.join(directory, plan["target"])
+        if os.path.exists(target):
+            for source in plan["sources"]:
+                if os.path.exists(os.path.join(directory, source)):
+                    os.remove(os.path.join(directory, source))
+        elif os.path.exists(target + ".tmp"):
+            os.remove(target + ".tmp")
+        os.remove(path)
+
+
+def _compact_day(directory: str, day: str, segments: List[str], previous: str | None, generation: int) -> None:
+    target = f"{PREFIX}{day}.g{generation}{COMPACTED}"
+    sources = ([previous] if previous else []) + segments
+    journal = os.path.join(directory, f"{PREFIX}{day}{JOURNAL}")
+    with open(journal + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"target": target, "sources": sources}, f)
+    os.replace(journal + ".tmp", journal)
+
+    tmp = os.path.join(directory, target + ".tmp")
+    with open(tmp, "wb") as out:
+        if previous:
+            # gzip допускает склейку потоков: прежний файл дня копируется как есть, без пересжатия
+            with open(os.path.join(directory, previous), "rb") as f:
+                shutil.copyfileobj(f, out)
+        with gzip.GzipFile(fileobj=out, mode="wb") as packed:
+            for segment in segments:
+                with open(os.path.join(directory, segment), "rb") as f:
+                    shutil.copyfileobj(f, packed)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, os.path.join(directory, target))
+    for source in sources:
+        os.remove(os.path.join(directory, source))
+    os.remove(journal)
+
+
+def _try_lock(lock) -> bool:
+    """Неблокирующая блокировка файла слияния: flock на POSIX, msvcrt.locking на Windows."""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        try:
+            msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def compact(directory: str, retention_days: int = EVENTS_RETENTION_DAYS) -> int:
+    """Сливает закрытые сегменты каждого дня с его сжатым файлом; возвращает число слитых сегментов.
+
+    Слияние идёт через журнал <день>.compact, поэтому падение посередине не теряет и не дублирует события.
+    Одновременно сливает только один процесс.
+    """
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        if not _try_lock(lock):
+            return 0
+        _finish_journals(directory)
+        segments: Dict[str, List[str]] = defaultdict(list)
+        packed: Dict[str, List[str]] = defaultdict(list)
+        for name in sorted(os.listdir(directory)):
+            if not name.startswith(PREFIX):
+                continue
+            if name.endswith(CLOSED):
+                segments[_day(name)].append(name)
+            elif name.endswith(COMPACTED):
+                packed[_day(name)].append(name)
+        for day, names in segments.items():
+            generations = sorted(packed[day], key=lambda n: int(n.split(".g")[1].split(".")[0]))
+            previous = generations[-1] if generations else None
+            number = int(previous.split(".g")[1].split(".")[0]) + 1 if previous else 1
+            _compact_day(directory, day, names, previous, number)
+        if retention_days:
+            # каталог читается заново: слияние выше заменило прежние поколения дней новыми
+            oldest = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime("%Y%m%d")
+            for name in os.listdir(directory):
+                if name.startswith(PREFIX) and name.endswith(COMPACTED) and _day(name) < oldest:
+                    os.remove(os.path.join(directory, name))
+    merged = sum(len(names) for names in segments.values())
+    if merged:
+        logger.info("Event log compacted: %s segments merged in %s", merged, directory)
+    return merged
+
+
+class EventLog:
+    """Буфер событий процесса и фоновый сброс его в сегмент.
+
+    ``emit`` не ждёт диска: только добавляет словарь в список. Сериализация и запись идут в потоке.
+    """
+
+    def __init__(self, directory: str | None):
+        self.directory = directory
+        self.dropped = 0
+        self.written = 0
+        self._buffer: List[Dict[str, Any]] = []
+        self._wake = asyncio.Event()
+        self._writer: SegmentWriter | None = None
+        self._task: asyncio.Task | None = None
+
+    def emit(self, type_: str, user_id: int | None, **fields: Any) -> None:
+        if self._writer is None:
+            return
+        if len(self._buffer) >= EVENTS_BUFFER_MAX:
+            self.dropped += 1
+            return
+        self._buffer.append({"ts": round(time.time(), 3), "type": type_, "user_id": user_id, **fields})
+        events_total.labels(type_).inc()
+        if len(self._buffer) >= EVENTS_BATCH:
+            self._wake.set()
+
+    def _write(self, batch: List[Dict[str, Any]]) -> bool:
+        return self._writer.write([json.dumps(event, ensure_ascii=False) + "\n" for event in batch])
+
+    async def flush(self) -> None:
+        if not self._buffer or self._writer is None:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            rotated = await asyncio.to_thread(self._write, batch)
+        except OSError:
+            self.dropped += len(batch)
+            logger.exception("Failed to write %s events to %s", len(batch), self.directory)
+            return
+        self.written += len(batch)
+        if rotated:
+            try:
+                await asyncio.to_thread(compact, self.directory)
+            except Exception:
+                logger.exception("Event log compaction failed")
+
+    async def _run(self, interval: float) -> None:
+        try:
+            await asyncio.to_thread(compact, self.directory)
+        except Exception:
+            logger.exception("Event log compaction failed")
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Event log flush failed")
+
+    def start(self, interval: float = EVENTS_FLUSH_INTERVAL) -> None:
+        if self.directory is None or self._task is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        close_orphans(self.directory)
+        self._writer = SegmentWriter(self.directory)
+        self._task = asyncio.create_task(self._run(interval), name="events-flush")
+
+    async def stop(self) -> None:
+        """Сбрасывает остаток буфера и закрывает сегмент."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        writer, self._writer = self._writer, None
+        await asyncio.to_thread(writer.close)
+
+
+event_log = EventLog(events_dir())
+
+metrics.registry.callback("bot_events_buffered", "События в памяти, ещё не записанные в журнал",
+                          lambda: len(event_log._buffer))
+metrics.registry.callback("bot_events_dropped_total", "События, не попавшие в журнал (переполнение или ошибка записи)",
+                          lambda: event_log.dropped, kind="counter")
+
+
+def _files(directory: str, since: str | None = None, until: str | None = None) -> List[str]:
+    """Файлы журнала по дням: сначала сжатый файл дня, затем его сегменты."""
+    names = []
+    for name in os.listdir(directory):
+        if not name.startswith(PREFIX) or not name.endswith((COMPACTED, CLOSED, ACTIVE)):
+            continue
+        day = _day(name)
+        if (since and day < since) or (until and day > until):
+            continue
+        names.append((day, not name.endswith(COMPACTED), name))
+    return [os.path.join(directory, name) for *_, name in sorted(names)]
+
+
+def read_events(directory: str, types=None, since: datetime | None = None, until: datetime | None = None,
+                user_id: int | None = None) -> Iterator[Dict[str, Any]]:
+    """События из всех файлов журнала, включая пишущиеся сейчас. Строка, оборванная при падении
+    процесса, пропускается."""
+    since_ts = since.timestamp() if since else None
+    until_ts = until.timestamp() if until else None
+    days = [d.astimezone(timezone.utc).strftime("%Y%m%d") if d else None for d in (since, until)]
+    for path in _files(directory, *days):
+        opener = gzip.open if path.endswith(COMPACTED) else open
+        try:
+            f = opener(path, "rt", encoding="utf-8")
+        except FileNotFoundError:
+            # сегмент успели закрыть или слить, пока читали каталог
+            continue
+        with f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if types and event.get("type") not in types:
+                    continue
+                if (since_ts and event["ts"] < since_ts) or (until_ts and event["ts"] >= until_ts):
+                    continue
+                if user_id is not None and event.get("user_id") != user_id:
+                    continue
+                yield event
+
+
+def stats(events: Iterator[Dict[str, Any]]) -> str:
+    by_type: Counter = Counter()
+    shown: Counter = Counter()
+    toggled: Dict[str, Counter] = defaultdict(Counter)
+    for event in events:
+        by_type[event["type"]] += 1
+        if event["type"] == "impression":
+            shown.update(event.get("routes", ()))
+        elif event["type"] == "toggle" and event.get("value") and not event.get("rollback"):
+            toggled[event["kind"]][event["route_id"]] += 1
+    lines = [f"{kind}: {count}" for kind, count in by_type.most_common()]
+    lines.append("")
+    lines.append(f"{'route':>6} {'shown':>8} {'❤️':>6} {'🏁':>6} {'❤️/shown':>9}")
+    for route_id, count in shown.most_common(30):
+        favorites = toggled["favorites"][route_id]
+        lines.append(f"{route_id:>6} {count:>8} {favorites:>6} {toggled['completed'][route_id]:>6} "
+                     f"{favorites / count:>9.1%}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Чтение и обслуживание журнала действий")
+    parser.add_argument("command", choices=("read", "stats", "compact"))
+    parser.add_argument("--dir", default=events_dir())
+    parser.add_argument("--type", action="append", help="тип события (можно несколько раз)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="с даты/времени (UTC), например 2026-10-01")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="до даты/времени (UTC), не включая")
+    parser.add_argument("--user", type=int, help="id пользователя (users.id)")
+    args = parser.parse_args(argv)
+    if not args.dir or not os.path.isdir(args.dir):
+        print(f"no event log at {args.dir}", file=sys.stderr)
+        return 1
+    if args.command == "compact":
+        print(f"{compact(args.dir)} segments merged")
+        return 0
+    since, until = (d.replace(tzinfo=d.tzinfo or timezone.utc) if d else None for d in (args.since, args.until))
+    events = read_events(args.dir, args.type, since, until, args.user)
+    if args.command == "stats":
+        print(stats(events))
+    else:
+        for event in events:
+            print(json.dumps(event, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
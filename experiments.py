@@ -0,0 +1,180 @@
+"""A/B-эксперименты с коэффициентами подбора маршрутов.
+
+Эксперимент описывается JSON-файлом EXPERIMENTS_FILE:
+
+    {"name": "tags-2026-10",
+     "variants": [{"name": "control", "share": 50},
+                  {"name": "tags3", "share": 50, "weights": {"tag": 3.0, "tag_overlap": 1.0}}]}
+
+Группа пользователя — sha256("<эксперимент>:<tg_id>") по модулю BUCKETS, поэтому она одна и та же во всех
+процессах и после перезапуска, а в новом эксперименте пользователи перемешиваются заново. Поля "weights" —
+имена полей ScoringWeights; не указанные берутся по умолчанию. Файл перечитывается при изменении, без
+перезапуска; "enabled": false или удаление файла возвращает всех к коэффициентам по умолчанию.
+
+    python experiments.py [tg_id ...]   # группы пользователей и проверка долей на 100 000 id
+"""
+import os
+import sys
+import json
+import time
+import bisect
+import hashlib
+import logging
+from collections import Counter
+from dataclasses import dataclass, fields, replace
+from typing import Any, Dict, List
+
+import metrics
+from recommender import DEFAULT_WEIGHTS, ScoringWeights, scorer_for
+
+logger = logging.getLogger(__name__)
+
+EXPERIMENTS_FILE = os.getenv("EXPERIMENTS_FILE", "")
+# как часто проверять, не изменился ли файл, секунды
+EXPERIMENTS_CHECK_INTERVAL = float(os.getenv("EXPERIMENTS_CHECK_INTERVAL", "10"))
+BUCKETS = 10000
+
+WEIGHT_FIELDS = {f.name for f in fields(ScoringWeights)}
+
+assignments_total = metrics.registry.counter(
+    "bot_experiment_assignments_total", "Подборки по группам эксперимента", ("experiment", "variant"))
+
+
+@dataclass(frozen=True)
+class Assignment:
+    experiment: str | None
+    variant: str
+    weights: ScoringWeights
+
+
+DEFAULT = Assignment(None, "default", DEFAULT_WEIGHTS)
+
+
+class Experiment:
+    def __init__(self, name: str, variants: List[Assignment], shares: List[float]):
+        self.name = name
+        self.variants = variants
+        total = sum(shares)
+        # верхние границы групп в шкале BUCKETS: доли 50/30/20 -> 5000, 8000, 10000
+        bounds, acc = [], 0.0
+        for share in shares:
+            acc += share
+            bounds.append(round(acc / total * BUCKETS))
+        self._bounds = bounds
+
+    def bucket(self, tg_id: int) -> int:
+        digest = hashlib.sha256(f"{self.name}:{tg_id}".encode()).digest()
+        return int.from_bytes(digest[:8], "big") % BUCKETS
+
+    def assign(self, tg_id: int) -> Assignment:
+        return self.variants[bisect.bisect_right(self._bounds, self.bucket(tg_id))]
+
+
+def make_weights(overrides: Dict[str, Any]) -> ScoringWeights:
+    """Коэффициенты по умолчанию с заменой указанных; ValueError при неизвестном поле, не числе или наборе,
+    на котором не компилируется план оценки (например, нулевой делитель)."""
+    if not isinstance(overrides, dict):
+        raise ValueError("weights must be an object")
+    unknown = set(overrides) - WEIGHT_FIELDS
+    if unknown:
+        raise ValueError(f"unknown weights {sorted(unknown)}")
+    if not all(isinstance(v, (int, float)) for v in overrides.values()):
+        raise ValueError("weights must be numbers")
+    weights = replace(DEFAULT_WEIGHTS, **overrides)
+    # компиляция здесь, а не при первом подборе: ошибка всплывает при загрузке файла, а не в обработчике
+    scorer_for(weights)
+    return weights
+
+
+def parse(data: Dict[str, Any]) -> Experiment | None:
+    """Эксперимент из описания; None, если он выключен. ValueError при ошибке в описании."""
+    if not data or not data.get("enabled", True):
+        return None
+    name = data.get("name")
+    variants = data.get("variants")
+    if not isinstance(name, str) or not name:
+        raise ValueError("experiment name is required")
+    if not isinstance(variants, list) or not variants:
+        raise ValueError("at least one variant is required")
+    assignments, shares, names = [], [], set()
+    for variant in variants:
+        variant_name, share, weights = variant.get("name"), variant.get("share"), variant.get("weights", {})
+        if not isinstance(variant_name, str) or variant_name in names:
+            raise ValueError(f"bad or duplicate variant name {variant_name!r}")
+        if not isinstance(share, (int, float)) or share <= 0:
+            raise ValueError(f"variant {variant_name}: share must be a positive number")
+        try:
+            assignment = Assignment(name, variant_name, make_weights(weights))
+        except ValueError as e:
+            raise ValueError(f"variant {variant_name}: {e}") from None
+        names.add(variant_name)
+        shares.append(share)
+        assignments.append(assignment)
+    return Experiment(name, assignments, shares)
+
+
+class ExperimentConfig:
+    """Текущий эксперимент из файла. Файл проверяется по mtime не чаще раза в ``interval`` секунд прямо при
+    обращении; ошибочный файл не применяется — остаётся прежний эксперимент."""
+
+    def __init__(self, path: str, interval: float = EXPERIMENTS_CHECK_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.experiment: Experiment | None = None
+        self._mtime: int | None = None
+        self._checked = float("-inf")
+
+    def current(self) -> Experiment | None:
+        now = time.monotonic()
+        if self.path and now - self._checked >= self.interval:
+            self._checked = now
+            self._reload()
+        return self.experiment
+
+    def _reload(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if self.experiment is not None:
+                logger.info("Experiments file %s removed, experiment %s stopped", self.path, self.experiment.name)
+            self.experiment, self._mtime = None, None
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                experiment = parse(json.load(f))
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error("Invalid experiments file %s, keeping the previous one: %s", self.path, e)
+            return
+        self.experiment = experiment
+        if experiment is None:
+            logger.info("Experiments disabled in %s", self.path)
+        else:
+            logger.info("Experiment %s loaded: %s", experiment.name,
+                        ", ".join(variant.variant for variant in experiment.variants))
+
+
+config = ExperimentConfig(EXPERIMENTS_FILE)
+
+
+def assign(tg_id: int) -> Assignment:
+    """Группа пользователя в текущем эксперименте (или коэффициенты по умолчанию)."""
+    experiment = config.current()
+    assignment = experiment.assign(tg_id) if experiment is not None else DEFAULT
+    assignments_total.labels(assignment.experiment or "", assignment.variant).inc()
+    return assignment
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    current = config.current()
+    if current is None:
+        print(f"no active experiment in {EXPERIMENTS_FILE or '(EXPERIMENTS_FILE not set)'}")
+        sys.exit(0)
+    for arg in sys.argv[1:]:
+        tg_id = int(arg)
+        print(f"{tg_id}: bucket {current.bucket(tg_id)} -> {current.assign(tg_id).variant}")
+    split = Counter(current.assign(tg_id).variant for tg_id in range(100_000))
+    print(", ".join(f"{variant}: {count / 1000:.1f}%" for variant, count in split.most_common()))
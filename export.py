@@ -0,0 +1,164 @@
+"""Выгрузка пользователей, избранного, прохождений и сводки по маршрутам в CSV или JSON Lines.
+
+    python export.py users|favorites|completions|routes [--format csv|jsonl] [-o файл]
+
+Строки читаются пачками по EXPORT_BATCH по первичному ключу (WHERE id > последний ORDER BY id LIMIT n),
+каждая пачка — отдельная короткая транзакция. Память не зависит от размера таблиц, а SQLite между
+пачками свободна для записи. Форматирование и запись пачки (и сжатие в export_gzip) идут в потоке, чтобы
+выгрузка из бота не останавливала цикл событий.
+"""
+import os
+import csv
+import sys
+import json
+import gzip
+import asyncio
+import argparse
+import logging
+from datetime import datetime
+from time import perf_counter
+from typing import Any, AsyncIterator, Dict, List, Sequence, TextIO, Tuple
+
+from sqlalchemy import func, select
+
+from db import AsyncSessionLocal
+from models import CompletedRoute, Favorite, Route, User
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "5000"))
+FORMATS = ("csv", "jsonl")
+
+Batches = AsyncIterator[List[Sequence[Any]]]
+
+
+async def _keyset(stmt, key, batch: int = EXPORT_BATCH) -> Batches:
+    """Пачки строк ``stmt`` по возрастанию ``key``; ключ должен быть первой колонкой выборки."""
+    last = None
+    while True:
+        page = stmt.order_by(key).limit(batch)
+        if last is not None:
+            page = page.where(key > last)
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(page)).all()
+        if rows:
+            yield rows
+        if len(rows) < batch:
+            return
+        last = rows[-1][0]
+
+
+async def _favorites() -> Batches:
+    stmt = select(Favorite.id, Favorite.user_id, User.tg_id, Favorite.route_id).join(User, User.id == Favorite.user_id)
+    async for rows in _keyset(stmt, Favorite.id):
+        yield rows
+
+
+async def _completions() -> Batches:
+    stmt = (select(CompletedRoute.id, CompletedRoute.user_id, User.tg_id, CompletedRoute.route_id,
+                   CompletedRoute.completed_at)
+            .join(User, User.id == CompletedRoute.user_id))
+    async for rows in _keyset(stmt, CompletedRoute.id):
+        yield rows
+
+
+async def _users() -> Batches:
+    """Пользователи со счётчиками; счётчики считаются по id пачки — два запроса на пачку."""
+    stmt = select(User.id, User.tg_id, User.name, User.preferences)
+    async for users in _keyset(stmt, User.id):
+        ids = [row.id for row in users]
+        async with AsyncSessionLocal() as session:
+            favorites = dict((await session.execute(
+                select(Favorite.user_id, func.count()).where(Favorite.user_id.in_(ids)).group_by(Favorite.user_id)
+            )).all())
+            completions = {row[0]: row[1:] for row in (await session.execute(
+                select(CompletedRoute.user_id, func.count(), func.max(CompletedRoute.completed_at))
+                .where(CompletedRoute.user_id.in_(ids)).group_by(CompletedRoute.user_id)
+            )).all()}
+        yield [(row.id, row.tg_id, row.name, favorites.get(row.id, 0), *completions.get(row.id, (0, None)),
+                row.preferences) for row in users]
+
+
+async def _routes() -> Batches:
+    """Сводка по маршрутам. Избранное и прохождения читаются теми же пачками и копятся в словарях
+    по маршрутам, а не одним GROUP BY на всю таблицу, — так не держится долгая транзакция."""
+    favorites: Dict[int, int] = {}
+    completions: Dict[int, int] = {}
+    last_completed: Dict[int, datetime] = {}
+    async for rows in _keyset(select(Favorite.id, Favorite.route_id), Favorite.id):
+        for _, route_id in rows:
+            favorites[route_id] = favorites.get(route_id, 0) + 1
+    stmt = select(CompletedRoute.id, CompletedRoute.route_id, CompletedRoute.completed_at)
+    async for rows in _keyset(stmt, CompletedRoute.id):
+        for _, route_id, completed_at in rows:
+            completions[route_id] = completions.get(route_id, 0) + 1
+            if completed_at is not None and (route_id not in last_completed or completed_at > last_completed[route_id]):
+                last_completed[route_id] = completed_at
+    async for routes in _keyset(select(Route.id, Route.title, Route.popularity), Route.id):
+        yield [(route_id, title, popularity, favorites.get(route_id, 0), completions.get(route_id, 0),
+                last_completed.get(route_id)) for route_id, title, popularity in routes]
+
+
+EXPORTS: Dict[str, Tuple[Tuple[str, ...], Any]] = {
+    "users": (("user_id", "tg_id", "name", "favorites", "completions", "last_completed_at", "preferences"), _users),
+    "favorites": (("id", "user_id", "tg_id", "route_id"), _favorites),
+    "completions": (("id", "user_id", "tg_id", "route_id", "completed_at"), _completions),
+    "routes": (("route_id", "title", "popularity", "favorites", "completions", "last_completed_at"), _routes),
+}
+
+
+def _value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+async def export(kind: str, fmt: str, out: TextIO) -> int:
+    """Пишет выгрузку ``kind`` в ``out`` в формате ``fmt``; возвращает число строк."""
+    columns, source = EXPORTS[kind]
+    started = perf_counter()
+    writer = csv.writer(out) if fmt == "csv" else None
+    if writer is not None:
+        writer.writerow(columns)
+
+    def write(rows: List[Sequence[Any]]) -> None:
+        if writer is not None:
+            writer.writerows([_value(v) for v in row] for row in rows)
+        else:
+            out.writelines(json.dumps(dict(zip(columns, map(_value, row))), ensure_ascii=False) + "\n"
+                           for row in rows)
+
+    count = 0
+    async for rows in source():
+        await asyncio.to_thread(write, rows)
+        count += len(rows)
+    logger.info("Exported %s %s rows as %s in %.1fs", count, kind, fmt, perf_counter() - started)
+    return count
+
+
+async def export_gzip(kind: str, fmt: str, path: str) -> int:
+    """Выгрузка в сжатый файл — для отправки документом в Telegram."""
+    out = await asyncio.to_thread(gzip.open, path, "wt", encoding="utf-8", newline="")
+    try:
+        return await export(kind, fmt, out)
+    finally:
+        # close() дожимает и сбрасывает остаток сжатого потока
+        await asyncio.to_thread(out.close)
+
+
+async def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Выгрузка данных бота для отчётов")
+    parser.add_argument("kind", choices=tuple(EXPORTS))
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("-o", "--output", help="файл (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as out:
+            count = await export(args.kind, args.format, out)
+        print(f"{count} rows -> {args.output}", file=sys.stderr)
+    else:
+        await export(args.kind, args.format, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main()))
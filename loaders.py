@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import select
+
+from models import Route, route_tags, route_seasons, route_transports, Favorite, CompletedRoute
+from tracing import span
+
+
+async def load_routes_with_meta(session, route_ids: Iterable[int] | None = None) -> Dict[int, Dict[str, Any]]:
+    """Маршруты со списками тегов, сезонов и транспорта: по одному запросу на таблицу.
+
+    Без ``route_ids`` загружается весь каталог.
+    """
+    ids = None if route_ids is None else list(route_ids)
+    routes_stmt = select(Route)
+    meta_stmts = [
+        ("tags", select(route_tags.c.route_id, route_tags.c.tag)),
+        ("seasons", select(route_seasons.c.route_id, route_seasons.c.season)),
+        ("transports", select(route_transports.c.route_id, route_transports.c.transport)),
+    ]
+    if ids is not None:
+        routes_stmt = routes_stmt.where(Route.id.in_(ids))
+        meta_stmts = [(key, stmt.where(stmt.selected_columns[0].in_(ids))) for key, stmt in meta_stmts]
+
+    routes_q = await session.execute(routes_stmt.order_by(Route.id))
+    result = {}
+    for r in routes_q.scalars().all():
+        d = r.to_dict()
+        d.update({"tags": [], "seasons": [], "transports": []})
+        result[r.id] = d
+    for key, stmt in meta_stmts:
+        rows = await session.execute(stmt)
+        for route_id, value in rows.all():
+            route = result.get(route_id)
+            if route is not None:
+                route[key].append(value)
+    return result
+
+
+class RouteLoader:
+    """Пакетный загрузчик маршрутов в рамках одного апдейта (в духе DataLoader).
+
+    Все id, запрошенные в одном шаге цикла событий, загружаются одной пачкой запросов
+    ``IN (...)``; результаты запоминаются до конца апдейта. Даты прохождения текущего
+    пользователя загружаются той же пачкой, поэтому экран любой длины стоит
+    фиксированного числа запросов.
+    """
+
+    def __init__(self, session, user_id: int | None = None):
+        self.session = session
+        self.user_id = user_id
+        self._routes: Dict[int, Dict[str, Any] | None] = {}
+        self._completed_at: Dict[int, datetime] = {}
+        self._pending: Set[int] = set()
+        self._batch: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._user_routes: Tuple[Set[int], Set[int]] | None = None
+
+    async def _dispatch(self) -> None:
+        await asyncio.sleep(0)
+        ids, self._pending, self._batch = self._pending, set(), None
+        async with self._lock:
+            with span("loader.batch", routes=len(ids)):
+                routes = await load_routes_with_meta(self.session, ids)
+                if self.user_id is not None:
+                    rows = await self.session.execute(
+                        select(CompletedRoute.route_id, CompletedRoute.completed_at).where(
+                            CompletedRoute.user_id == self.user_id,
+                            CompletedRoute.route_id.in_(ids),
+                        )
+                    )
+                    self._completed_at.update(dict(rows.all()))
+        for route_id in ids:
+            self._routes[route_id] = routes.get(route_id)
+
+    async def _ensure(self, route_ids: Iterable[int]) -> None:
+        missing = {i for i in route_ids if i not in self._routes}
+        if not missing:
+            return
+        self._pending |= missing
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self._dispatch())
+        await self._batch
+
+    async def load(self, route_id: int) -> Dict[str, Any] | None:
+        await self._ensure((route_id,))
+        return self._routes[route_id]
+
+    async def load_many(self, route_ids: Iterable[int]) -> List[Dict[str, Any]]:
+        """Маршруты в порядке ``route_ids``; несуществующие пропускаются."""
+        route_ids = list(route_ids)
+        await self._ensure(route_ids)
+        return [self._routes[i] for i in route_ids if self._routes[i] is not None]
+
+    async def completed_at(self, route_ids: Iterable[int]) -> Dict[int, datetime]:
+        route_ids = list(route_ids)
+        await self._ensure(route_ids)
+        return {i: self._completed_at[i] for i in route_ids if i in self._completed_at}
+
+    async def user_routes(self) -> Tuple[Set[int], Set[int]]:
+        """(избранные, пройденные) id маршрутов текущего пользователя — два запроса на апдейт."""
+        if self._user_routes is None:
+            async with self._lock:
+                fav_q = await self.session.execute(select(Favorite.route_id).where(Favorite.user_id == self.user_id))
+                comp_q = await self.session.execute(
+                    select(CompletedRoute.route_id).where(CompletedRoute.user_id == self.user_id))
+                self._user_routes = (set(fav_q.scalars().all()), set(comp_q.scalars().all()))
+        return self._user_routes
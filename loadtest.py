@@ -0,0 +1,305 @@
+"""Нагрузочный прогон бота: виртуальные пользователи проходят сценарии через dp.feed_update.
+
+    python loadtest.py --users 2000 --api-latency 0.05 --report loadtest.json
+    python loadtest.py --startup 5        # время холодного и тёплого старта до первого ответа
+
+Запросы к Telegram не уходят — их принимает FakeSession с заданной задержкой. БД — отдельный
+SQLite-файл (``--db``, по умолчанию ./loadtest.db, пересоздаётся), рабочая база не трогается.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import statistics
+import subprocess
+from collections import Counter, defaultdict
+from typing import Any, Dict, List
+
+SEASONS = ["winter", "spring", "summer", "autumn"]
+DIFFICULTIES = ["легко", "сложно", "варьируется"]
+TRANSPORTS = ["машина", "4x4", "маршрутка", "лодка", "пешком"]
+TAGS = ["природа", "культура", "история", "приключение", "еда", "семейное", "походы", "прогулки", "город"]
+ROUTES_COUNT = 25
+
+SHED_TEXTS = ("Сейчас много запросов", "Слишком много нажатий")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон сценариев бота")
+    parser.add_argument("--users", type=int, default=1000, help="число виртуальных пользователей")
+    parser.add_argument("--ramp", type=float, default=5.0, help="за сколько секунд стартуют все пользователи")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя между нажатиями, с")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--api-jitter", type=float, default=0.02, help="разброс задержки Bot API, с")
+    parser.add_argument("--db", default="loadtest.db", help="файл SQLite для прогона")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report", help="куда записать JSON-отчёт (по умолчанию stdout)")
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS",
+                        help="вместо нагрузки замерить старт: RUNS холодных и RUNS тёплых запусков")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def remove_db(path: str) -> None:
+    for file in (path, path + ".catalog.json"):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+args = parse_args() if __name__ == "__main__" else None
+if args is not None:
+    if not args.startup and not args.startup_child:
+        remove_db(args.db)
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{args.db}"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # сезонная рассылка в прогоне не нужна: она пошла бы через ту же заглушку Bot API
+    os.environ.setdefault("BROADCAST_DIGEST", "0")
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+from sqlalchemy import event
+
+import db
+import metrics
+import run
+
+IMPORTED_AT = time.time()
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+    return {"count": len(values), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "max_ms": round(values[-1] * 1000, 2)}
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot API без сети: отвечает успехом через ``latency ± jitter`` и считает вызовы."""
+
+    def __init__(self, latency: float, jitter: float):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.calls: Counter = Counter()
+        self.shed = 0
+
+    async def make_request(self, bot: Bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        text = getattr(method, "text", None)
+        if text and text.startswith(SHED_TEXTS):
+            self.shed += 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        result: Any = True
+        if "Message" in str(method.__returning__):
+            chat_id = getattr(method, "chat_id", None) or 1
+            result = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "ok"}
+        return self.check_response(bot=bot, method=method, status_code=200,
+                                   content=json.dumps({"ok": True, "result": result}))
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        if False:
+            yield b""
+
+
+class DbWaits:
+    """Время пишущих запросов (в SQLite в нём сидит ожидание блокировки) и ошибки «database is locked»."""
+
+    def __init__(self, engine):
+        self.writes: List[float] = []
+        self.locked = 0
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        event.listen(engine, "handle_error", self._error)
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._loadtest_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            self.writes.append(time.perf_counter() - context._loadtest_started)
+
+    def _error(self, context):
+        if "locked" in str(context.original_exception):
+            self.locked += 1
+
+
+class LoadTest:
+    def __init__(self, bot: Bot, dp: Dispatcher, options):
+        self.bot = bot
+        self.dp = dp
+        self.options = options
+        self.update_ids = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+
+    def _message(self, uid: int, text: str) -> Update:
+        return Update.model_validate({"update_id": next(self.update_ids), "message": {
+            "message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"load{uid}"}, "text": text}})
+
+    def _callback(self, uid: int, data: str) -> Update:
+        return Update.model_validate({"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.update_ids)), "chat_instance": "1", "data": data,
+            "from": {"id": uid, "is_bot": False, "first_name": f"load{uid}"},
+            "message": {"message_id": 5, "date": 0, "chat": {"id": uid, "type": "private"}, "text": "x"}}})
+
+    def journey(self, uid: int, rnd: random.Random) -> List[Update]:
+        """/start, мастер предпочтений, подбор, переключатели ❤️/🏁, статистика и «Мои маршруты»."""
+        fav, other = rnd.sample(range(1, ROUTES_COUNT + 1), 2)
+        steps = [
+            self._message(uid, "/start"),
+            self._callback(uid, "set_prefs"),
+            self._callback(uid, f"season_{rnd.choice(SEASONS)}"),
+            self._message(uid, str(rnd.choice([10, 20, 40, 80]))),
+            self._message(uid, str(rnd.choice([1000, 3000, 8000]))),
+            self._callback(uid, f"diff_{rnd.choice(DIFFICULTIES)}"),
+            self._message(uid, str(rnd.randint(0, 100))),
+            self._callback(uid, f"trans_{rnd.choice(TRANSPORTS)}"),
+        ]
+        steps += [self._callback(uid, f"tag_{tag}") for tag in rnd.sample(TAGS, 2)]
+        steps += [
+            self._callback(uid, "tags_done"),
+            self._callback(uid, "find_routes"),
+            self._callback(uid, f"add_fav_{fav}"),
+            self._callback(uid, f"add_fav_{other}"),
+            self._callback(uid, f"complete_{fav}"),
+            self._callback(uid, f"remove_fav_{other}"),
+            self._callback(uid, "show_stats"),
+            self._callback(uid, "my_routes"),
+            self._callback(uid, "stats_details_all"),
+            self._callback(uid, "main_menu"),
+        ]
+        return steps
+
+    async def _feed(self, update: Update) -> None:
+        action = metrics.action_label(update.event)
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.errors[f"{action}: {type(e).__name__}"] += 1
+        finally:
+            self.latencies[action].append(time.perf_counter() - started)
+
+    async def _user(self, index: int) -> None:
+        rnd = random.Random(self.options.seed * 1_000_003 + index)
+        await asyncio.sleep(self.options.ramp * index / max(self.options.users, 1))
+        for update in self.journey(10_000_000 + index, rnd):
+            await self._feed(update)
+            if self.options.think:
+                await asyncio.sleep(rnd.expovariate(1 / self.options.think))
+
+    async def run(self) -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*(self._user(i) for i in range(self.options.users)))
+        return time.perf_counter() - started
+
+
+async def main(options) -> Dict[str, Any]:
+    random.seed(options.seed)
+    bot = run.create_bot()
+    session = FakeSession(options.api_latency, options.api_jitter)
+    bot.session = session
+    dp = run.create_dispatcher(bot)
+    waits = DbWaits(db.engine.sync_engine)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    test = LoadTest(bot, dp, options)
+    try:
+        duration = await test.run()
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+
+    updates = sum(len(v) for v in test.latencies.values())
+    failed = sum(test.errors.values())
+    return {
+        "config": vars(options),
+        "updates": updates,
+        "duration_s": round(duration, 3),
+        "throughput_ups": round(updates / duration, 1) if duration else None,
+        "latency": percentiles([x for v in test.latencies.values() for x in v]),
+        "handlers": {action: percentiles(values) for action, values in sorted(test.latencies.items())},
+        "errors": dict(test.errors),
+        "error_rate": round(failed / updates, 5) if updates else 0.0,
+        "shed": session.shed,
+        "shed_rate": round(session.shed / updates, 5) if updates else 0.0,
+        "db": {"write_statements": percentiles(waits.writes), "locked_errors": waits.locked},
+        "api_calls": dict(session.calls),
+    }
+
+
+async def startup_child(options) -> Dict[str, float]:
+    """Один запуск в отдельном процессе: моменты готовности, отсчитанные от порождения процесса."""
+    import catalog
+    spawned = float(os.environ["LOADTEST_SPAWN_TS"])
+    bot = run.create_bot()
+    session = FakeSession(0, 0)
+    bot.session = session
+    dp = run.create_dispatcher(bot)
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    started_at = time.time()
+    await dp.feed_update(bot, LoadTest(bot, dp, options)._message(1, "/start"))
+    first_response_at = time.time()
+    await catalog.get_snapshot()
+    catalog_at = time.time()
+    await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    return {
+        "imports_ms": (IMPORTED_AT - spawned) * 1000,
+        "startup_ms": (started_at - spawned) * 1000,
+        "first_response_ms": (first_response_at - spawned) * 1000,
+        "catalog_ready_ms": (catalog_at - spawned) * 1000,
+    }
+
+
+def startup_benchmark(options) -> Dict[str, Any]:
+    """Медианы по RUNS запускам: cold — пустой том (нет БД и снимка), warm — повторный старт."""
+    report: Dict[str, Any] = {"config": vars(options)}
+    for scenario in ("cold", "warm"):
+        runs = []
+        for _ in range(options.startup):
+            if scenario == "cold":
+                remove_db(options.db)
+            env = dict(os.environ, LOADTEST_SPAWN_TS=repr(time.time()), LOG_LEVEL="ERROR")
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-child", "--db", options.db],
+                                 env=env, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+        report[scenario] = {key: round(statistics.median(r[key] for r in runs), 1) for key in runs[0]}
+    return report
+
+
+if __name__ == "__main__" and args.startup_child:
+    print(json.dumps(asyncio.run(startup_child(args))))
+elif __name__ == "__main__" and args.startup:
+    report = startup_benchmark(args)
+    payload = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(payload)
+    print(payload)
+elif __name__ == "__main__":
+    report = asyncio.run(main(args))
+    payload = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(payload)
+        print(f"{report['updates']} updates in {report['duration_s']}s, {report['throughput_ups']} upd/s, "
+              f"p99 {report['latency'].get('p99_ms')} ms, errors {report['error_rate']:.2%}", file=sys.stderr)
+    else:
+        print(payload)
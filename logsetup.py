@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Tuple
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# записей в секунду на логгер (и его дочерние); WARNING и выше не ограничиваются
+LOG_RATE_LIMITS = os.getenv("LOG_RATE_LIMITS", "aiogram.event=20,recommender=20,handlers=50")
+# доля записей, которые вообще доходят до лимита: "recommender=0.1"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+
+TEXT_FORMAT = "%(asctime)s | %(levelname)-5s | %(name)s | %(message)s"
+
+
+def _parse(raw: str, cast) -> Dict[str, float]:
+    result = {}
+    for item in raw.split(","):
+        name, _, value = item.strip().partition("=")
+        if name and value:
+            result[name] = cast(value)
+    return result
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из ``extra=`` попадают в объект как есть."""
+
+    _skip = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._skip:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket и сэмплирование по имени логгера (самый длинный подходящий префикс).
+
+    Стоит на QueueHandler, то есть выполняется в потоке цикла событий: отброшенная запись
+    не попадает в очередь и не форматируется.
+    """
+
+    def __init__(self, limits: Dict[str, float], samples: Dict[str, float]):
+        super().__init__()
+        self.limits = limits
+        self.samples = samples
+        self.dropped: Counter = Counter()
+        self._buckets: Dict[str, list] = {}
+        self._rules: Dict[str, Tuple[str | None, str | None]] = {}
+
+    @staticmethod
+    def _match(name: str, rules: Dict[str, float]) -> str | None:
+        while name:
+            if name in rules:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rules = self._rules.get(record.name)
+        if rules is None:
+            rules = self._rules[record.name] = (self._match(record.name, self.limits),
+                                                self._match(record.name, self.samples))
+        limit_key, sample_key = rules
+        if sample_key is not None and random.random() >= self.samples[sample_key]:
+            self.dropped[record.name] += 1
+            return False
+        if limit_key is not None:
+            rate = self.limits[limit_key]
+            bucket = self._buckets.get(limit_key)
+            now = time.monotonic()
+            if bucket is None:
+                bucket = self._buckets[limit_key] = [rate, now]
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.dropped[record.name] += 1
+                return False
+            bucket[0] -= 1
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Кладёт запись в очередь без форматирования: сообщение собирается из msg % args уже в потоке
+    QueueListener. Поэтому аргументы логирования не должны меняться после вызова — в коде бота это
+    строки, числа и свежие словари апдейта. Если очередь полна, запись отбрасывается."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.overflow = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # трассировку стека форматируем сразу: кадры могут измениться, пока запись в очереди
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.overflow += 1
+
+
+listener: QueueListener | None = None
+rate_filter: RateLimitFilter | None = None
+queue_handler: NonBlockingQueueHandler | None = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT) -> None:
+    """Корневой логгер пишет в очередь; форматирует и выводит в stderr фоновый поток."""
+    global listener, rate_filter, queue_handler
+    if listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    rate_filter = RateLimitFilter(_parse(LOG_RATE_LIMITS, float), _parse(LOG_SAMPLE, float))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(rate_filter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def dropped() -> Dict[str, int]:
+    """Отброшенные записи: по логгерам (лимиты и сэмплирование) и "<overflow>" — из-за полной очереди."""
+    result = dict(rate_filter.dropped) if rate_filter is not None else {}
+    if queue_handler is not None and queue_handler.overflow:
+        result["<overflow>"] = queue_handler.overflow
+    return result
+
+
+def _bench(n: int = 200_000) -> None:
+    """Стоимость вызова логгера в потоке приложения, мкс на вызов."""
+    import io
+    import tempfile
+
+    def measure(title, logger, fn, count=n):
+        start = time.perf_counter()
+        for i in range(count):
+            fn(logger, i)
+        elapsed = time.perf_counter() - start
+        print(f"{title:44s} {elapsed / count * 1e6:7.2f} us")
+
+    class SlowSink(io.StringIO):
+        """stderr, который читают медленнее, чем пишут (терминал, переполненный pipe)."""
+
+        def write(self, s):
+            time.sleep(0.0002)
+            return super().write(s)
+
+    def info(logger, i):
+        logger.info("User %s set season=%s prefs=%s", i, "summer", {"tags": ["nature"], "length_km": 20.0})
+
+    def debug(logger, i):
+        logger.debug("SCORE DEBUG for '%s' : score=%.3f | %s", "route", 1.5, "details")
+
+    with tempfile.TemporaryFile("w") as sink:
+        sync = logging.getLogger("bench.sync")
+        sync.propagate = False
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        sync.addHandler(handler)
+        sync.setLevel(logging.INFO)
+        measure("sync StreamHandler (file)", sync, info)
+
+        q: queue.Queue = queue.Queue()
+        queued = logging.getLogger("bench.queued")
+        queued.propagate = False
+        queued.addHandler(NonBlockingQueueHandler(q))
+        queued.setLevel(logging.INFO)
+        output = logging.StreamHandler(sink)
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+        bench_listener = QueueListener(q, output)
+        bench_listener.start()
+        measure("NonBlockingQueueHandler (enqueue only)", queued, info)
+        bench_listener.stop()
+
+        slow = logging.getLogger("bench.slow")
+        slow.propagate = False
+        slow_handler = logging.StreamHandler(SlowSink())
+        slow_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        slow.addHandler(slow_handler)
+        slow.setLevel(logging.INFO)
+        measure("sync StreamHandler (slow stderr)", slow, info, 2000)
+
+        slow_q: queue.Queue = queue.Queue()
+        slow_queued = logging.getLogger("bench.slow_queued")
+        slow_queued.propagate = False
+        slow_queued.addHandler(NonBlockingQueueHandler(slow_q))
+        slow_queued.setLevel(logging.INFO)
+        slow_listener = QueueListener(slow_q, slow_handler)
+        slow_listener.start()
+        measure("NonBlockingQueueHandler (slow stderr)", slow_queued, info, 2000)
+        slow_listener.stop()
+
+        limited = logging.getLogger("bench.limited")
+        limited.propagate = False
+        limited_handler = NonBlockingQueueHandler(queue.Queue())
+        limited_handler.addFilter(RateLimitFilter({"bench.limited": 10}, {}))
+        limited.addHandler(limited_handler)
+        limited.setLevel(logging.INFO)
+        measure("rate-limited, dropped", limited, info)
+
+        sampled = logging.getLogger("bench.sampled")
+        sampled.propagate = False
+        sampled_handler = NonBlockingQueueHandler(queue.Queue())
+        sampled_handler.addFilter(RateLimitFilter({}, {"bench.sampled": 0.01}))
+        sampled.addHandler(sampled_handler)
+        sampled.setLevel(logging.INFO)
+        measure("sampled 1%", sampled, info)
+
+        measure("debug() below level", queued, debug)
+
+    from recommender import score_route
+    route = {"title": "r", "seasons": ["summer"], "length_km": 20.0, "price_estimate": 3000.0,
+             "difficulty": "легко", "popularity": 50, "transports": ["car"], "tags": ["nature"], "link": "x"}
+    prefs = {"season": "summer", "length_km": 25, "price_estimate": 2000, "difficulty": "легко",
+             "popularity": 40, "transport": "car", "tags": ["nature", "family"]}
+    rec_logger = logging.getLogger("recommender")
+    for level in (logging.INFO, logging.DEBUG):
+        rec_logger.setLevel(level)
+        rec_logger.propagate = False
+        rec_logger.handlers = [NonBlockingQueueHandler(queue.Queue())]
+        measure(f"score_route, recommender at {logging.getLevelName(level)}", None,
+                lambda _, i: score_route(route, prefs, "summer"))
+
+
+if __name__ == "__main__":
+    # python logsetup.py  — замер накладных расходов логирования
+    _bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
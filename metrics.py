@@ -0,0 +1,363 @@
+import os
+import sys
+import logging
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Mapping, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery, InlineQuery, Message, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# токен для /metrics на публичном порту вебхука (заголовок "Authorization: Bearer <токен>");
+# без него метрики отдаются только отдельным сервером на METRICS_PORT
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+# callback_data кнопок, совпадают с фильтрами в handlers.py; всё остальное считается как "other",
+# чтобы число значений метки не росло от id маршрутов
+CALLBACK_ACTIONS = {
+    "main_menu", "set_prefs", "view_prefs", "my_routes", "show_stats", "find_routes", "help",
+    "tags_done", "reset_and_start", "continue_current", "reset_prefs", "stats_details_all",
+}
+CALLBACK_PREFIXES = ("season_", "diff_", "trans_", "tag_", "add_fav_", "remove_fav_", "complete_", "uncomplete_",
+                     "similar_")
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """Метрика с метками. ``labels(...)`` возвращает дочерний счётчик; его стоит получить один раз
+    и переиспользовать, тогда запись — это одно сложение (или bisect для гистограммы)."""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: Any):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield "", values, "", child.value
+
+    def render(self, out: list) -> None:
+        out.append(f"# HELP {self.name} {self.documentation}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        for suffix, values, extra, value in self._samples():
+            out.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", values, f'le="{_format_value(bound)}"', cumulative
+            yield "_count", values, "", cumulative
+            yield "_sum", values, "", child.sum
+
+
+class CallbackMetric(Metric):
+    """Значение читается функцией в момент сбора (глубины очередей, счётчики кэшей) —
+    на горячем пути ничего не стоит. ``func`` возвращает число или {значение метки: число}."""
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], Any], labelname: str | None = None,
+                 kind: str = "gauge"):
+        super().__init__(name, documentation, (labelname,) if labelname else ())
+        self.func = func
+        self.kind = kind
+
+    def _samples(self):
+        value = self.func()
+        if isinstance(value, Mapping):
+            for label, v in value.items():
+                yield "", (label,), "", v
+        else:
+            yield "", (), "", value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as {metric.kind}")
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def callback(self, name: str, documentation: str, func: Callable[[], Any], labelname: str | None = None,
+                 kind: str = "gauge") -> CallbackMetric:
+        """Регистрирует (или заменяет) метрику, значение которой вычисляется при сборе."""
+        metric = self._metrics[name] = CallbackMetric(name, documentation, func, labelname, kind)
+        return metric
+
+    def render(self) -> str:
+        out: list = []
+        for metric in list(self._metrics.values()):
+            lines: list = []
+            try:
+                metric.render(lines)
+            except Exception:
+                logger.exception("Failed to collect metric %s", metric.name)
+                continue
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "bot_handler_seconds", "Время обработки апдейта обработчиком", ("action",))
+handler_errors = registry.counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ("action",))
+update_queries = registry.histogram(
+    "bot_update_db_queries", "Число SQL-запросов на апдейт", ("action",), buckets=COUNT_BUCKETS)
+db_query_seconds = registry.histogram(
+    "bot_db_query_seconds", "Длительность одного SQL-запроса", buckets=QUERY_BUCKETS)
+recommender_seconds = registry.histogram(
+    "bot_recommender_seconds", "Время подбора маршрутов (recommend_routes)")
+api_seconds = registry.histogram(
+    "bot_telegram_api_seconds", "Длительность вызовов Telegram Bot API", ("method",))
+api_errors = registry.counter(
+    "bot_telegram_api_errors_total", "Ошибки вызовов Telegram Bot API", ("method", "error"))
+
+
+caches: Dict[str, Callable[[], Tuple[int, int]]] = {}
+
+
+def cache_ratio(hits: int, misses: int) -> float:
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+def register_cache(name: str, stats: Callable[[], Tuple[int, int]]) -> None:
+    """Публикует hits/misses кэша и их отношение; ``stats`` возвращает (hits, misses)."""
+    caches[name] = stats
+    registry.callback("bot_cache_hits_total", "Попадания в кэши",
+                      lambda: {n: s()[0] for n, s in caches.items()}, "cache", kind="counter")
+    registry.callback("bot_cache_misses_total", "Промахи кэшей",
+                      lambda: {n: s()[1] for n, s in caches.items()}, "cache", kind="counter")
+    registry.callback("bot_cache_hit_ratio", "Доля попаданий в кэши",
+                      lambda: {n: cache_ratio(*s()) for n, s in caches.items()}, "cache")
+
+
+def action_label(event: TelegramObject) -> str:
+    if isinstance(event, CallbackQuery):
+        data = event.data or ""
+        if data in CALLBACK_ACTIONS:
+            return data
+        for prefix in CALLBACK_PREFIXES:
+            if data.startswith(prefix):
+                return prefix[:-1]
+        return "other"
+    if isinstance(event, Message):
+        text = event.text or ""
+        return "cmd_start" if text.startswith("/start") else "message"
+    if isinstance(event, InlineQuery):
+        return "inline_query"
+    return type(event).__name__.lower()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: время обработчика и число SQL-запросов по действию."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        action = action_label(event)
+        start = perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.labels(action).inc()
+            raise
+        finally:
+            handler_seconds.labels(action).observe(perf_counter() - start)
+            stats = data.get("query_stats")
+            if stats is not None:
+                update_queries.labels(action).observe(stats.count)
+
+
+class TelegramApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: длительность и ошибки каждого вызова Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            api_seconds.labels(name).observe(perf_counter() - start)
+
+
+async def handle_metrics(request):
+    from aiohttp import web
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """Отдельный HTTP-сервер с /metrics (для polling и воркеров). Возвращает AppRunner для cleanup()."""
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics server listening on %s:%s", host, port)
+    return runner
+
+
+def _bench(n: int = 1_000_000) -> None:
+    """Стоимость записи на горячем пути, нс на операцию."""
+    counter = registry.counter("bench_total", "bench", ("action",)).labels("find_routes")
+    histogram = registry.histogram("bench_seconds", "bench", ("action",))
+    child = histogram.labels("find_routes")
+    cases = [
+        ("counter.inc (child)", lambda: counter.inc()),
+        ("histogram.observe (child)", lambda: child.observe(0.0123)),
+        ("histogram.labels().observe", lambda: histogram.labels("find_routes").observe(0.0123)),
+        ("perf_counter pair + observe", lambda: child.observe(perf_counter() - perf_counter())),
+    ]
+    baseline_start = perf_counter()
+    noop = lambda: None  # noqa: E731
+    for _ in range(n):
+        noop()
+    baseline = perf_counter() - baseline_start
+    for title, fn in cases:
+        start = perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = perf_counter() - start - baseline
+        print(f"{title:32s} {elapsed / n * 1e9:8.1f} ns")
+
+
+if __name__ == "__main__":
+    # python metrics.py  — замер накладных расходов записи метрик
+    _bench(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
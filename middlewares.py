@@ -0,0 +1,135 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+from sqlalchemy import select
+
+from db import AsyncSessionLocal, QueryStats, current_query_stats
+from loaders import RouteLoader
+from models import User
+
+logger = logging.getLogger(__name__)
+
+USER_QUEUE_LIMIT = int(os.getenv("USER_QUEUE_LIMIT", "20"))
+
+# апдейты, которые обслуживаются из памяти и не должны открывать сессию БД
+NO_DB_EVENTS = {"inline_query", "chosen_inline_result"}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class KeyedLock:
+    """Отдельный asyncio.Lock на каждый ключ.
+
+    Запись о ключе живёт, пока лок кто-то держит или ждёт, и удаляется сразу после этого,
+    так что память не растёт с числом пользователей. ``limit`` ограничивает число ожидающих
+    на один ключ: лишние получают QueueFull.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self._entries: Dict[Hashable, list] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def pending(self, key: Hashable) -> int:
+        entry = self._entries.get(key)
+        return entry[1] if entry else 0
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [asyncio.Lock(), 0]
+        elif self.limit and entry[1] > self.limit:
+            raise QueueFull(key)
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._entries[key]
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """Обрабатывает апдейты одного пользователя строго по очереди, разных — параллельно.
+
+    Должен стоять перед DbSessionMiddleware: пользователь читается из БД уже под локом,
+    поэтому быстрые повторные нажатия (tag_*, add_fav_*, complete_*) не теряют записи друг друга.
+    """
+
+    def __init__(self, limit: int = USER_QUEUE_LIMIT):
+        self.locks = KeyedLock(limit)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        tg_user = data.get("event_from_user")
+        if tg_user is None:
+            return await handler(event, data)
+        try:
+            async with self.locks.hold(tg_user.id):
+                return await handler(event, data)
+        except QueueFull:
+            logger.warning("Too many pending updates for user %s, dropping update %s",
+                           tg_user.id, getattr(event, "update_id", None))
+            if isinstance(event, Update) and event.callback_query is not None:
+                await event.callback_query.answer("Слишком много нажатий, подождите немного ⏳")
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Открывает одну сессию БД на апдейт, находит пользователя и коммитит один раз в конце.
+
+    Обработчики получают аргументы ``session``, ``user`` (или None, если пользователь
+    ещё не писал /start), ``loader`` (RouteLoader этого апдейта) и ``query_stats``.
+    Inline-запросы пропускаются без сессии.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if isinstance(event, Update) and event.event_type in NO_DB_EVENTS:
+            return await handler(event, data)
+
+        stats = QueryStats()
+        token = current_query_stats.set(stats)
+        try:
+            async with AsyncSessionLocal() as session:
+                user = None
+                tg_user = data.get("event_from_user")
+                if tg_user is not None:
+                    q = await session.execute(select(User).where(User.tg_id == tg_user.id))
+                    user = q.scalars().first()
+
+                data["session"] = session
+                data["user"] = user
+                data["loader"] = RouteLoader(session, user.id if user else None)
+                data["query_stats"] = stats
+                try:
+                    result = await handler(event, data)
+                    await session.commit()
+                except Exception:
+                    await session.rollback()
+                    # обработчик мог записать побочные эффекты (события журнала), которые теперь надо компенсировать
+                    for compensate in session.info.pop("on_rollback", ()):
+                        compensate()
+                    raise
+                return result
+        finally:
+            current_query_stats.reset(token)
+            logger.debug("Update %s issued %s queries", getattr(event, "update_id", None), stats.count)
@@ -74,4 +74,44 @@ class CompletedRoute(Base):
     route_id = Column(Integer, ForeignKey("routes.id"), nullable=False)
     completed_at = Column(DateTime, default=datetime.utcnow)
 
-    __table_args__ = (UniqueConstraint('user_id', 'route_id', name='unique_user_completed_route'),)
\ No newline at end of file
+    __table_args__ = (UniqueConstraint('user_id', 'route_id', name='unique_user_completed_route'),)
+
+
+class AppMeta(Base):
+    """Служебные значения: версия схемы и версия каталога маршрутов."""
+    __tablename__ = "app_meta"
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+
+class Broadcast(Base):
+    """Рассылка с контрольной точкой: продолжается с last_user_id после падения или передеплоя.
+
+    lease_owner/lease_until — кто из процессов сейчас ведёт рассылку (аренда продлевается на каждой точке).
+    """
+    __tablename__ = "broadcasts"
+    key = Column(String, primary_key=True)
+    last_user_id = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    lease_owner = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+
+
+class BlockedUser(Base):
+    """Пользователи, заблокировавшие бота; рассылки их пропускают до следующего /start."""
+    __tablename__ = "blocked_users"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    blocked_at = Column(DateTime, default=datetime.utcnow)
+
+
+class RouteNeighbor(Base):
+    """Заранее посчитанные похожие маршруты (similarity.py): ``rank`` 0 — самый похожий."""
+    __tablename__ = "route_neighbors"
+    route_id = Column(Integer, ForeignKey("routes.id"), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    neighbor_id = Column(Integer, ForeignKey("routes.id"), nullable=False)
+    score = Column(Float, nullable=False)
@@ -0,0 +1,321 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import linecache
+import threading
+import traceback
+import tracemalloc
+from collections import deque
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# период замера задержки цикла событий, с (0 — замер выключен, самописец апдейтов работает)
+MONITOR_INTERVAL = float(os.getenv("MONITOR_INTERVAL", "0.25"))
+# задержка цикла, после которой пишется дамп со стеком блокирующего кода
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "500"))
+# апдейт дольше порога тоже вызывает дамп (со стеком его задачи, пока он ещё выполняется)
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "5000"))
+FLIGHT_RECORDER_SIZE = int(os.getenv("FLIGHT_RECORDER_SIZE", "100"))
+# не чаще одного дампа за столько секунд
+MONITOR_DUMP_COOLDOWN = float(os.getenv("MONITOR_DUMP_COOLDOWN", "60"))
+# дампы дописываются в файл; без него — только в лог
+MONITOR_DUMP_FILE = os.getenv("MONITOR_DUMP_FILE", "")
+# >0 — tracemalloc с этим числом кадров с момента старта; иначе включается при первом /debug_state
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "0"))
+
+ENABLED = MONITOR_INTERVAL > 0
+
+loop_lag = metrics.registry.histogram(
+    "bot_loop_lag_seconds", "Задержка цикла событий относительно ожидаемого пробуждения")
+loop_stalls = metrics.registry.counter("bot_loop_stalls_total", "Блокировки цикла событий дольше порога")
+slow_updates = metrics.registry.counter("bot_slow_updates_total", "Апдейты дольше SLOW_UPDATE_MS")
+
+
+class UpdateRecord:
+    __slots__ = ("update_id", "action", "handler", "wall_start", "start", "duration_ms", "queries",
+                 "api_calls", "error", "task", "dumped")
+
+    def __init__(self, update_id: Any, action: str):
+        self.update_id = update_id
+        self.action = action
+        self.handler: Optional[str] = None
+        self.wall_start = time.time()
+        self.start = perf_counter()
+        self.duration_ms: Optional[float] = None
+        self.queries = 0
+        self.api_calls = 0
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = asyncio.current_task()
+        self.dumped = False
+
+    def format(self, now: float) -> str:
+        duration = self.duration_ms if self.duration_ms is not None else (now - self.start) * 1000
+        state = "running" if self.duration_ms is None else "done"
+        return (f"{time.strftime('%H:%M:%S', time.localtime(self.wall_start))}  update={self.update_id}  "
+                f"{self.action}/{self.handler or '-'}  {duration:8.1f} ms  {state}  queries={self.queries}  "
+                f"api={self.api_calls}" + (f"  error={self.error}" if self.error else ""))
+
+
+current_record: ContextVar[Optional[UpdateRecord]] = ContextVar("current_record", default=None)
+
+
+def _coroutine_stack(task: asyncio.Task) -> List[str]:
+    """Цепочка await задачи от обработчика до места ожидания (task.get_stack() даёт только верхний кадр)."""
+    lines = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        lines.append(f'  File "{frame.f_code.co_filename}", line {frame.f_lineno}, in {frame.f_code.co_name}')
+        source = linecache.getline(frame.f_code.co_filename, frame.f_lineno).strip()
+        if source:
+            lines.append(f"    {source}")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return lines
+
+
+class Monitor:
+    """Задержка цикла событий и бортовой самописец последних апдейтов.
+
+    Задача в цикле просыпается каждые ``interval`` секунд и меряет опоздание; поток-сторож смотрит
+    на время последнего пробуждения и, если цикл стоит дольше порога, снимает стек главного потока —
+    это и есть код, который блокирует цикл. Пока цикл свободен, та же задача ищет апдейты дольше
+    SLOW_UPDATE_MS и снимает стек их задач.
+    """
+
+    def __init__(self, interval: float = MONITOR_INTERVAL, lag_threshold_ms: float = LOOP_LAG_THRESHOLD_MS,
+                 slow_update_ms: float = SLOW_UPDATE_MS, size: int = FLIGHT_RECORDER_SIZE):
+        self.interval = interval
+        self.lag_threshold = lag_threshold_ms / 1000
+        self.slow_update_ms = slow_update_ms
+        self.records: deque = deque(maxlen=size)
+        self.in_flight: Dict[int, UpdateRecord] = {}
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._stall_reported = False
+        self._last_dump = 0.0
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        if TRACEMALLOC_FRAMES > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = loop.create_task(self._probe(), name="loop-monitor")
+        if self.lag_threshold > 0:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+        if hasattr(signal, "SIGUSR1"):
+            try:
+                loop.add_signal_handler(signal.SIGUSR1, self._on_signal)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=1)
+            self._watchdog = None
+
+    async def _probe(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(0.0, now - expected)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            loop_lag.observe(lag)
+            if self.lag_threshold and lag >= self.lag_threshold:
+                if self._stall_reported:
+                    logger.warning("Event loop resumed after %.0f ms stall", lag * 1000)
+                else:
+                    # сторож не успел заметить блокировку — стека уже нет
+                    self._record_stall()
+                    self.dump(f"event loop lag {lag * 1000:.0f} ms (stack not captured)")
+            self._stall_reported = False
+            if self.slow_update_ms:
+                self._check_slow_updates()
+
+    def _watch(self) -> None:
+        period = min(self.interval, self.lag_threshold) / 2
+        while not self._stop.wait(period):
+            blocked = time.monotonic() - self._heartbeat - self.interval
+            if blocked < self.lag_threshold or self._stall_reported:
+                continue
+            self._stall_reported = True
+            self._record_stall()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            self.dump(f"event loop blocked for {blocked * 1000:.0f} ms", "".join(stack).rstrip().splitlines())
+
+    def _record_stall(self) -> None:
+        self.stalls += 1
+        loop_stalls.inc()
+
+    def _check_slow_updates(self) -> None:
+        now = perf_counter()
+        for record in list(self.in_flight.values()):
+            if record.dumped or (now - record.start) * 1000 < self.slow_update_ms:
+                continue
+            record.dumped = True
+            slow_updates.inc()
+            stack = _coroutine_stack(record.task) if record.task is not None else []
+            self.dump(f"update {record.update_id} running for {(now - record.start) * 1000:.0f} ms", stack)
+
+    def begin(self, update_id: Any, action: str) -> UpdateRecord:
+        record = UpdateRecord(update_id, action)
+        self.in_flight[id(record)] = record
+        self.records.append(record)
+        return record
+
+    def finish(self, record: UpdateRecord) -> None:
+        record.duration_ms = (perf_counter() - record.start) * 1000
+        self.in_flight.pop(id(record), None)
+        if self.slow_update_ms and record.duration_ms >= self.slow_update_ms and not record.dumped:
+            record.dumped = True
+            slow_updates.inc()
+            self.dump(f"update {record.update_id} took {record.duration_ms:.0f} ms")
+
+    def dump(self, reason: str, stack: List[str] = ()) -> None:
+        """Пишет в лог (и в MONITOR_DUMP_FILE) причину, стек и содержимое самописца."""
+        now = time.monotonic()
+        if now - self._last_dump < MONITOR_DUMP_COOLDOWN:
+            logger.warning("Flight recorder: %s (dump suppressed, cooldown)", reason)
+            return
+        self._last_dump = now
+        lines = [f"Flight recorder: {reason}"]
+        if stack:
+            lines.append("Stack:")
+            lines.extend(stack)
+        lines.extend(self._records_section())
+        text = "\n".join(lines)
+        logger.warning(text)
+        if MONITOR_DUMP_FILE:
+            try:
+                with open(MONITOR_DUMP_FILE, "a", encoding="utf-8") as f:
+                    f.write(time.strftime("%Y-%m-%d %H:%M:%S ") + text + "\n\n")
+            except OSError:
+                logger.exception("Failed to write flight recorder dump to %s", MONITOR_DUMP_FILE)
+
+    def _records_section(self) -> List[str]:
+        now = perf_counter()
+        # вызывается и из потока-сторожа, пока цикл стоит; копия на случай, если он успел ожить
+        try:
+            records = list(self.records)
+        except RuntimeError:
+            records = []
+        lines = [f"Last {len(records)} updates (oldest first):"]
+        lines.extend("  " + r.format(now) for r in records)
+        return lines
+
+    def state_report(self, top: int = 10) -> str:
+        """Текущее состояние: задержка цикла, выполняющиеся апдейты со стеками, самописец, память."""
+        now = perf_counter()
+        lines = [
+            f"Loop lag: last {self.last_lag * 1000:.1f} ms, max {self.max_lag * 1000:.1f} ms, "
+            f"stalls {self.stalls}, asyncio tasks {len(asyncio.all_tasks())}",
+            f"In flight: {len(self.in_flight)}",
+        ]
+        for record in sorted(self.in_flight.values(), key=lambda r: r.start):
+            lines.append("  " + record.format(now))
+            if record.task is not None:
+                lines.extend("    " + line for line in _coroutine_stack(record.task))
+        lines.extend(self._records_section())
+        lines.extend(memory_report(top))
+        return "\n".join(lines)
+
+    def _on_signal(self) -> None:
+        logger.warning("State on SIGUSR1:\n%s", self.state_report())
+
+
+def memory_report(top: int = 10) -> List[str]:
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(TRACEMALLOC_FRAMES, 1))
+        return ["tracemalloc: started now, allocations will be shown on the next request"]
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"tracemalloc: current {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB, "
+             f"top {top} by line:"]
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append(f"  {stat.size / 1024:9.1f} KiB  {stat.count:7d} blocks  {frame.filename}:{frame.lineno}")
+    return lines
+
+
+monitor = Monitor()
+
+
+class FlightRecorderMiddleware(BaseMiddleware):
+    """Внешний middleware: запись апдейта в самописец. Стоит перед очередью пользователя и допуском,
+    поэтому длительность включает ожидание в них; число запросов берётся из QueryStats апдейта."""
+
+    def __init__(self, target: Monitor = monitor):
+        self.monitor = target
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if isinstance(event, Update):
+            record = self.monitor.begin(event.update_id, metrics.action_label(event.event))
+        else:
+            record = self.monitor.begin(None, type(event).__name__)
+        token = current_record.set(record)
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            record.error = type(e).__name__
+            raise
+        finally:
+            current_record.reset(token)
+            stats = data.get("query_stats")
+            if stats is not None:
+                record.queries = stats.count
+                record.handler = stats.handler
+            self.monitor.finish(record)
+
+
+class OutboundCallsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: считает вызовы Bot API текущего апдейта."""
+
+    async def __call__(self, make_request, bot, method):
+        record = current_record.get()
+        if record is not None:
+            record.api_calls += 1
+        return await make_request(bot, method)
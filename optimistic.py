@@ -0,0 +1,193 @@
+import os
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Set
+
+from aiogram import types
+from sqlalchemy import select, delete
+
+import collab
+import metrics
+from db import AsyncSessionLocal
+from events import event_log
+from models import Favorite, CompletedRoute
+from utils import route_keyboard
+
+logger = logging.getLogger(__name__)
+
+OPTIMISTIC_TOGGLES = os.getenv("OPTIMISTIC_TOGGLES", "1") == "1"
+USER_STATE_CACHE_SIZE = int(os.getenv("USER_STATE_CACHE_SIZE", "10000"))
+WRITE_RETRIES = int(os.getenv("OPTIMISTIC_WRITE_RETRIES", "3"))
+# предел очереди фоновой записи: когда БД не успевает, нажатия ждут места в очереди, а не копятся в памяти
+WRITE_BEHIND_QUEUE = int(os.getenv("WRITE_BEHIND_QUEUE", "1000"))
+
+FAVORITES = "favorites"
+COMPLETED = "completed"
+
+_MODELS = {FAVORITES: Favorite, COMPLETED: CompletedRoute}
+
+
+class UserState:
+    """Избранное и пройденные маршруты пользователя в памяти процесса."""
+    __slots__ = ("favorites", "completed")
+
+    def __init__(self, favorites: Set[int], completed: Set[int]):
+        self.favorites = favorites
+        self.completed = completed
+
+    def ids(self, kind: str) -> Set[int]:
+        return self.favorites if kind == FAVORITES else self.completed
+
+    def keyboard(self, route_id: int):
+        return route_keyboard(route_id, route_id in self.favorites, route_id in self.completed)
+
+
+class UserStateCache:
+    """LRU-кэш UserState. Состояние загружается из БД при первом обращении и дальше
+    меняется только через toggle(), поэтому совпадает с БД с точностью до очереди записи."""
+
+    def __init__(self, size: int = USER_STATE_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._states: "OrderedDict[int, UserState]" = OrderedDict()
+
+    def peek(self, user_id: int) -> UserState | None:
+        return self._states.get(user_id)
+
+    async def get(self, session, user_id: int) -> UserState:
+        state = self._states.get(user_id)
+        if state is not None:
+            self.hits += 1
+            self._states.move_to_end(user_id)
+            return state
+        self.misses += 1
+        fav_q = await session.execute(select(Favorite.route_id).where(Favorite.user_id == user_id))
+        comp_q = await session.execute(select(CompletedRoute.route_id).where(CompletedRoute.user_id == user_id))
+        state = UserState(set(fav_q.scalars().all()), set(comp_q.scalars().all()))
+        self._states[user_id] = state
+        if len(self._states) > self.size:
+            self._states.popitem(last=False)
+        return state
+
+    def invalidate(self, user_id: int) -> None:
+        self._states.pop(user_id, None)
+
+
+@dataclass
+class PendingWrite:
+    user_id: int
+    kind: str
+    route_id: int
+    value: bool
+    on_failure: Callable[[Exception], Awaitable[None]]
+
+
+class WriteBehind:
+    """Фоновая очередь записи переключателей. Записи применяются по одной в порядке поступления;
+    после WRITE_RETRIES неудачных попыток вызывается on_failure (откат состояния и клавиатуры).
+    В очереди не больше ``maxsize`` записей, submit() при заполненной очереди ждёт места."""
+
+    def __init__(self, retries: int = WRITE_RETRIES, maxsize: int = WRITE_BEHIND_QUEUE):
+        self.retries = retries
+        self.maxsize = maxsize
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, write: PendingWrite) -> None:
+        if self._task is None or self._task.done():
+            self._queue = self._queue or asyncio.Queue(self.maxsize)
+            # чистый контекст: иначе задача унаследует QueryStats и трассу апдейта, который её запустил
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+        await self._queue.put(write)
+
+    async def _run(self) -> None:
+        while True:
+            write = await self._queue.get()
+            try:
+                await self._apply_with_retries(write)
+            except Exception as e:
+                logger.exception("Failed to persist %s=%s for user %s route %s",
+                                 write.kind, write.value, write.user_id, write.route_id)
+                try:
+                    await write.on_failure(e)
+                except Exception:
+                    logger.exception("Rollback failed for user %s", write.user_id)
+            finally:
+                self._queue.task_done()
+
+    async def _apply_with_retries(self, write: PendingWrite) -> None:
+        for attempt in range(1, self.retries + 1):
+            try:
+                await self._apply(write)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+    @staticmethod
+    async def _apply(write: PendingWrite) -> None:
+        model = _MODELS[write.kind]
+        async with AsyncSessionLocal() as session:
+            if write.value:
+                existing = await session.execute(
+                    select(model.id).where(model.user_id == write.user_id, model.route_id == write.route_id)
+                )
+                if existing.first() is None:
+                    session.add(model(user_id=write.user_id, route_id=write.route_id))
+            else:
+                await session.execute(
+                    delete(model).where(model.user_id == write.user_id, model.route_id == write.route_id)
+                )
+            await session.commit()
+
+    async def close(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+        if self._task is not None:
+            self._task.cancel()
+
+
+user_states = UserStateCache()
+write_behind = WriteBehind()
+
+metrics.register_cache("user_states", lambda: (user_states.hits, user_states.misses))
+metrics.registry.callback("bot_write_behind_queue_depth", "Записи переключателей в очереди на запись в БД",
+                          write_behind.depth)
+
+
+async def toggle(callback: types.CallbackQuery, session, user_id: int, kind: str, route_id: int,
+                 value: bool, done_text: str, noop_text: str) -> None:
+    """Меняет кэш и ставит запись в БД в очередь, затем отвечает на нажатие и меняет клавиатуру по кэшу."""
+    state = await user_states.get(session, user_id)
+    ids = state.ids(kind)
+    if (route_id in ids) == value:
+        await callback.answer(noop_text)
+        return
+
+    def flip(to: bool, **extra) -> None:
+        collab.on_toggle(state.favorites, state.completed, route_id, ids, to)
+        event_log.emit("toggle", user_id, kind=kind, route_id=route_id, value=to, **extra)
+        (ids.add if to else ids.discard)(route_id)
+
+    async def rollback(error: Exception) -> None:
+        flip(not value, rollback=True)
+        await callback.message.edit_reply_markup(reply_markup=state.keyboard(route_id))
+
+    flip(value)
+    # запись ставится в очередь до обращений к Telegram: их ошибка не должна оставить кэш без записи в БД
+    try:
+        await write_behind.submit(PendingWrite(user_id, kind, route_id, value, rollback))
+    except BaseException:
+        # апдейт отменён, пока ждал места в очереди, — запись не поставлена, кэш возвращается к БД
+        flip(not value, rollback=True)
+        raise
+    await callback.answer(done_text)
+    await callback.message.edit_reply_markup(reply_markup=state.keyboard(route_id))
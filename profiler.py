@@ -0,0 +1,112 @@
+import os
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy import event
+
+import metrics
+from db import QueryStats, current_query_stats, engine
+
+logger = logging.getLogger(__name__)
+
+# off — выключен, log — предупреждение в лог, strict — исключение (для тестов и нагрузочных прогонов)
+PROFILER_MODE = os.getenv("PROFILER_MODE", "log")
+QUERY_BUDGET_DEFAULT = int(os.getenv("QUERY_BUDGET_DEFAULT", "12"))
+# одинаковый запрос с разными параметрами столько раз за апдейт считается N+1
+NPLUS1_MIN_REPEATS = int(os.getenv("NPLUS1_MIN_REPEATS", "3"))
+
+
+def _parse_budgets(raw: str) -> Dict[str, int]:
+    """QUERY_BUDGETS="handle_find_routes=8,handle_my_routes=8" -> {имя обработчика: лимит}"""
+    budgets = {}
+    for item in raw.split(","):
+        name, _, limit = item.strip().partition("=")
+        if name and limit:
+            budgets[name] = int(limit)
+    return budgets
+
+
+QUERY_BUDGETS = _parse_budgets(os.getenv("QUERY_BUDGETS", ""))
+
+budget_exceeded = metrics.registry.counter(
+    "bot_query_budget_exceeded_total", "Апдейты, превысившие бюджет SQL-запросов", ("handler",))
+nplus1_detected = metrics.registry.counter(
+    "bot_nplus1_detected_total", "Апдейты с повторяющимися запросами одной формы (N+1)", ("handler",))
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    stats = current_query_stats.get()
+    if stats is not None:
+        stats.statements.setdefault(statement, []).append(parameters)
+
+
+if PROFILER_MODE != "off":
+    event.listen(engine.sync_engine, "before_cursor_execute", _record_statement)
+
+
+def repeated_statements(stats: QueryStats, min_repeats: int = NPLUS1_MIN_REPEATS) -> List[Tuple[str, int]]:
+    """Запросы одной формы, выполненные не меньше ``min_repeats`` раз с разными параметрами."""
+    repeated = []
+    for statement, params in stats.statements.items():
+        if len(params) >= min_repeats and len({repr(p) for p in params}) >= min_repeats:
+            repeated.append((statement, len(params)))
+    return sorted(repeated, key=lambda item: -item[1])
+
+
+def _shorten(statement: str, limit: int = 160) -> str:
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit] + "..."
+
+
+def check(stats: QueryStats, update_id: Any = None, mode: str = PROFILER_MODE) -> None:
+    """Сверяет запросы апдейта с бюджетом обработчика и ищет N+1."""
+    budget = QUERY_BUDGETS.get(stats.handler, QUERY_BUDGET_DEFAULT)
+    repeated = repeated_statements(stats)
+    over_budget = stats.count > budget
+    if not over_budget and not repeated:
+        return
+
+    problems = []
+    if over_budget:
+        budget_exceeded.labels(stats.handler).inc()
+        problems.append(f"{stats.count} queries (budget {budget})")
+    if repeated:
+        nplus1_detected.labels(stats.handler).inc()
+        problems.extend(f"N+1: {count}x {_shorten(statement)}" for statement, count in repeated)
+    message = f"Update {update_id} in {stats.handler}: " + "; ".join(problems)
+    if mode == "strict":
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class QueryBudgetMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: привязывает запросы апдейта к обработчику и проверяет бюджет.
+
+    Запросы считает DbSessionMiddleware (QueryStats в current_query_stats), поэтому в бюджет
+    входит и выборка пользователя перед обработчиком.
+    """
+
+    def __init__(self, mode: str = PROFILER_MODE):
+        self.mode = mode
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        stats = data.get("query_stats")
+        if stats is None:
+            return await handler(event, data)
+        handler_object = data.get("handler")
+        stats.handler = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        result = await handler(event, data)
+        update = data.get("event_update")
+        check(stats, getattr(update, "update_id", None), self.mode)
+        return result
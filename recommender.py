@@ -1,14 +1,30 @@
+import os
+import heapq
 import logging
+from dataclasses import dataclass, fields
 from datetime import datetime
-from typing import List, Dict, Any
+from functools import lru_cache
+from time import perf_counter
+from typing import Callable, List, Dict, Any, Set, Tuple
 
-from sqlalchemy import select
-
-from db import AsyncSessionLocal
-from models import Route, route_tags, route_seasons, route_transports
+import collab
+from catalog import get_snapshot
+from metrics import recommender_seconds
+from scoring_plan import compile_plan, load_plan
+from similarity import route_features, similarity
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
+PairSimilarity = Callable[[Dict[str, Any], Dict[str, Any]], float]
+
+# баланс релевантности и разнообразия в выдаче: 1 — только оценка, 0 — только непохожесть на уже выбранные
+RERANK_LAMBDA = float(os.getenv("RERANK_LAMBDA", "0.5"))
+# из скольких лучших по оценке маршрутов выбирается выдача
+RERANK_POOL = int(os.getenv("RERANK_POOL", "50"))
+# какие маршруты пользователя не показывать в подборе: completed, favorites (через запятую)
+RERANK_EXCLUDE = {x.strip() for x in os.getenv("RERANK_EXCLUDE", "completed").split(",") if x.strip()}
+
 SEASONS_BY_MONTH = {
     1: "winter",
     2: "winter",
@@ -25,103 +41,138 @@ SEASONS_BY_MONTH = {
 }
 
 
-def score_route(route_row: Dict[str, Any], prefs: Dict[str, Any], current_season: str) -> float:
-    score = 0.0
-    debug = []
-
-    if current_season in route_row.get("seasons", []):
-        score += 3
-        debug.append("season_match_current(+3)")
-    if prefs.get("season") in route_row.get("seasons", []):
-        score += 1
-        debug.append("season_match_pref(+1)")
-
-    try:
-        pref_len = float(prefs.get("length_km", 0))
-        length = float(route_row.get("length_km") or 0)
-        add = max(0, 3 - abs(length - pref_len) / 20)
-        score += add
-        debug.append(f"length_diff({length}-{pref_len})(+{add:.2f})")
-    except Exception:
-        debug.append("length_skip")
-
-    try:
-        pref_price = float(prefs.get("price_estimate", 0))
-        price = float(route_row.get("price_estimate") or 0)
-        add = max(0, 3 - abs(price - pref_price) / 3000)
-        score += add
-        debug.append(f"price_diff({price}-{pref_price})(+{add:.2f})")
-    except Exception:
-        debug.append("price_skip")
-
-    if prefs.get("difficulty"):
-        if prefs["difficulty"] == route_row.get("difficulty"):
-            score += 2
-            debug.append("difficulty_match(+2)")
-        else:
-            debug.append("difficulty_mismatch")
-
-    try:
-        pref_pop = int(prefs.get("popularity", 0))
-        pop = int(route_row.get("popularity") or 0)
-        add = max(0, 2 - abs(pop - pref_pop) / 30)
-        score += add
-        debug.append(f"pop_diff({pop}-{pref_pop})(+{add:.2f})")
-    except Exception:
-        debug.append("pop_skip")
-
-    pref_trans = prefs.get("transport")
-    if pref_trans:
-        if pref_trans in route_row.get("transports", []):
-            score += 2
-            debug.append("transport_ok(+2)")
+def current_season() -> str:
+    return SEASONS_BY_MONTH[datetime.utcnow().month]
+
+
+@dataclass(frozen=True)
+class ScoringWeights:
+    """Коэффициенты оценки маршрута; значения по умолчанию — исходные. Набор на эксперимент — в experiments.py."""
+    current_season: float = 3      # маршрут подходит под текущий сезон
+    pref_season: float = 1         # под сезон из предпочтений
+    length: float = 3              # максимум за совпадение длины
+    length_scale: float = 20       # на столько км расхождения — минус балл
+    price: float = 3
+    price_scale: float = 3000      # руб
+    difficulty: float = 2
+    popularity: float = 2
+    popularity_scale: float = 30
+    transport: float = 2
+    tag: float = 2.5               # за каждый совпавший тег
+    tag_overlap: float = 2         # умножается на долю совпавших тегов из предпочтений
+    link: float = 0.5
+    collab: float = collab.COLLAB_WEIGHT
+    rerank_lambda: float = RERANK_LAMBDA
+
+
+# план оценки (scoring_plan.py) — проверяется здесь, при импорте, и не меняется до перезапуска
+PLAN = load_plan(weight_names=[f.name for f in fields(ScoringWeights)])
+
+
+def make_scorer(w: ScoringWeights) -> Callable[[Dict[str, Any], Dict[str, Any], str], float]:
+    """Функция оценки по плану PLAN с коэффициентами ``w`` (см. scoring_plan.py)."""
+    return compile_plan(PLAN, w, logger)
+
+
+@lru_cache(maxsize=32)
+def scorer_for(weights: ScoringWeights) -> Callable[[Dict[str, Any], Dict[str, Any], str], float]:
+    return make_scorer(weights)
+
+
+DEFAULT_WEIGHTS = ScoringWeights()
+score_route = scorer_for(DEFAULT_WEIGHTS)
+
+
+def top_routes(routes: List[Dict[str, Any]], prefs: Dict[str, Any], season: str,
+               limit: int) -> List[Tuple[float, Dict[str, Any]]]:
+    """Лучшие ``limit`` маршрутов без полной сортировки — для массовых подборов (рассылка)."""
+    score = score_route.prepare(prefs, season)
+    return heapq.nlargest(limit, ((score(r), r) for r in routes), key=lambda x: x[0])
+
+
+def excluded_ids(favorites: Set[int], completed: Set[int]) -> Set[int]:
+    """Маршруты пользователя, которые по RERANK_EXCLUDE не попадают в подбор."""
+    excluded = set()
+    if "completed" in RERANK_EXCLUDE:
+        excluded |= completed
+    if "favorites" in RERANK_EXCLUDE:
+        excluded |= favorites
+    return excluded
+
+
+def diversify(scored: List[Tuple[float, Dict[str, Any]]], limit: int, lambda_: float = RERANK_LAMBDA,
+              pair_similarity: PairSimilarity | None = None) -> List[Tuple[float, Dict[str, Any]]]:
+    """Жадный MMR по кандидатам, отсортированным по убыванию оценки.
+
+    На каждом шаге берётся кандидат с наибольшим lambda * оценка - (1 - lambda) * похожесть на уже
+    выбранные (оценка нормирована на лучшую). Максимальная похожесть каждого кандидата обновляется
+    после выбора, поэтому стоимость — O(limit * кандидатов) сравнений признаков.
+    ``pair_similarity(a, b)`` заменяет подсчёт похожести по признакам — например, кэшем по id при
+    массовом прогоне (evaluate.py).
+    """
+    if lambda_ >= 1 or len(scored) <= 1:
+        return scored[:limit]
+    best = scored[0][0] or 1.0
+    relevance = [lambda_ * s / best for s, _ in scored]
+    features = [route_features(r) for _, r in scored] if pair_similarity is None else None
+    closest = [0.0] * len(scored)
+    remaining = list(range(len(scored)))
+    chosen = []
+    while remaining and len(chosen) < limit:
+        pick = max(remaining, key=lambda i: relevance[i] - (1 - lambda_) * closest[i])
+        remaining.remove(pick)
+        chosen.append(scored[pick])
+        if features is not None:
+            for i in remaining:
+                closest[i] = max(closest[i], similarity(features[pick], features[i]))
         else:
-            debug.append("transport_no")
-
-    route_tags_set = set(route_row.get("tags", []))
-    prefs_tags = set(prefs.get("tags", []))
-    match_count = len(route_tags_set & prefs_tags)
-    score += match_count * 2.5
-    debug.append(f"tags_matched({match_count})*(+{match_count * 2.5:.2f})")
-    if prefs_tags:
-        overlap_ratio = len(route_tags_set & prefs_tags) / len(prefs_tags)
-        add = overlap_ratio * 2
-        score += add
-        debug.append(f"tags_overlap_ratio({overlap_ratio:.2f})(+{add:.2f})")
-
-    if route_row.get("link"):
-        score += 0.5
-        debug.append("has_link(+0.5)")
-
-    logger.debug("SCORE DEBUG for '%s' : score=%.3f | %s", route_row.get("title"), score, "; ".join(debug))
-    return score
-
-
-async def fetch_routes_with_meta(session) -> List[Dict[str, Any]]:
-    q = await session.execute(select(Route))
-    routes = q.scalars().all()
-    result = []
-    for r in routes:
-        tags_q = await session.execute(select(route_tags.c.tag).where(route_tags.c.route_id == r.id))
-        seasons_q = await session.execute(select(route_seasons.c.season).where(route_seasons.c.route_id == r.id))
-        transports_q = await session.execute(
-            select(route_transports.c.transport).where(route_transports.c.route_id == r.id))
-        d = r.to_dict()
-        d.update(
-            {
-                "tags": [t[0] for t in tags_q.all()],
-                "seasons": [s[0] for s in seasons_q.all()],
-                "transports": [t[0] for t in transports_q.all()],
-            }
-        )
-        result.append(d)
-    return result
-
-
-async def recommend_routes(session, prefs: Dict[str, Any], limit: int = 10):
-    current_season = SEASONS_BY_MONTH[datetime.utcnow().month]
-    routes = await fetch_routes_with_meta(session)
-    scored = sorted([(score_route(r, prefs, current_season), r) for r in routes], key=lambda x: x[0], reverse=True)
-    top = [{"score": round(s, 3), "route": r} for s, r in scored[:limit]]
+            for i in remaining:
+                closest[i] = max(closest[i], pair_similarity(scored[pick][1], scored[i][1]))
+    return chosen
+
+
+def score_routes(routes: List[Dict[str, Any]], prefs: Dict[str, Any], season: str,
+                 score: Callable[[Dict[str, Any], Dict[str, Any], str], float] = score_route,
+                 related: Dict[int, float] | None = None,
+                 collab_weight: float = 0.0) -> List[Tuple[float, Dict[str, Any]]]:
+    """Оценки маршрутов; ``related`` — коллаборативная похожесть по id (collab.index.scores).
+    У скомпилированного плана предпочтения разбираются один раз (``score.prepare``), а не на каждый маршрут."""
+    prepare = getattr(score, "prepare", None)
+    if prepare is not None:
+        route_score = prepare(prefs, season)
+    else:
+        def route_score(route: Dict[str, Any]) -> float:
+            return score(route, prefs, season)
+    if related:
+        return [(route_score(r) + collab_weight * related.get(r["id"], 0.0), r) for r in routes]
+    return [(route_score(r), r) for r in routes]
+
+
+def select_top(scored: List[Tuple[float, Dict[str, Any]]], limit: int, lambda_: float = RERANK_LAMBDA,
+               pair_similarity: PairSimilarity | None = None) -> List[Tuple[float, Dict[str, Any]]]:
+    """Выдача из оценённых маршрутов: RERANK_POOL лучших, из них ``limit`` с учётом разнообразия."""
+    pool = heapq.nlargest(max(RERANK_POOL, limit), scored, key=lambda x: x[0])
+    return diversify(pool, limit, lambda_, pair_similarity)
+
+
+async def recommend_routes(session, prefs: Dict[str, Any], limit: int = 10, interacted: Set[int] | None = None,
+                           exclude: Set[int] | None = None, weights: ScoringWeights = DEFAULT_WEIGHTS):
+    """Подбор по предпочтениям; ``interacted`` (избранные и пройденные id) добавляет к оценке
+    коллаборативную составляющую — похожесть маршрута на них по поведению других пользователей.
+    Маршруты из ``exclude`` не оцениваются; из лучших RERANK_POOL выдача собирается с учётом разнообразия.
+    ``weights`` — коэффициенты (набор группы эксперимента)."""
+    score_route = scorer_for(weights)
+    season = current_season()
+    with span("recommender.snapshot"):
+        routes = (await get_snapshot(session)).routes
+    if exclude:
+        routes = [r for r in routes if r["id"] not in exclude]
+    started = perf_counter()
+    with span("recommender.score", routes=len(routes)):
+        related = collab.index.scores(interacted) if interacted and weights.collab else None
+        scored = score_routes(routes, prefs, season, score_route, related, weights.collab)
+    with span("recommender.rank"):
+        top = [{"score": round(s, 3), "route": r} for s, r in select_top(scored, limit, weights.rerank_lambda)]
+    recommender_seconds.observe(perf_counter() - started)
     logger.info("Top %s recommendations generated (prefs=%s).", limit, prefs)
     return top
@@ -5,11 +5,11 @@ import asyncio
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format="%(asctime)s | %(levelname)-5s | %(name)s | %(message)s",
-)
+import logsetup
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WORKERS = int(os.getenv("WORKERS", "1"))
+logsetup.setup_logging()
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8169988545:AAEk8jMumU9Lt2r4eXAn_iCp-4hSZe5YkLs")
@@ -17,31 +17,125 @@ if not BOT_TOKEN:
     logger.error("BOT_TOKEN not provided. Set environment variable BOT_TOKEN.")
     raise SystemExit(1)
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher()
-
+import admin
+import broadcast
+import catalog
+import collab
 import db
+import events
 import handlers
+import metrics
+import monitor
+import optimistic
+import profiler
+import similarity
+import tracing
+from admission import AdmissionMiddleware
+from middlewares import DbSessionMiddleware, UserLockMiddleware
 
-dp.include_router(handlers.router)
-
-handlers.bot = bot
-handlers.dp = dp
 
-@dp.startup.register
-async def on_startup():
+async def on_startup(bot: Bot, worker: int | None = None):
     logger.info("Starting bot...")
-    await db.init_db_and_seed()
+    # при WORKERS > 1 схему и сидирование делает супервизор, а рассылку ведёт только воркер 0;
+    # кэши и их фоновое обновление нужны каждому процессу
+    if worker is None:
+        await db.init_db_and_seed()
+    catalog.preload()
+    catalog.start()
+    similarity.preload()
+    collab.start()
+    events.event_log.start()
+    if monitor.ENABLED:
+        monitor.monitor.start()
+    if broadcast.BROADCAST_DIGEST and not worker:
+        broadcast.start(bot)
     logger.info("Bot started, DB ready.")
 
-@dp.shutdown.register
-async def on_shutdown():
+
+async def on_shutdown(bot: Bot):
     logger.info("Shutting down bot...")
+    await monitor.monitor.stop()
+    await events.event_log.stop()
+    await broadcast.stop()
+    await collab.stop()
+    await catalog.stop()
+    await optimistic.write_behind.close()
+    await tracing.exporter.close()
     await bot.session.close()
 
 
+def create_bot() -> Bot:
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    bot.session.middleware(metrics.TelegramApiMetricsMiddleware())
+    bot.session.middleware(monitor.OutboundCallsMiddleware())
+    if tracing.ENABLED:
+        bot.session.middleware(tracing.TelegramTracingMiddleware())
+    return bot
+
+
+def create_dispatcher(bot: Bot) -> Dispatcher:
+    """Собирает диспетчер. Вызывается один раз на процесс: роутер handlers можно подключить только однажды."""
+    dp = Dispatcher()
+    user_lock = UserLockMiddleware()
+    admission = AdmissionMiddleware()
+    # порядок важен: сначала очередь пользователя (сохраняет порядок его апдейтов),
+    # затем допуск по приоритету, и только потом сессия БД; трасса и самописец охватывают всё
+    if tracing.ENABLED:
+        dp.update.outer_middleware(tracing.TracingMiddleware())
+    dp.update.outer_middleware(monitor.FlightRecorderMiddleware())
+    dp.update.outer_middleware(user_lock)
+    dp.update.outer_middleware(admission)
+    dp.update.outer_middleware(DbSessionMiddleware())
+    handler_metrics = metrics.HandlerMetricsMiddleware()
+    query_budget = profiler.QueryBudgetMiddleware() if profiler.PROFILER_MODE != "off" else None
+    handler_span = tracing.HandlerSpanMiddleware() if tracing.ENABLED else None
+    for observer in (handlers.router.message, handlers.router.callback_query, handlers.router.inline_query):
+        observer.middleware(handler_metrics)
+        if query_budget is not None:
+            observer.middleware(query_budget)
+        if handler_span is not None:
+            observer.middleware(handler_span)
+    # служебные команды раньше handlers.router: в нём есть обработчик всех текстовых сообщений
+    dp.include_router(admin.router)
+    dp.include_router(handlers.router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    handlers.bot = bot
+    handlers.dp = dp
+
+    metrics.registry.callback("bot_admission_queue_depth", "Апдейты, ожидающие допуска, по приоритету",
+                              admission.controller.depths, "priority")
+    metrics.registry.callback("bot_admission_running", "Апдейты, выполняющиеся сейчас",
+                              lambda: admission.controller.running)
+    metrics.registry.callback("bot_admission_shed_total", "Апдейты, отброшенные допуском, по приоритету",
+                              lambda: {p.name.lower(): n for p, n in admission.controller.shed_count.items()},
+                              "priority", kind="counter")
+    metrics.registry.callback("bot_user_queues", "Пользователи с выполняющимися или ожидающими апдейтами",
+                              lambda: len(user_lock.locks))
+    metrics.registry.callback("bot_log_dropped_total", "Записи лога, отброшенные лимитами, сэмплированием или "
+                              "переполнением очереди", logsetup.dropped, "logger", kind="counter")
+    return dp
+
+
 async def main():
-    await dp.start_polling(bot)
+    if WORKERS > 1:
+        import workers
+        await workers.run_supervisor(WORKERS, BOT_MODE)
+        return
+
+    bot = create_bot()
+    dp = create_dispatcher(bot)
+    if BOT_MODE == "webhook":
+        import webhook
+        await webhook.run_webhook(bot, dp)
+    else:
+        runner = await metrics.start_server() if metrics.METRICS_PORT else None
+        try:
+            await dp.start_polling(bot)
+        finally:
+            if runner is not None:
+                await runner.cleanup()
 
 
 if __name__ == "__main__":
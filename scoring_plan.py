@@ -0,0 +1,297 @@
+"""Декларативный план оценки маршрута и его компиляция в функцию.
+
+План — JSON-объект со списком слагаемых "terms". Виды слагаемых:
+- contains — значение предпочтения ("pref") есть в списке маршрута ("route"): +weight;
+  "pref": "$season" — текущий сезон;
+- equals — поле маршрута совпадает с предпочтением: +weight;
+- closeness — max(0, weight − |маршрут − предпочтение| / divisor) для чисел ("cast": "int" — как целые);
+- shared — weight за каждый общий элемент списков маршрута и предпочтения;
+- shared_ratio — weight × доля элементов предпочтения, найденных у маршрута;
+- present — поле маршрута заполнено: +weight.
+Незаданное предпочтение слагаемое пропускает (closeness считает его нулём). "cap" ограничивает вклад
+слагаемого сверху. Числа weight, divisor и cap задаются числом или именем поля ScoringWeights, тогда значение
+берётся из коэффициентов варианта эксперимента. "name" — подпись в DEBUG-логе оценки.
+
+План берётся из SCORING_PLAN (JSON-файл) или встроенный DEFAULT_PLAN. Он проверяется при импорте recommender,
+ошибка останавливает запуск. Для каждого набора коэффициентов план один раз компилируется в исходный код
+функции. Константы подставлены, пересечение тегов считается один раз на маршрут. Разбор предпочтений вынесен
+в ``prepare(prefs, season)``, которым пользуется score_routes. Сверка со старой ручной функцией оценки и замер
+скорости — tests/test_scoring_plan.py.
+
+    python scoring_plan.py dump             # встроенный план в JSON — основа для своего файла
+    python scoring_plan.py source [план]    # сгенерированный код
+"""
+import os
+import sys
+import json
+import hashlib
+import logging
+import linecache
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# JSON-файл плана оценки; пусто — встроенный DEFAULT_PLAN
+SCORING_PLAN = os.getenv("SCORING_PLAN", "")
+
+DEFAULT_PLAN: Dict[str, Any] = {"terms": [
+    {"name": "season_match_current", "kind": "contains", "route": "seasons", "pref": "$season",
+     "weight": "current_season"},
+    {"name": "season_match_pref", "kind": "contains", "route": "seasons", "pref": "season", "weight": "pref_season"},
+    {"name": "length_diff", "kind": "closeness", "route": "length_km", "pref": "length_km",
+     "weight": "length", "divisor": "length_scale"},
+    {"name": "price_diff", "kind": "closeness", "route": "price_estimate", "pref": "price_estimate",
+     "weight": "price", "divisor": "price_scale"},
+    {"name": "difficulty_match", "kind": "equals", "route": "difficulty", "pref": "difficulty", "weight": "difficulty"},
+    {"name": "pop_diff", "kind": "closeness", "route": "popularity", "pref": "popularity", "cast": "int",
+     "weight": "popularity", "divisor": "popularity_scale"},
+    {"name": "transport_ok", "kind": "contains", "route": "transports", "pref": "transport", "weight": "transport"},
+    {"name": "tags_matched", "kind": "shared", "route": "tags", "pref": "tags", "weight": "tag"},
+    {"name": "tags_overlap_ratio", "kind": "shared_ratio", "route": "tags", "pref": "tags", "weight": "tag_overlap"},
+    {"name": "has_link", "kind": "present", "route": "link", "weight": "link"},
+]}
+
+# вид слагаемого -> обязательные поля, кроме kind и weight
+KINDS = {
+    "contains": ("route", "pref"),
+    "equals": ("route", "pref"),
+    "closeness": ("route", "pref", "divisor"),
+    "shared": ("route", "pref"),
+    "shared_ratio": ("route", "pref"),
+    "present": ("route",),
+}
+CAPPED = ("closeness", "shared", "shared_ratio")
+TERM_KEYS = {"kind", "name", "route", "pref", "weight", "divisor", "cap", "cast"}
+NUMBERS = ("weight", "divisor", "cap")
+
+Scorer = Callable[[Dict[str, Any], Dict[str, Any], str], float]
+
+
+def validate(plan: Any, weight_names: Iterable[str] = ()) -> List[Dict[str, Any]]:
+    """Проверяет план; возвращает его слагаемые. ValueError с номером слагаемого при ошибке."""
+    weight_names = set(weight_names)
+    terms = plan.get("terms") if isinstance(plan, dict) else None
+    if not isinstance(terms, list) or not terms:
+        raise ValueError('plan must be an object with a non-empty "terms" list')
+    for n, term in enumerate(terms, start=1):
+        if not isinstance(term, dict):
+            raise ValueError(f"term #{n}: must be an object")
+        kind = term.get("kind")
+        if kind not in KINDS:
+            raise ValueError(f"term #{n}: unknown kind {kind!r}, expected one of {', '.join(KINDS)}")
+        unknown = set(term) - TERM_KEYS
+        if unknown:
+            raise ValueError(f"term #{n}: unknown keys {sorted(unknown)}")
+        for key in KINDS[kind] + ("weight",):
+            if key not in term:
+                raise ValueError(f"term #{n}: {kind} needs {key!r}")
+        for key in ("route", "pref", "name"):
+            if key in term and (not isinstance(term[key], str) or not term[key]):
+                raise ValueError(f"term #{n}: {key} must be a non-empty string")
+        if term.get("pref") == "$season" and kind not in ("contains", "equals"):
+            raise ValueError(f"term #{n}: $season works only in contains and equals")
+        for key in NUMBERS:
+            value = term.get(key)
+            if value is None:
+                continue
+            if isinstance(value, str):
+                if value not in weight_names:
+                    raise ValueError(f"term #{n}: {key} refers to unknown weight {value!r}")
+            elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"term #{n}: {key} must be a number or a weight name")
+        if "divisor" in term and kind != "closeness":
+            raise ValueError(f"term #{n}: divisor is only for closeness")
+        if term.get("divisor") == 0:
+            raise ValueError(f"term #{n}: divisor must not be zero")
+        if "cap" in term and kind not in CAPPED:
+            raise ValueError(f"term #{n}: cap is only for {', '.join(CAPPED)}")
+        if "cast" in term and (kind != "closeness" or term["cast"] not in ("float", "int")):
+            raise ValueError(f"term #{n}: cast is float or int and only for closeness")
+    return terms
+
+
+def load_plan(path: str = SCORING_PLAN, weight_names: Iterable[str] = ()) -> Dict[str, Any]:
+    """План из файла ``path`` (пусто — DEFAULT_PLAN), проверенный validate."""
+    if not path:
+        validate(DEFAULT_PLAN, weight_names)
+        return DEFAULT_PLAN
+    with open(path, encoding="utf-8") as f:
+        plan = json.load(f)
+    validate(plan, weight_names)
+    logger.info("Scoring plan loaded from %s: %s terms", path, len(plan["terms"]))
+    return plan
+
+
+class _Codegen:
+    """Исходный код оценщика: строки разбора предпочтений (один раз на подбор) и строки оценки маршрута."""
+
+    def __init__(self, terms: List[Dict[str, Any]], weights: Any):
+        self.terms = terms
+        self.weights = weights
+        self.prefs: List[str] = []
+        self.names: Dict[tuple, str] = {}
+
+    def number(self, term: Dict[str, Any], key: str) -> str:
+        value = term[key]
+        if isinstance(value, str):
+            value = getattr(self.weights, value)
+        if key == "divisor" and value == 0:
+            raise ValueError(f"term {term.get('name', term['kind'])}: divisor resolves to zero")
+        return repr(value)
+
+    def _var(self, key: tuple, lines: Callable[[str], List[str]]) -> str:
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = f"p{len(self.names)}"
+            self.prefs.extend(lines(name))
+        return name
+
+    def pref(self, term: Dict[str, Any]) -> str:
+        pref = term["pref"]
+        if pref == "$season":
+            return "current_season"
+        if term["kind"] == "closeness":
+            cast = term.get("cast", "float")
+            return self._var(("number", pref, cast), lambda v: [
+                "try:", f"    {v} = {cast}(prefs.get({pref!r}, 0))", "except Exception:", f"    {v} = None"])
+        if term["kind"] in ("shared", "shared_ratio"):
+            return self._var(("set", pref), lambda v: [f"{v} = set(prefs.get({pref!r}) or ())"])
+        return self._var(("value", pref), lambda v: [f"{v} = prefs.get({pref!r})"])
+
+    def route(self, explain: bool) -> List[str]:
+        lines: List[str] = []
+        local: Dict[tuple, str] = {}
+
+        def once(key: tuple, expr: str) -> str:
+            if key not in local:
+                local[key] = f"r{len(local)}"
+                lines.append(f"{local[key]} = {expr}")
+            return local[key]
+
+        def add(term: Dict[str, Any], value: str, body: List[str], label: str) -> None:
+            """``body`` вычисляет вклад в add (или пусто для константы ``value``)."""
+            if "cap" in term:
+                body = body + [f"if add > {self.number(term, 'cap')}:", f"    add = {self.number(term, 'cap')}"]
+            lines.extend(body)
+            lines.append(f"total += {value}")
+            if explain:
+                lines.append(f"parts.append({label})")
+
+        for term in self.terms:
+            kind, field = term["kind"], term["route"]
+            name = term.get("name", f"{kind}:{field}")
+            weight = self.number(term, "weight")
+            const_label = repr(f"{name}(+{weight})")
+            if kind == "contains":
+                pref = self.pref(term)
+                values = once(("list", field), f"route_row.get({field!r}) or ()")
+                guard = f"{pref} in {values}" if pref == "current_season" else f"{pref} and {pref} in {values}"
+                lines.append(f"if {guard}:")
+                self._nested(lines, lambda: add(term, weight, [], const_label))
+            elif kind == "equals":
+                pref = self.pref(term)
+                lines.append(f"if {pref} and {pref} == route_row.get({field!r}):")
+                self._nested(lines, lambda: add(term, weight, [], const_label))
+            elif kind == "closeness":
+                pref = self.pref(term)
+                cast = term.get("cast", "float")
+                divisor = self.number(term, "divisor")
+                lines.extend([
+                    f"if {pref} is not None:",
+                    "    try:",
+                    f"        add = {weight} - abs({cast}(route_row.get({field!r}) or 0) - {pref}) / {divisor}",
+                    "    except Exception:",
+                    "        add = 0",
+                    "    if add > 0:",
+                ])
+                self._nested(lines, lambda: add(term, "add", [], f"f'{name}(+{{add:.2f}})'"), depth=2)
+            elif kind in ("shared", "shared_ratio"):
+                pref = self.pref(term)
+                count = once(("shared", field, pref), f"len({pref}.intersection(route_row.get({field!r}) or ()))")
+                if kind == "shared":
+                    lines.append(f"if {count}:")
+                    body = [f"add = {count} * {weight}"]
+                else:
+                    size = self._var(("len", pref), lambda v: [f"{v} = len({pref})"])
+                    lines.append(f"if {count}:")
+                    body = [f"add = {count} / {size} * {weight}"]
+                self._nested(lines, lambda: add(term, "add", body, f"f'{name}(+{{add:.2f}})'"))
+            else:
+                lines.append(f"if route_row.get({field!r}):")
+                self._nested(lines, lambda: add(term, weight, [], const_label))
+        return lines
+
+    @staticmethod
+    def _nested(lines: List[str], emit: Callable[[], None], depth: int = 1) -> None:
+        start = len(lines)
+        emit()
+        lines[start:] = ["    " * depth + line for line in lines[start:]]
+
+    def source(self) -> str:
+        fast, explained = self.route(explain=False), self.route(explain=True)
+        prefs = self.prefs
+
+        def block(lines: List[str], depth: int) -> str:
+            return "".join("    " * depth + line + "\n" for line in lines)
+
+        return (
+            "def score(route_row, prefs, current_season):\n"
+            "    if _explain():\n"
+            "        return score_explained(route_row, prefs, current_season)\n"
+            + block(prefs, 1)
+            + "    total = 0.0\n"
+            + block(fast, 1)
+            + "    return total\n\n\n"
+            "def prepare(prefs, current_season):\n"
+            "    if _explain():\n"
+            "        return partial(score_explained, prefs=prefs, current_season=current_season)\n"
+            + block(prefs, 1)
+            + "\n    def route_score(route_row):\n"
+            "        total = 0.0\n"
+            + block(fast, 2)
+            + "        return total\n"
+            "    return route_score\n\n\n"
+            "def score_explained(route_row, prefs, current_season):\n"
+            "    parts = []\n"
+            + block(prefs, 1)
+            + "    total = 0.0\n"
+            + block(explained, 1)
+            + "    _log.debug(\"SCORE DEBUG for '%s' : score=%.3f | %s\", route_row.get('title'), total, "
+            "'; '.join(parts))\n"
+            "    return total\n"
+        )
+
+
+def compile_plan(plan: Dict[str, Any], weights: Any, log: logging.Logger = logger) -> Scorer:
+    """Оценщик ``score(route, prefs, season)`` по плану с коэффициентами ``weights``.
+
+    У функции есть ``prepare(prefs, season)`` — оценщик одного маршрута с уже разобранными предпочтениями —
+    и ``source`` с сгенерированным кодом. При DEBUG у ``log`` оценка расписывается по слагаемым.
+    """
+    source = _Codegen(plan["terms"], weights).source()
+    filename = f"<scoring plan {hashlib.sha1(source.encode()).hexdigest()[:12]}>"
+    # исходник в linecache — в трейсбеках видны строки сгенерированного кода
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    namespace: Dict[str, Any] = {"_explain": partial(log.isEnabledFor, logging.DEBUG), "_log": log,
+                                 "partial": partial}
+    exec(compile(source, filename, "exec"), namespace)
+    scorer = namespace["score"]
+    scorer.prepare = namespace["prepare"]
+    scorer.source = source
+    return scorer
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "dump":
+        print(json.dumps(DEFAULT_PLAN, ensure_ascii=False, indent=2))
+    elif command == "source":
+        from dataclasses import fields
+        from recommender import DEFAULT_WEIGHTS
+        plan = load_plan(sys.argv[2], [f.name for f in fields(DEFAULT_WEIGHTS)]) if len(sys.argv) > 2 \
+            else DEFAULT_PLAN
+        print(compile_plan(plan, DEFAULT_WEIGHTS).source)
+    else:
+        print(__doc__)
+        sys.exit(2)
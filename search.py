@@ -0,0 +1,158 @@
+import os
+import re
+import difflib
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Set
+
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
+
+import catalog
+import metrics
+from catalog import CatalogSnapshot, get_snapshot
+from utils import route_card
+
+logger = logging.getLogger(__name__)
+
+INLINE_RESULTS_LIMIT = int(os.getenv("INLINE_RESULTS_LIMIT", "20"))
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "2000"))
+
+# русские названия тегов каталога, чтобы находить маршруты по «природа», «горы» и т.п.
+TAG_SYNONYMS = {
+    "nature": ["природа"],
+    "family": ["семейное", "семья"],
+    "hiking": ["походы", "прогулки"],
+    "trekking": ["треккинг", "походы"],
+    "adventure": ["приключение"],
+    "culture": ["культура"],
+    "city": ["город"],
+    "history": ["история"],
+    "food": ["еда"],
+    "archaeology": ["археология", "курганы"],
+    "religion": ["религия"],
+    "spiritual": ["святыни"],
+    "hot_springs": ["источники"],
+    "photography": ["фото"],
+    "wildlife": ["животные"],
+    "rafting": ["сплав", "рафтинг"],
+    "sport": ["спорт"],
+    "desert": ["пустыня"],
+    "panorama": ["панорама"],
+    "waterfalls": ["водопады"],
+    "mountains": ["горы"],
+    "steppe": ["степь"],
+}
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text: str) -> List[str]:
+    return _WORD.findall((text or "").lower().replace("ё", "е"))
+
+
+class RouteIndex:
+    """Индекс каталога для inline-поиска: префиксы слов названий и тегов -> id маршрутов.
+
+    Готовые InlineQueryResultArticle строятся один раз при создании индекса.
+    """
+
+    def __init__(self, snapshot: CatalogSnapshot):
+        self.snapshot = snapshot
+        self._prefixes: Dict[str, Set[int]] = defaultdict(set)
+        words = set()
+        for route in snapshot.routes:
+            route_words = normalize(route["title"])
+            for tag in route.get("tags", []):
+                route_words += normalize(tag.replace("_", " ")) + TAG_SYNONYMS.get(tag, [])
+            for word in route_words:
+                words.add(word)
+                for i in range(1, len(word) + 1):
+                    self._prefixes[word[:i]].add(route["id"])
+        self._vocab = sorted(words)
+        self._popular = [r["id"] for r in sorted(snapshot.routes, key=lambda r: -(r.get("popularity") or 0))]
+        self.results = {r["id"]: self._build_result(r) for r in snapshot.routes}
+
+    @staticmethod
+    def _build_result(route: dict) -> InlineQueryResultArticle:
+        return InlineQueryResultArticle(
+            id=str(route["id"]),
+            title=route["title"],
+            description=f"{route.get('length_km')} км · {route.get('difficulty')} · {route.get('price_estimate')} руб",
+            input_message_content=InputTextMessageContent(message_text=route_card(route), parse_mode="HTML"),
+        )
+
+    def _match(self, token: str) -> Set[int]:
+        ids = self._prefixes.get(token)
+        if ids:
+            return ids
+        fuzzy = set()
+        for word in difflib.get_close_matches(token, self._vocab, n=3, cutoff=0.7):
+            fuzzy |= self._prefixes[word]
+        return fuzzy
+
+    def search(self, query: str, limit: int = INLINE_RESULTS_LIMIT) -> List[int]:
+        tokens = normalize(query)
+        if not tokens:
+            return self._popular[:limit]
+        matched = None
+        for token in tokens:
+            ids = self._match(token)
+            matched = set(ids) if matched is None else matched & ids
+            if not matched:
+                return []
+        return [route_id for route_id in self._popular if route_id in matched][:limit]
+
+
+class AnswerCache:
+    """LRU-кэш готовых ответов по нормализованной строке запроса."""
+
+    def __init__(self, size: int = INLINE_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, list]" = OrderedDict()
+
+    def get(self, key: str):
+        results = self._items.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return results
+
+    def put(self, key: str, results: list) -> None:
+        self._items[key] = results
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+_index: RouteIndex | None = None
+answer_cache = AnswerCache()
+
+metrics.register_cache("inline_answers", lambda: (answer_cache.hits, answer_cache.misses))
+
+
+def get_index(snapshot: CatalogSnapshot) -> RouteIndex:
+    global _index
+    if _index is None or _index.snapshot is not snapshot:
+        _index = RouteIndex(snapshot)
+        answer_cache.clear()
+    return _index
+
+
+# новый индекс строится в момент подмены снимка, а не первым запросом после неё
+catalog.on_swap(get_index)
+
+
+async def search_routes(query: str) -> List[InlineQueryResultArticle]:
+    index = get_index(await get_snapshot())
+    key = " ".join(normalize(query))
+    results = answer_cache.get(key)
+    if results is None:
+        results = [index.results[route_id] for route_id in index.search(key)]
+        answer_cache.put(key, results)
+    return results
@@ -0,0 +1,256 @@
+import os
+import sys
+import re
+import math
+import heapq
+import asyncio
+import logging
+from typing import Any, Dict, List, Set, Tuple
+
+from sqlalchemy import delete, insert, select
+
+import catalog
+from db import AsyncSessionLocal, read_meta, set_meta
+from models import RouteNeighbor
+
+logger = logging.getLogger(__name__)
+
+# сколько похожих маршрутов хранить и показывать
+SIMILAR_K = int(os.getenv("SIMILAR_K", "5"))
+
+DIFFICULTY_LEVELS = {"легко": 0, "средне": 1, "сложно": 2, "варьируется": 1}
+WEIGHTS = {"tags": 0.25, "title": 0.3, "seasons": 0.1, "transports": 0.1, "difficulty": 0.1, "length": 0.1,
+           "price": 0.05}
+# меняется вместе с признаками или весами — сохранённая таблица тогда пересобирается
+FEATURES_VERSION = 2
+_WORD = re.compile(r"\w{4,}")
+_ENDING = re.compile(r"[аеёиоуыэюяй]+$")
+
+Neighbors = List[Tuple[int, float]]
+
+
+def _stem(word: str) -> str:
+    return _ENDING.sub("", word) or word
+
+
+# слова, которые есть в названиях многих маршрутов и не говорят о месте: общая точка старта, вид маршрута
+TITLE_STOPWORDS = frozenset(_stem(w) for w in ("кызыл", "треккинг", "гора", "через", "пешая", "часть", "гидом"))
+
+
+def title_words(title: str) -> frozenset:
+    """Значимые слова названия без гласных окончаний: «Кызыл — гора Догээ» и «Треккинг на гору Догээ»
+    дают одно и то же {"дог"}."""
+    return frozenset(_stem(word) for word in _WORD.findall((title or "").lower())) - TITLE_STOPWORDS
+
+
+def route_features(route: Dict[str, Any]) -> Tuple:
+    return (
+        frozenset(route.get("tags") or ()),
+        frozenset(route.get("seasons") or ()),
+        frozenset(route.get("transports") or ()),
+        DIFFICULTY_LEVELS.get(route.get("difficulty"), 1),
+        math.log1p(route.get("length_km") or 0),
+        # цена в сотнях рублей: бесплатный маршрут и маршрут за 500 ₽ не должны быть противоположностями
+        math.log1p((route.get("price_estimate") or 0) / 100),
+        title_words(route.get("title")),
+    )
+
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def similarity(a: Tuple, b: Tuple) -> float:
+    """Похожесть двух маршрутов по признакам из route_features, 0..1."""
+    return (
+        WEIGHTS["tags"] * _jaccard(a[0], b[0])
+        + WEIGHTS["seasons"] * _jaccard(a[1], b[1])
+        + WEIGHTS["transports"] * _jaccard(a[2], b[2])
+        + WEIGHTS["title"] * _jaccard(a[6], b[6])
+        + WEIGHTS["difficulty"] * (1 - abs(a[3] - b[3]) / 2)
+        # длина и цена — по отношению величин: 10 и 20 км так же далеки, как 50 и 100
+        + WEIGHTS["length"] * math.exp(-abs(a[4] - b[4]))
+        + WEIGHTS["price"] * math.exp(-abs(a[5] - b[5]))
+    )
+
+
+class SimilarityTable:
+    """Top-K соседей каждого маршрута.
+
+    Полная сборка — O(N²) сравнений; при изменении одного маршрута пересчитывается его строка и строки,
+    где он был соседом, а в остальные он только вставляется, если обходит K-го соседа — O(N) сравнений
+    плюс O(N) на каждую затронутую строку.
+    """
+
+    def __init__(self, k: int = SIMILAR_K):
+        self.k = k
+        self.features: Dict[int, Tuple] = {}
+        self.rows: Dict[int, Neighbors] = {}
+
+    def _row(self, route_id: int) -> Neighbors:
+        own = self.features[route_id]
+        return heapq.nlargest(self.k, ((other, round(similarity(own, features), 4))
+                                       for other, features in self.features.items() if other != route_id),
+                              key=lambda item: (item[1], -item[0]))
+
+    def build(self, routes: List[Dict[str, Any]]) -> None:
+        self.features = {r["id"]: route_features(r) for r in routes}
+        self.rows = {route_id: self._row(route_id) for route_id in self.features}
+
+    def apply_change(self, route_id: int, route: Dict[str, Any] | None) -> Set[int]:
+        """Маршрут добавлен или изменён (route) либо удалён (None); возвращает id изменившихся строк."""
+        changed = {route_id}
+        if route is None:
+            self.features.pop(route_id, None)
+            self.rows.pop(route_id, None)
+        else:
+            self.features[route_id] = route_features(route)
+            self.rows[route_id] = self._row(route_id)
+        for other, row in self.rows.items():
+            if other == route_id:
+                continue
+            if any(neighbor == route_id for neighbor, _ in row):
+                # оценка соседа изменилась или он исчез — строку пересчитываем целиком
+                self.rows[other] = self._row(other)
+                changed.add(other)
+            elif route is not None:
+                score = round(similarity(self.features[other], self.features[route_id]), 4)
+                if len(row) < self.k or (score, -route_id) > (row[-1][1], -row[-1][0]):
+                    self.rows[other] = sorted(row + [(route_id, score)],
+                                              key=lambda item: (-item[1], item[0]))[:self.k]
+                    changed.add(other)
+        return changed
+
+
+async def save_rows(session, table: SimilarityTable, route_ids: Set[int] | None = None) -> None:
+    """Перезаписывает в route_neighbors строки ``route_ids`` (все, если None)."""
+    ids = set(table.rows) if route_ids is None else set(route_ids)
+    if route_ids is None:
+        await session.execute(delete(RouteNeighbor))
+    elif ids:
+        await session.execute(delete(RouteNeighbor).where(RouteNeighbor.route_id.in_(ids)))
+    rows = [{"route_id": route_id, "rank": rank, "neighbor_id": neighbor, "score": score}
+            for route_id in ids for rank, (neighbor, score) in enumerate(table.rows.get(route_id, ()))]
+    if rows:
+        await session.execute(insert(RouteNeighbor), rows)
+
+
+def _table_version(catalog_version) -> str:
+    return f"{catalog_version}:{SIMILAR_K}:{FEATURES_VERSION}"
+
+
+async def ensure_table() -> None:
+    """Собирает таблицу заново, если она построена для другой версии каталога, K или признаков."""
+    snapshot = await catalog.get_snapshot()
+    expected = _table_version(snapshot.version)
+    async with AsyncSessionLocal() as session:
+        if (await read_meta(session)).get("neighbors_version") == expected:
+            return
+        table = SimilarityTable()
+        table.build(snapshot.routes)
+        await save_rows(session, table)
+        await set_meta(session, neighbors_version=expected)
+        await session.commit()
+    logger.info("Route similarity table built for catalog v%s: %s routes, K=%s",
+                snapshot.version, len(table.rows), SIMILAR_K)
+
+
+async def update_routes(session, routes: Dict[int, Dict[str, Any] | None], version: int,
+                        base: List[Dict[str, Any]] | None = None) -> Set[int]:
+    """Инкрементально обновляет таблицу после изменения маршрутов (None — маршрут удалён).
+
+    ``routes`` — изменившиеся маршруты в новом виде; остальные берутся из ``base`` (каталог до изменения),
+    по умолчанию — из текущего снимка каталога. Коммит — за вызывающим.
+    """
+    meta = await read_meta(session)
+    if base is None:
+        snapshot = await catalog.get_snapshot(session)
+        base, base_version = snapshot.routes, snapshot.version
+    else:
+        base_version = meta.get("catalog_version")
+    current = {r["id"]: r for r in base}
+    current.update(routes)
+    table = SimilarityTable()
+    if meta.get("neighbors_version") != _table_version(base_version):
+        # таблица построена не для этого каталога (или ещё не строилась) — править её по разнице нельзя
+        table.build([r for r in current.values() if r is not None])
+        await save_rows(session, table)
+        await set_meta(session, neighbors_version=_table_version(version))
+        return set(table.rows)
+    table.features = {route_id: route_features(r) for route_id, r in current.items() if r is not None}
+    rows = await session.execute(select(RouteNeighbor).order_by(RouteNeighbor.route_id, RouteNeighbor.rank))
+    for row in rows.scalars():
+        table.rows.setdefault(row.route_id, []).append((row.neighbor_id, row.score))
+    for route_id in table.features:
+        table.rows.setdefault(route_id, [])
+    for route_id, route in routes.items():
+        if route is None:
+            table.rows.pop(route_id, None)
+    changed: Set[int] = set()
+    for route_id, route in routes.items():
+        changed |= table.apply_change(route_id, route)
+    await save_rows(session, table, changed)
+    await set_meta(session, neighbors_version=_table_version(version))
+    return changed
+
+
+async def similar_routes(session, route_id: int) -> List[int]:
+    """Id похожих маршрутов, от самого похожего: один запрос по первичному ключу, без подсчёта оценок."""
+    rows = await session.execute(
+        select(RouteNeighbor.neighbor_id).where(RouteNeighbor.route_id == route_id).order_by(RouteNeighbor.rank)
+    )
+    return list(rows.scalars())
+
+
+_task: asyncio.Task | None = None
+
+
+def preload() -> None:
+    """Проверяет таблицу в фоне после старта."""
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(ensure_table(), name="similarity-table")
+        _task.add_done_callback(_preload_done)
+
+
+def _preload_done(task: asyncio.Task) -> None:
+    global _task
+    _task = None
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Route similarity table build failed", exc_info=task.exception())
+
+
+def _bench(n: int = 2000, changes: int = 50) -> None:
+    """Полная сборка против инкрементального обновления на синтетическом каталоге."""
+    import random
+    import time
+
+    rng = random.Random(1)
+    tags = [f"tag{i}" for i in range(30)]
+
+    def fake_route(route_id: int) -> Dict[str, Any]:
+        return {"id": route_id, "title": " ".join(rng.sample(tags, 2)), "tags": rng.sample(tags, rng.randint(1, 5)),
+                "seasons": rng.sample(["winter", "spring", "summer", "autumn"], rng.randint(1, 3)),
+                "transports": rng.sample(["car", "walk", "bus"], rng.randint(1, 2)),
+                "difficulty": rng.choice(list(DIFFICULTY_LEVELS)),
+                "length_km": rng.uniform(2, 150), "price_estimate": rng.uniform(0, 20000)}
+
+    routes = [fake_route(i) for i in range(1, n + 1)]
+    table = SimilarityTable()
+    started = time.perf_counter()
+    table.build(routes)
+    print(f"full build: {n} routes in {time.perf_counter() - started:.2f}s")
+    started = time.perf_counter()
+    touched = 0
+    for _ in range(changes):
+        route_id = rng.randint(1, n)
+        touched += len(table.apply_change(route_id, fake_route(route_id)))
+    elapsed = (time.perf_counter() - started) / changes
+    print(f"incremental: {elapsed * 1000:.1f} ms per changed route, {touched / changes:.1f} rows rewritten")
+
+
+if __name__ == "__main__":
+    # python similarity.py [маршрутов]
+    _bench(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,12 @@
+"""Общие настройки тестов: модули бота импортируются из корня репозитория, БД и файлы — во временном каталоге."""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# db создаёт движок при импорте — адрес БД задаётся до импорта любых модулей бота
+TMP = tempfile.mkdtemp(prefix="tuva-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(TMP, 'test.db')}"
+os.environ.setdefault("EVENTS_DIR", "-")
@@ -0,0 +1,47 @@
+"""Слияние сегментов журнала действий и удаление старых дней."""
+import os
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+
+from events import COMPACTED, PREFIX, compact
+
+
+def write_segment(directory: str, day: str, pid: int, events) -> str:
+    name = f"{PREFIX}{day}-000000-000000-{pid}.jsonl"
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(event) + "\n" for event in events)
+    return name
+
+
+def write_packed(directory: str, day: str, generation: int, events) -> str:
+    name = f"{PREFIX}{day}.g{generation}{COMPACTED}"
+    with gzip.open(os.path.join(directory, name), "wt", encoding="utf-8") as f:
+        f.writelines(json.dumps(event) + "\n" for event in events)
+    return name
+
+
+def test_compact_merges_segments_into_the_next_generation(tmp_path):
+    directory = str(tmp_path)
+    today = datetime.now(timezone.utc).strftime("%Y%m%d")
+    write_packed(directory, today, 1, [{"n": 1}])
+    write_segment(directory, today, 1, [{"n": 2}])
+    write_segment(directory, today, 2, [{"n": 3}])
+
+    assert compact(directory, retention_days=0) == 2
+    assert sorted(n for n in os.listdir(directory) if n != ".lock") == [f"{PREFIX}{today}.g2{COMPACTED}"]
+    with gzip.open(os.path.join(directory, f"{PREFIX}{today}.g2{COMPACTED}"), "rt", encoding="utf-8") as f:
+        assert [json.loads(line)["n"] for line in f] == [1, 2, 3]
+
+
+def test_retention_removes_a_stale_day_merged_in_the_same_pass(tmp_path):
+    directory = str(tmp_path)
+    stale = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y%m%d")
+    fresh = datetime.now(timezone.utc).strftime("%Y%m%d")
+    # у старого дня остались незалитые сегменты: слияние создаёт .g2 и удаляет .g1 до проверки срока
+    write_packed(directory, stale, 1, [{"n": 1}])
+    write_segment(directory, stale, 1, [{"n": 2}])
+    write_packed(directory, fresh, 1, [{"n": 3}])
+
+    assert compact(directory, retention_days=7) == 1
+    assert sorted(n for n in os.listdir(directory) if n != ".lock") == [f"{PREFIX}{fresh}.g1{COMPACTED}"]
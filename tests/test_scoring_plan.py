@@ -0,0 +1,221 @@
+"""Скомпилированный план оценки против прежней ручной функции: совпадение оценок; замер скорости — _bench()."""
+import sys
+import random
+import time
+import logging
+from dataclasses import fields, replace
+from typing import Any, Callable, Dict
+
+import pytest
+
+from db import SAMPLE_ROUTES
+from recommender import DEFAULT_WEIGHTS, SEASONS_BY_MONTH, ScoringWeights, scorer_for
+from scoring_plan import DEFAULT_PLAN, Scorer, compile_plan, validate
+
+reference_logger = logging.getLogger("tests.reference_scorer")
+WEIGHT_NAMES = [f.name for f in fields(ScoringWeights)]
+ROUTES = [dict(r, id=n) for n, r in enumerate(SAMPLE_ROUTES, start=1)]
+
+
+def reference_scorer(w: ScoringWeights) -> Scorer:
+    """Ручная оценка из recommender до перехода на план — эталон для сверки."""
+    w_current, w_pref = w.current_season, w.pref_season
+    w_length, length_scale = w.length, w.length_scale
+    w_price, price_scale = w.price, w.price_scale
+    w_difficulty, w_transport, w_link = w.difficulty, w.transport, w.link
+    w_popularity, popularity_scale = w.popularity, w.popularity_scale
+    w_tag, w_overlap = w.tag, w.tag_overlap
+
+    def score_route(route_row: Dict[str, Any], prefs: Dict[str, Any], current_season: str) -> float:
+        score = 0.0
+        # пояснения к оценке нужны только для DEBUG-лога; строки не собираем, если он выключен
+        explain = reference_logger.isEnabledFor(logging.DEBUG)
+        debug = []
+
+        if current_season in route_row.get("seasons", []):
+            score += w_current
+            if explain:
+                debug.append(f"season_match_current(+{w_current:g})")
+        if prefs.get("season") in route_row.get("seasons", []):
+            score += w_pref
+            if explain:
+                debug.append(f"season_match_pref(+{w_pref:g})")
+
+        try:
+            pref_len = float(prefs.get("length_km", 0))
+            length = float(route_row.get("length_km") or 0)
+            add = max(0, w_length - abs(length - pref_len) / length_scale)
+            score += add
+            if explain:
+                debug.append(f"length_diff({length}-{pref_len})(+{add:.2f})")
+        except Exception:
+            if explain:
+                debug.append("length_skip")
+
+        try:
+            pref_price = float(prefs.get("price_estimate", 0))
+            price = float(route_row.get("price_estimate") or 0)
+            add = max(0, w_price - abs(price - pref_price) / price_scale)
+            score += add
+            if explain:
+                debug.append(f"price_diff({price}-{pref_price})(+{add:.2f})")
+        except Exception:
+            if explain:
+                debug.append("price_skip")
+
+        if prefs.get("difficulty"):
+            if prefs["difficulty"] == route_row.get("difficulty"):
+                score += w_difficulty
+                if explain:
+                    debug.append(f"difficulty_match(+{w_difficulty:g})")
+            elif explain:
+                debug.append("difficulty_mismatch")
+
+        try:
+            pref_pop = int(prefs.get("popularity", 0))
+            pop = int(route_row.get("popularity") or 0)
+            add = max(0, w_popularity - abs(pop - pref_pop) / popularity_scale)
+            score += add
+            if explain:
+                debug.append(f"pop_diff({pop}-{pref_pop})(+{add:.2f})")
+        except Exception:
+            if explain:
+                debug.append("pop_skip")
+
+        pref_trans = prefs.get("transport")
+        if pref_trans:
+            if pref_trans in route_row.get("transports", []):
+                score += w_transport
+                if explain:
+                    debug.append(f"transport_ok(+{w_transport:g})")
+            elif explain:
+                debug.append("transport_no")
+
+        route_tags_set = set(route_row.get("tags", []))
+        prefs_tags = set(prefs.get("tags", []))
+        match_count = len(route_tags_set & prefs_tags)
+        score += match_count * w_tag
+        if explain:
+            debug.append(f"tags_matched({match_count})*(+{match_count * w_tag:.2f})")
+        if prefs_tags:
+            overlap_ratio = len(route_tags_set & prefs_tags) / len(prefs_tags)
+            add = overlap_ratio * w_overlap
+            score += add
+            if explain:
+                debug.append(f"tags_overlap_ratio({overlap_ratio:.2f})(+{add:.2f})")
+
+        if route_row.get("link"):
+            score += w_link
+            if explain:
+                debug.append(f"has_link(+{w_link:g})")
+
+        if explain:
+            reference_logger.debug("SCORE DEBUG for '%s' : score=%.3f | %s",
+                                   route_row.get("title"), score, "; ".join(debug))
+        return score
+
+    return score_route
+
+
+def random_cases(count: int, seed: int = 1):
+    """Случайные предпочтения, включая строки и мусор вместо чисел — как в старых записях preferences."""
+    rng = random.Random(seed)
+    tags = sorted({t for r in ROUTES for t in r["tags"]})
+    seasons = sorted(set(SEASONS_BY_MONTH.values()))
+
+    def number(low: int, high: int) -> Any:
+        return rng.choice([rng.randint(low, high), float(rng.randint(low, high)), str(rng.randint(low, high)), "abc"])
+
+    cases = []
+    for _ in range(count):
+        prefs = {"season": rng.choice(seasons + [None]), "tags": rng.sample(tags, rng.randint(0, 4)),
+                 "difficulty": rng.choice(["легко", "средне", "сложно", "варьируется", None]),
+                 "transport": rng.choice(["car", "minibus", "walk", "horse", None])}
+        for key, low, high in (("length_km", 1, 200), ("price_estimate", 0, 30000), ("popularity", 0, 100)):
+            if rng.random() < 0.9:
+                prefs[key] = number(low, high)
+        cases.append((prefs, rng.choice(seasons)))
+    return cases
+
+
+@pytest.mark.parametrize("weights", [DEFAULT_WEIGHTS, replace(DEFAULT_WEIGHTS, tag=3.0, length_scale=10, link=0)],
+                         ids=["default", "variant"])
+def test_compiled_plan_matches_reference(weights):
+    reference, compiled = reference_scorer(weights), scorer_for(weights)
+    for prefs, season in random_cases(2000):
+        prepared = compiled.prepare(prefs, season)
+        for route in ROUTES:
+            expected = reference(route, prefs, season)
+            assert compiled(route, prefs, season) == expected, (route["id"], prefs, season)
+            assert prepared(route) == expected, (route["id"], prefs, season)
+
+
+def test_debug_path_matches_reference():
+    log = logging.getLogger("tests.debug_scorer")
+    log.setLevel(logging.DEBUG)
+    compiled = compile_plan(DEFAULT_PLAN, DEFAULT_WEIGHTS, log)
+    reference = reference_scorer(DEFAULT_WEIGHTS)
+    for prefs, season in random_cases(50, seed=2):
+        prepared = compiled.prepare(prefs, season)
+        for route in ROUTES:
+            assert compiled(route, prefs, season) == prepared(route) == reference(route, prefs, season)
+
+
+def test_cap_and_literal_numbers():
+    plan = {"terms": [
+        {"kind": "shared", "route": "tags", "pref": "tags", "weight": 5, "cap": 6},
+        {"kind": "closeness", "route": "length_km", "pref": "length_km", "weight": 4, "divisor": 10, "cap": 3},
+        {"kind": "equals", "route": "difficulty", "pref": "$season", "weight": 1},
+    ]}
+    validate(plan, WEIGHT_NAMES)
+    score = compile_plan(plan, DEFAULT_WEIGHTS)
+    route = {"tags": ["nature", "family", "hiking"], "length_km": 40.0, "difficulty": "легко"}
+    # теги: 2 × 5 = 10, потолок 6; длина: 4 − 15 / 10 = 2.5 (ниже потолка 3); сложность не равна сезону
+    assert score(route, {"tags": ["nature", "family"], "length_km": 25}, "summer") == 8.5
+
+
+@pytest.mark.parametrize("plan, error", [
+    ({}, "non-empty"),
+    ({"terms": [{"kind": "x", "weight": 1}]}, "unknown kind"),
+    ({"terms": [{"kind": "present", "route": "link", "weight": "nope"}]}, "unknown weight"),
+    ({"terms": [{"kind": "equals", "route": "a", "pref": "b", "weight": 1, "cap": 2}]}, "cap is only"),
+    ({"terms": [{"kind": "closeness", "route": "a", "pref": "b", "weight": 1}]}, "needs 'divisor'"),
+    ({"terms": [{"kind": "closeness", "route": "a", "pref": "b", "weight": 1, "divisor": 0}]}, "zero"),
+    ({"terms": [{"kind": "present", "route": "link", "weight": 1, "wieght": 2}]}, "unknown keys"),
+])
+def test_validate_rejects_bad_plans(plan, error):
+    with pytest.raises(ValueError, match=error):
+        validate(plan, WEIGHT_NAMES)
+
+
+def test_zero_divisor_from_weights_fails_at_compile():
+    with pytest.raises(ValueError, match="divisor resolves to zero"):
+        compile_plan(DEFAULT_PLAN, replace(DEFAULT_WEIGHTS, length_scale=0))
+
+
+def _bench(profiles: int = 300) -> None:
+    """Прежняя функция, скомпилированный план и prepare(), мкс на маршрут (лучший из 5 прогонов).
+
+    Не тест: время на общем CI-сервере шумит сильнее, чем разница между реализациями.
+    """
+    cases = random_cases(profiles, seed=3)
+    reference, compiled = reference_scorer(DEFAULT_WEIGHTS), scorer_for(DEFAULT_WEIGHTS)
+    calls = len(cases) * len(ROUTES)
+
+    def best(run: Callable[[], Any]) -> float:
+        timings = []
+        for _ in range(5):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        return min(timings) / calls * 1e6
+
+    old = best(lambda: [reference(r, p, s) for p, s in cases for r in ROUTES])
+    flat = best(lambda: [compiled(r, p, s) for p, s in cases for r in ROUTES])
+    prepared = best(lambda: [score(r) for score in (compiled.prepare(p, s) for p, s in cases) for r in ROUTES])
+    print(f"reference: {old:.2f} us, compiled: {flat:.2f} us, prepared: {prepared:.2f} us per route")
+
+
+if __name__ == "__main__":
+    # python -m tests.test_scoring_plan [профилей]  — замер скорости из корня репозитория
+    _bench(int(sys.argv[1]) if len(sys.argv) > 1 else 300)
@@ -0,0 +1,79 @@
+"""Параллельные апдейты одного пользователя через настоящий диспетчер: ни одна запись не теряется."""
+import json
+import asyncio
+import itertools
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+from sqlalchemy import select
+
+import db
+import run
+import optimistic
+from models import Favorite, User
+
+TAGS = ["природа", "приключение", "семейное", "походы", "культура", "город", "история", "еда", "прогулки"]
+USERS = range(100, 120)
+ROUTES = (1, 2, 3)
+
+_ids = itertools.count(1)
+
+
+class FakeTelegram(BaseSession):
+    """Сессия бота без сети: любой метод Bot API «успешен», отправка сообщения возвращает сообщение."""
+
+    async def make_request(self, bot, method, timeout=None):
+        result = True
+        if "Message" in str(method.__returning__):
+            chat = {"id": getattr(method, "chat_id", 1) or 1, "type": "private"}
+            result = {"message_id": 1, "date": 0, "chat": chat, "text": "x"}
+        return self.check_response(bot=bot, method=method, status_code=200,
+                                   content=json.dumps({"ok": True, "result": result}))
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def message(user_id: int, text: str) -> Update:
+    user = {"id": user_id, "is_bot": False, "first_name": "U"}
+    return Update.model_validate({"update_id": next(_ids), "message": {
+        "message_id": 1, "date": 0, "chat": {"id": user_id, "type": "private"}, "from": user, "text": text}})
+
+
+def callback(user_id: int, data: str) -> Update:
+    user = {"id": user_id, "is_bot": False, "first_name": "U"}
+    return Update.model_validate({"update_id": next(_ids), "callback_query": {
+        "id": str(next(_ids)), "chat_instance": "1", "data": data, "from": user,
+        "message": {"message_id": 5, "date": 0, "chat": {"id": user_id, "type": "private"}, "text": "x"}}})
+
+
+def test_concurrent_updates_keep_every_write():
+    bot = run.create_bot()
+    bot.session = FakeTelegram()
+    dp = run.create_dispatcher(bot)
+
+    async def scenario():
+        await db.init_db_and_seed()
+        for user_id in USERS:
+            await dp.feed_update(bot, message(user_id, "/start"))
+        # каждый тег — чтение-изменение-запись одного и того же JSON в preferences; без очереди пользователя
+        # параллельные апдейты читают одну версию и затирают теги друг друга
+        updates = [callback(u, f"tag_{tag}") for u in USERS for tag in TAGS]
+        updates += [callback(u, f"add_fav_{r}") for u in USERS for r in ROUTES for _ in range(2)]
+        results = await asyncio.gather(*(dp.feed_update(bot, update) for update in updates),
+                                       return_exceptions=True)
+        await optimistic.write_behind.close()
+        async with db.AsyncSessionLocal() as session:
+            users = (await session.execute(select(User).where(User.tg_id.in_(USERS)))).scalars().all()
+            favorites = (await session.execute(select(Favorite.user_id, Favorite.route_id))).all()
+        return results, users, favorites
+
+    results, users, favorites = asyncio.run(scenario())
+    assert [r for r in results if isinstance(r, Exception)] == []
+    assert len(users) == len(USERS)
+    for user in users:
+        assert sorted(json.loads(user.preferences or "{}").get("tags", [])) == sorted(TAGS), user.tg_id
+    assert len(favorites) == len(set(favorites)) == len(USERS) * len(ROUTES)
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+from sqlalchemy import event
+
+import metrics
+from db import engine
+
+logger = logging.getLogger(__name__)
+
+# доля апдейтов, которые трассируются всегда (0..1)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# кроме того, сохраняются все апдейты дольше порога (0 — выключено); записываются все апдейты,
+# а экспортируются только медленные
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+# файл JSONL для трасс; без него трассы хранятся в памяти (последние TRACE_BUFFER)
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", "200"))
+# как часто трассы из памяти дописываются в TRACE_FILE, секунды
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))
+# больше трасс в ожидании записи не держим (диск не успевает) — новые отбрасываются
+TRACE_PENDING_MAX = int(os.getenv("TRACE_PENDING_MAX", "10000"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "500"))
+
+ENABLED = TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attrs")
+
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, attrs: Dict[str, Any]):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = perf_counter()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+
+    def finish(self) -> None:
+        self.end = perf_counter()
+
+
+class Trace:
+    """Все спаны одного апдейта. Число спанов ограничено TRACE_MAX_SPANS, лишние отбрасываются."""
+    __slots__ = ("trace_id", "wall_start", "spans", "dropped")
+
+    def __init__(self):
+        self.trace_id = f"{random.getrandbits(64):016x}"
+        self.wall_start = time.time()
+        self.spans: List[Span] = []
+        self.dropped = 0
+
+    def start_span(self, name: str, parent: Optional[Span] = None, attrs: Dict[str, Any] = None) -> Optional[Span]:
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(len(self.spans) + 1, parent.span_id if parent is not None else None, name, attrs or {})
+        self.spans.append(span)
+        return span
+
+    def to_dict(self) -> Dict[str, Any]:
+        root = self.spans[0]
+        end = root.end or perf_counter()
+        return {
+            "trace_id": self.trace_id,
+            "name": root.attrs.get("action", root.name),
+            "start": self.wall_start,
+            "duration_ms": round((end - root.start) * 1000, 3),
+            "dropped_spans": self.dropped,
+            "spans": [{
+                "id": s.span_id,
+                "parent": s.parent_id,
+                "name": s.name,
+                "start_ms": round((s.start - root.start) * 1000, 3),
+                "duration_ms": round(((s.end or end) - s.start) * 1000, 3),
+                "attrs": s.attrs,
+            } for s in self.spans],
+        }
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Дочерний спан текущего апдейта; вне трассы ничего не делает."""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    s = trace.start_span(name, current_span.get(), attrs)
+    if s is None:
+        yield None
+        return
+    token = current_span.set(s)
+    try:
+        yield s
+    finally:
+        s.finish()
+        current_span.reset(token)
+
+
+def start_child(name: str, **attrs) -> Optional[Span]:
+    """Спан без смены текущего (для событий SQLAlchemy, где нет with-блока); закрывается через finish()."""
+    trace = current_trace.get()
+    if trace is None:
+        return None
+    return trace.start_span(name, current_span.get(), attrs)
+
+
+class InMemoryExporter:
+    def __init__(self, size: int = TRACE_BUFFER):
+        self.traces: deque = deque(maxlen=size)
+
+    def export(self, trace: Trace) -> None:
+        self.traces.append(trace.to_dict())
+
+    def get(self, trace_id: str) -> Optional[Dict[str, Any]]:
+        return next((t for t in self.traces if t["trace_id"] == trace_id), None)
+
+    def slowest(self, n: int = 10) -> List[Dict[str, Any]]:
+        return sorted(self.traces, key=lambda t: -t["duration_ms"])[:n]
+
+    async def close(self) -> None:
+        pass
+
+
+class JsonlExporter:
+    """Дописывает по одной трассе на строку; файл читает ``python tracing.py``.
+
+    ``export`` не ждёт диска: трасса кладётся в буфер, а сериализация и запись идут в потоке из фоновой
+    задачи раз в ``interval`` секунд. Остаток буфера сбрасывает close().
+    """
+
+    def __init__(self, path: str, interval: float = TRACE_FLUSH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.dropped = 0
+        self._file = open(path, "a", encoding="utf-8")
+        # поток сброса, отменённый в close(), может ещё дописывать, пока close() пишет остаток
+        self._lock = threading.Lock()
+        self._buffer: List[Dict[str, Any]] = []
+        self._task: asyncio.Task | None = None
+
+    def export(self, trace: Trace) -> None:
+        if len(self._buffer) >= TRACE_PENDING_MAX:
+            self.dropped += 1
+            return
+        self._buffer.append(trace.to_dict())
+        if self._task is None or self._task.done():
+            # чистый контекст: иначе задача унаследует трассу апдейта, который её запустил
+            self._task = asyncio.create_task(self._run(), name="trace-export", context=contextvars.Context())
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        lines = [json.dumps(trace, ensure_ascii=False, default=str) + "\n" for trace in batch]
+        with self._lock:
+            self._file.writelines(lines)
+            self._file.flush()
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except OSError:
+            self.dropped += len(batch)
+            logger.exception("Failed to write %s traces to %s", len(batch), self.path)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+exporter = JsonlExporter(TRACE_FILE) if TRACE_FILE else InMemoryExporter()
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Внешний middleware: превращает апдейт в трассу. Должен стоять первым, чтобы в трассу
+    попало и ожидание очереди пользователя и допуска."""
+
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, slow_ms: float = TRACE_SLOW_MS):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        sampled = random.random() < self.sample_rate
+        if not sampled and not self.slow_ms:
+            return await handler(event, data)
+
+        trace = Trace()
+        attrs = {}
+        if isinstance(event, Update):
+            attrs = {"update_id": event.update_id, "action": metrics.action_label(event.event)}
+        root = trace.start_span("update", None, attrs)
+        trace_token = current_trace.set(trace)
+        span_token = current_span.set(root)
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            root.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            root.finish()
+            current_span.reset(span_token)
+            current_trace.reset(trace_token)
+            if sampled or (root.end - root.start) * 1000 >= self.slow_ms:
+                try:
+                    exporter.export(trace)
+                except Exception:
+                    logger.exception("Failed to export trace %s", trace.trace_id)
+
+
+class HandlerSpanMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: спан обработчика внутри трассы апдейта."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if current_trace.get() is None:
+            return await handler(event, data)
+        name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "handler")
+        with span(f"handler.{name}"):
+            return await handler(event, data)
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: спан на каждый вызов Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        if current_trace.get() is None:
+            return await make_request(bot, method)
+        with span(f"telegram.{type(method).__name__}"):
+            return await make_request(bot, method)
+
+
+def _start_db_span(conn, cursor, statement, parameters, context, executemany):
+    context._trace_span = start_child("db", statement=" ".join(statement.split())[:120])
+
+
+def _end_db_span(conn, cursor, statement, parameters, context, executemany):
+    s = getattr(context, "_trace_span", None)
+    if s is not None:
+        s.finish()
+
+
+if ENABLED:
+    event.listen(engine.sync_engine, "before_cursor_execute", _start_db_span)
+    event.listen(engine.sync_engine, "after_cursor_execute", _end_db_span)
+
+
+def format_timeline(trace: Dict[str, Any], width: int = 40) -> str:
+    """Трасса в виде дерева спанов с полосками по времени (как flame graph, повёрнутый набок)."""
+    total = trace["duration_ms"] or 1.0
+    children: Dict[Any, list] = {}
+    for s in trace["spans"]:
+        children.setdefault(s["parent"], []).append(s)
+
+    start = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace["start"]))
+    lines = [f"trace {trace['trace_id']}  {trace['name']}  {trace['duration_ms']:.1f} ms  ({start})"]
+    lines.append(f"{'start, ms':>10} {'dur, ms':>9}  {'':{width}}  span")
+
+    def walk(parent_id, depth):
+        for s in sorted(children.get(parent_id, []), key=lambda x: x["start_ms"]):
+            offset = int(s["start_ms"] / total * width)
+            length = max(1, int(round(s["duration_ms"] / total * width)))
+            bar = (" " * offset + "█" * length)[:width]
+            label = s["name"]
+            if "statement" in s["attrs"]:
+                label += " " + s["attrs"]["statement"]
+            lines.append(f"{s['start_ms']:10.1f} {s['duration_ms']:9.1f}  {bar:{width}}  {'  ' * depth}{label}")
+            walk(s["id"], depth + 1)
+
+    walk(None, 0)
+    if trace.get("dropped_spans"):
+        lines.append(f"... {trace['dropped_spans']} spans dropped (TRACE_MAX_SPANS)")
+    return "\n".join(lines)
+
+
+def _read_traces(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    # python tracing.py traces.jsonl                 — последняя трасса
+    # python tracing.py traces.jsonl --slowest [N]   — N самых медленных
+    # python tracing.py traces.jsonl --list          — список трасс
+    # python tracing.py traces.jsonl <trace_id>
+    traces = _read_traces(sys.argv[1])
+    arg = sys.argv[2] if len(sys.argv) > 2 else None
+    if not traces:
+        print("no traces")
+    elif arg == "--list":
+        for t in traces:
+            print(f"{t['trace_id']}  {t['duration_ms']:9.1f} ms  {len(t['spans']):4d} spans  {t['name']}")
+    elif arg == "--slowest":
+        n = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        for t in sorted(traces, key=lambda t: -t["duration_ms"])[:n]:
+            print(format_timeline(t) + "\n")
+    elif arg:
+        found = [t for t in traces if t["trace_id"] == arg]
+        print(format_timeline(found[0]) if found else f"trace {arg} not found")
+    else:
+        print(format_timeline(traces[-1]))
@@ -125,3 +125,57 @@ reset_choice_keyboard = InlineKeyboardMarkup(
         ]
     ]
 )
+
+
+def route_keyboard(route_id: int, is_favorite: bool, is_completed: bool) -> InlineKeyboardMarkup:
+    """Кнопки под карточкой маршрута: избранное, отметка о прохождении и похожие маршруты"""
+    favorite_button_text = "❌ Удалить из моих маршрутов" if is_favorite else "❤️ Добавить в мои маршруты"
+    favorite_button_data = f"remove_fav_{route_id}" if is_favorite else f"add_fav_{route_id}"
+    completed_button_text = "✅ Пройден" if is_completed else "🏁 Отметить как пройденный"
+    completed_button_data = f"uncomplete_{route_id}" if is_completed else f"complete_{route_id}"
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=favorite_button_text, callback_data=favorite_button_data)],
+            [InlineKeyboardButton(text=completed_button_text, callback_data=completed_button_data)],
+            [InlineKeyboardButton(text="🔁 Похожие", callback_data=f"similar_{route_id}")],
+        ]
+    )
+
+
+SEASON_NAMES = {
+    "winter": "❄️ Зима",
+    "spring": "🌸 Весна",
+    "summer": "☀️ Лето",
+    "autumn": "🍁 Осень"
+}
+
+
+def normalize_link(link) -> str | None:
+    if isinstance(link, list):
+        link = link[0] if link else None
+    if not isinstance(link, str) or not link.strip():
+        return None
+    link = link.strip()
+    if not link.startswith(('http://', 'https://')):
+        link = 'https://' + link
+    return link
+
+
+def route_card(route: dict) -> str:
+    """Текст карточки маршрута из словаря каталога (как в разделе «Мои маршруты»)"""
+    seasons_display = [SEASON_NAMES.get(s, s) for s in route.get("seasons", [])]
+    text = (
+        f"🏔️<b>{route['title']}</b>\n\n"
+        f"<i>{route.get('description')}</i>\n\n"
+        f"📏 Длина: {route.get('length_km')} км\n"
+        f"⚡ Сложность: {route.get('difficulty')}\n"
+        f"💰 Цена: {route.get('price_estimate')} руб\n"
+        f"📈 Популярность: {route.get('popularity')}/100\n"
+        f"🏷️ Теги: {', '.join(route.get('tags', []))}\n"
+        f"📅 Сезоны: {', '.join(seasons_display)}\n"
+        f"🚗 Транспорт: {', '.join(route.get('transports', []))}"
+    )
+    link = normalize_link(route.get("link"))
+    if link:
+        text += f"\n🔗 <a href='{link}'>Подробнее о маршруте</a>"
+    return text
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import signal
+import asyncio
+import hashlib
+import logging
+import secrets
+from typing import Any, Awaitable, Callable, Dict
+
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "80"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+WEBHOOK_DELETE_ON_SHUTDOWN = os.getenv("WEBHOOK_DELETE_ON_SHUTDOWN", "1") == "1"
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+Submit = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+def resolve_secret(token: str) -> str:
+    """Секрет вебхука: из WEBHOOK_SECRET или детерминированно из токена, чтобы все инстансы совпадали."""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class UpdateFeeder:
+    """Обрабатывает апдейты конкурентно, но не больше ``limit`` одновременно.
+
+    Если все слоты заняты, ``submit`` ждёт освобождения слота, и Telegram получает ответ
+    чуть позже — это естественный backpressure вместо неограниченного числа задач.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, limit: int = WEBHOOK_MAX_CONCURRENCY):
+        self.dp = dp
+        self.bot = bot
+        self._slots = asyncio.Semaphore(limit)
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def submit(self, raw: Dict[str, Any]) -> None:
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(raw))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, raw: Dict[str, Any]) -> None:
+        try:
+            await self.dp.feed_raw_update(self.bot, raw)
+        except Exception:
+            logger.exception("Failed to process update %s", raw.get("update_id"))
+        finally:
+            self._slots.release()
+
+    async def drain(self) -> None:
+        if self._tasks:
+            logger.info("Waiting for %s in-flight updates...", len(self._tasks))
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_app(bot: Bot, submit: Submit, health: Callable[[], Dict[str, Any]] | None = None) -> web.Application:
+    secret = resolve_secret(bot.token)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        try:
+            raw = await request.json(loads=json.loads)
+        except ValueError:
+            return web.Response(status=400)
+        await submit(raw)
+        return web.Response()
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {metrics.METRICS_TOKEN}"):
+            return web.Response(status=401)
+        return await metrics.handle_metrics(request)
+
+    async def handle_health(request: web.Request) -> web.Response:
+        payload = {"status": "ok"}
+        if health is not None:
+            payload.update(health())
+        return web.json_response(payload)
+
+    async def on_startup(app: web.Application):
+        if not WEBHOOK_URL:
+            logger.warning("WEBHOOK_URL is not set, serving without registering the webhook (local mode).")
+            return
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=app.get("allowed_updates"),
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),
+        )
+        logger.info("Webhook registered at %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+    async def on_cleanup(app: web.Application):
+        if WEBHOOK_URL and WEBHOOK_DELETE_ON_SHUTDOWN:
+            try:
+                await bot.delete_webhook()
+                logger.info("Webhook removed.")
+            except Exception:
+                logger.exception("Failed to remove webhook")
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get("/healthz", handle_health)
+    # порт вебхука публичный: метрики на нём только по токену
+    if metrics.METRICS_TOKEN:
+        app.router.add_get("/metrics", handle_metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def serve(app: web.Application) -> None:
+    """Запускает aiohttp-сервер и ждёт SIGTERM/SIGINT, после чего аккуратно его останавливает."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info("Webhook server listening on %s:%s", WEBHOOK_HOST, WEBHOOK_PORT)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    feeder = UpdateFeeder(dp, bot)
+    app = create_app(bot, feeder.submit, health=lambda: {"in_flight": feeder.in_flight})
+    metrics.registry.callback("bot_webhook_in_flight", "Апдейты вебхука в обработке", lambda: feeder.in_flight)
+    app["allowed_updates"] = dp.resolve_used_update_types()
+
+    metrics_runner = await metrics.start_server() if metrics.METRICS_PORT else None
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    try:
+        await serve(app)
+    finally:
+        await feeder.drain()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+async def replay(path: str, url: str, secret: str) -> None:
+    """Отправляет записанные апдейты (по одному JSON на строку) на локальный сервер."""
+    async with ClientSession() as http:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                async with http.post(url, data=line, headers={SECRET_HEADER: secret,
+                                                              "Content-Type": "application/json"}) as resp:
+                    logger.info("update -> %s", resp.status)
+
+
+if __name__ == "__main__":
+    # python webhook.py updates.jsonl [http://localhost:80/webhook]
+    # токен — тот же, с которым запущен бот (run.py настраивает и логирование), иначе секрет не совпадёт
+    from run import BOT_TOKEN
+    target = sys.argv[2] if len(sys.argv) > 2 else f"http://localhost:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    asyncio.run(replay(sys.argv[1], target, resolve_secret(BOT_TOKEN)))
@@ -0,0 +1,203 @@
+import os
+import asyncio
+import logging
+import multiprocessing as mp
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "32"))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))
+
+_ctx = mp.get_context("spawn")
+
+_STOP = None
+
+
+def extract_chat_id(raw: Dict[str, Any]) -> int:
+    """chat_id апдейта (или id пользователя, если чата нет) — ключ привязки к воркеру."""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in raw:
+            return raw[key]["chat"]["id"]
+    callback = raw.get("callback_query")
+    if callback is not None:
+        message = callback.get("message")
+        if message is not None:
+            return message["chat"]["id"]
+        return callback["from"]["id"]
+    for key in ("inline_query", "chosen_inline_result", "my_chat_member", "chat_member"):
+        if key in raw:
+            return raw[key]["from"]["id"]
+    return 0
+
+
+async def _worker_loop(index: int, queue) -> None:
+    import metrics
+    from run import create_bot, create_dispatcher
+
+    bot = create_bot()
+    dp = create_dispatcher(bot)
+    # у каждого воркера свои метрики: порт METRICS_PORT + 1 + index (сам супервизор — на METRICS_PORT)
+    metrics_runner = await metrics.start_server(metrics.METRICS_PORT + 1 + index) if metrics.METRICS_PORT else None
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    # последний запущенный апдейт каждого чата: следующий ждёт его, чтобы порядок внутри чата сохранялся
+    tails: Dict[int, asyncio.Task] = {}
+
+    async def process(raw: Dict[str, Any], previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        async with slots:
+            try:
+                await dp.feed_raw_update(bot, raw)
+            except Exception:
+                logger.exception("Worker %s failed to process update %s", index, raw.get("update_id"))
+
+    def forget(chat_id: int, task: asyncio.Task) -> None:
+        if tails.get(chat_id) is task:
+            del tails[chat_id]
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], worker=index, **dp.workflow_data)
+    logger.info("Worker %s started (pid=%s)", index, os.getpid())
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is _STOP:
+                break
+            chat_id = extract_chat_id(raw)
+            task = asyncio.create_task(process(raw, tails.get(chat_id)))
+            tails[chat_id] = task
+            task.add_done_callback(lambda t, c=chat_id: forget(c, t))
+        if tails:
+            await asyncio.gather(*tails.values(), return_exceptions=True)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        logger.info("Worker %s stopped", index)
+
+
+def _worker_main(index: int, queue) -> None:
+    try:
+        asyncio.run(_worker_loop(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """Запускает N процессов-воркеров и раздаёт им апдейты по chat_id.
+
+    Апдейты одного чата всегда попадают в один и тот же воркер и обрабатываются по порядку.
+    Упавший воркер перезапускается с новой очередью: апдейты, которые он не успел забрать,
+    теряются (Telegram их уже не пришлёт повторно), поэтому это логируется.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.queues: List[Any] = [None] * size
+        self.processes: List[Optional[mp.Process]] = [None] * size
+        self._stopping = False
+
+    def _spawn(self, index: int) -> None:
+        queue = _ctx.Queue(maxsize=WORKER_QUEUE_SIZE)
+        process = _ctx.Process(target=_worker_main, args=(index, queue), name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        self.queues[index] = queue
+        self.processes[index] = process
+
+    def start(self) -> None:
+        for index in range(self.size):
+            self._spawn(index)
+        logger.info("Started %s workers", self.size)
+
+    def queue_depths(self) -> List[int]:
+        depths = []
+        for queue in self.queues:
+            try:
+                depths.append(queue.qsize())
+            except NotImplementedError:
+                depths.append(-1)
+        return depths
+
+    @staticmethod
+    async def _put(queue, item: Any, timeout: Optional[float] = None) -> None:
+        try:
+            queue.put_nowait(item)
+        except Exception:
+            # очередь воркера переполнена — ждём в отдельном потоке, не блокируя цикл событий
+            await asyncio.get_running_loop().run_in_executor(None, partial(queue.put, item, True, timeout))
+
+    async def submit(self, raw: Dict[str, Any]) -> None:
+        await self._put(self.queues[extract_chat_id(raw) % self.size], raw)
+
+    async def monitor(self, interval: float = 1.0) -> None:
+        while not self._stopping:
+            for index, process in enumerate(self.processes):
+                if process is not None and process.exitcode is not None and not self._stopping:
+                    logger.warning("Worker %s exited with code %s, restarting (queued updates: %s)",
+                                   index, process.exitcode, self.queue_depths()[index])
+                    self._spawn(index)
+            await asyncio.sleep(interval)
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        self._stopping = True
+        # воркер, который не освободил место в очереди за timeout, завершается принудительно ниже
+        await asyncio.gather(*(self._put(queue, _STOP, timeout) for queue in self.queues), return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning("Worker %s did not stop in time, terminating", process.name)
+                process.terminate()
+
+
+async def _poll(bot, supervisor: Supervisor, allowed_updates) -> None:
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                            allowed_updates=allowed_updates)
+        except Exception:
+            logger.exception("Failed to fetch updates, retrying")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await supervisor.submit(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+async def run_supervisor(size: int, mode: str) -> None:
+    """Режим нескольких процессов: супервизор сам получает апдейты (polling или webhook) и раздаёт их."""
+    import db
+    import metrics
+    from run import create_bot, create_dispatcher
+
+    # схема и сидирование — один раз до старта воркеров, чтобы они не гонялись за пустую БД
+    await db.init_db_and_seed()
+    await db.engine.dispose()
+
+    bot = create_bot()
+    allowed_updates = create_dispatcher(bot).resolve_used_update_types()
+    supervisor = Supervisor(size)
+    supervisor.start()
+    metrics.registry.callback("bot_worker_queue_depth", "Апдейты в очереди воркера",
+                              lambda: dict(enumerate(supervisor.queue_depths())), "worker")
+    monitor = asyncio.create_task(supervisor.monitor())
+    metrics_runner = await metrics.start_server() if metrics.METRICS_PORT else None
+    try:
+        if mode == "webhook":
+            import webhook
+            app = webhook.create_app(bot, supervisor.submit, health=lambda: {"queues": supervisor.queue_depths()})
+            app["allowed_updates"] = allowed_updates
+            await webhook.serve(app)
+        else:
+            await bot.delete_webhook()
+            await _poll(bot, supervisor, allowed_updates)
+    finally:
+        monitor.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await supervisor.stop()
+        await bot.session.close()